@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmarks for the hot paths in steenbeck. These run on synthetic
+data from fake_resolve, so no Resolve or ffmpeg is needed.
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+import fake_resolve
+import steenbeck
+from fake_resolve import syntheticPackets
+from steenbeck import KeyframeIndex, packet, packetFlags
+
+
+def linearKeyframes(packets, cuts, ptsperframe):
+    """
+    linearKeyframes resolves cut points the way steenbeck did before the
+    keyframe index, by walking the packet list from every cut point.
+    """
+    bypts = {}
+    for p in packets:
+        bypts[p["pts"]] = p
+    packets = sorted(list(bypts.values()), key=lambda x: x["pts"])
+
+    def findprevKeyframe(packets, i):
+        for j in reversed(range(i)):
+            if "K" in packets[j]["flags"]:
+                return packets[j]
+
+    def findnextKeyframe(packets, i):
+        for j in range(i, len(packets)):
+            if "K" in packets[j]["flags"]:
+                return packets[j]
+
+    res = {}
+    for i, p in enumerate(packets):
+        framenum = p["pts"]/ptsperframe
+        if framenum in cuts:
+            inkf = findnextKeyframe(packets, i)
+            outkf = findprevKeyframe(packets, i)
+            res[framenum] = (inkf["pts"]/ptsperframe if inkf else None,
+                             outkf["pts"]/ptsperframe if outkf else None)
+    return res
+
+
+def indexKeyframes(index, cuts):
+    res = {}
+    for c in cuts:
+        k = index.findnext(c)
+        inkf = index.frames[k] if k is not None else None
+        k = index.findprev(c)
+        res[c] = (inkf, index.frames[k] if k is not None else None)
+    return res
+
+
+def benchKeyframes(nframes, gop, ncuts):
+    packets = syntheticPackets(nframes, gop)
+    rng = random.Random(1)
+    cuts = set(rng.sample(range(1, nframes), ncuts))
+    timebase = fake_resolve.TIMEBASE
+    framerate = fake_resolve.FRAMERATE
+    ptsperframe = (1/framerate)/timebase
+
+    start = time.perf_counter()
+    expected = linearKeyframes(packets, cuts, ptsperframe)
+    linear = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = KeyframeIndex(timebase, framerate, nframes*fake_resolve.PTS_PER_FRAME)
+    for p in packets:
+        if "K" in p["flags"]:
+            index.add(packet(p["pts"], p["dts"], p["duration"], packetFlags(p["flags"])))
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    got = indexKeyframes(index, cuts)
+    lookup = time.perf_counter() - start
+
+    if got != expected:
+        raise Exception("keyframe index disagrees with linear scan")
+
+    print(f"keyframes frames:{nframes} gop:{gop} cuts:{ncuts}  "
+          f"linear:{linear*1000:.1f}ms  index build:{build*1000:.1f}ms  "
+          f"lookup:{lookup*1000:.2f}ms  speedup:{linear/(build+lookup):.1f}x")
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    res = fn(*args)
+    return res, time.perf_counter() - start
+
+
+def benchTimeline(ntracks, nitems, pattern, nedits, gop):
+    """
+    benchTimeline times every step of working out what to render, for an
+    edit of a synthetic timeline
+    """
+    original = fake_resolve.syntheticTimeline(ntracks, nitems)
+    target = fake_resolve.editTimeline(original, pattern, nedits)
+    label = f"timeline tracks:{ntracks} items:{nitems} {pattern}:{nedits}"
+
+    with tempfile.TemporaryDirectory(prefix="steenbeck-bench-") as td:
+        cache = steenbeck.SignatureCache(os.path.join(td, "timelines"))
+
+        def framesig(threads, cache=None):
+            snaps = steenbeck.snapshotTimelines([original, target], cache, threads=threads)
+            return steenbeck.calculateFrameSeqs(snaps, cache)
+
+        (originalFrames, targetFrames), uncached = timed(framesig, 1)
+        _, threaded = timed(framesig, 4)
+        _, cold = timed(framesig, 1, cache)
+        _, warm = timed(framesig, 1, cache)
+        print(f"{label}  frames:{targetFrames.duration} runs:{len(targetFrames.hashes)}  "
+              f"framesig:{uncached*1000:.1f}ms  threaded:{threaded*1000:.1f}ms  "
+              f"cold cache:{cold*1000:.1f}ms  warm cache:{warm*1000:.1f}ms")
+
+        _, lcs = timed(steenbeck.longestcommonsub,
+                       originalFrames.hashes, targetFrames.hashes)
+
+        reference = os.path.join(td, "reference.mp4")
+        with open(reference, "wb") as f:
+            f.write(b"\0" * 4096)
+        fake_resolve.FakeProbe(originalFrames.duration, gop).install()
+        _, probe = timed(steenbeck.loadKeyframeIndex, reference)
+        kfindex, sidecar = timed(steenbeck.loadKeyframeIndex, reference)
+
+        segments, build = timed(steenbeck.buildSegments, originalFrames,
+                                targetFrames, kfindex, 25)
+        glue = sum(s.duration for s in segments if isinstance(s, steenbeck.target))
+        print(f"{label}  lcs:{lcs*1000:.1f}ms  keyframe probe:{probe*1000:.1f}ms  "
+              f"sidecar:{sidecar*1000:.1f}ms  segments:{build*1000:.1f}ms  "
+              f"({len(segments)} segments, {glue} frames to render)")
+
+        pairs = steenbeck.commonsubpairs(originalFrames.hashes, targetFrames.hashes)
+        _, python = timed(steenbeck.planSegments, originalFrames, targetFrames, pairs,
+                          kfindex, 25, lambda msg, segs: None, False)
+        if steenbeck.numpy is not None:
+            _, vectorized = timed(steenbeck.planSegmentsNumpy, originalFrames, targetFrames,
+                                  pairs, kfindex, 25)
+            print(f"{label}  planning python:{python*1000:.1f}ms  numpy:{vectorized*1000:.1f}ms")
+
+        smart = steenbeck.buildSegments(originalFrames, targetFrames, kfindex,
+                                        25, smartrender=True)
+        glue = sum(s.duration for s in smart if isinstance(s, steenbeck.target))
+        reencoded = sum(s.duration for s in smart if isinstance(s, steenbeck.reencode))
+        print(f"{label}  smart render: {len(smart)} segments, {glue} frames to render, "
+              f"{reencoded} frames to re-encode")
+
+        for smartrender in (False, True):
+            report = steenbeck.Report()
+            steenbeck.buildSegments(originalFrames, targetFrames, kfindex, 25, report=report,
+                                    smartrender=smartrender, model=steenbeck.costModel())
+            info = report.info
+            print(f"{label}  cost planner{' smart render' if smartrender else ''}: "
+                  f"{info['gluesegments']} jobs, {info['glueframes']} frames to render, "
+                  f"{info['reencodeframes']} to re-encode, about {info['plancost']:.1f}s "
+                  f"against {info['greedyplancost']:.1f}s by mergegap")
+
+        snaps = steenbeck.snapshotTimelines([original, target])
+        steenbeck.calculateFrameSeqs(snaps)
+        causes, explain = timed(steenbeck.renderCauses, *snaps, segments)
+        blamed = {}
+        for c in causes.values():
+            for cause, frames in c.items():
+                blamed[cause] = blamed.get(cause, 0) + frames
+        print(f"{label}  explain:{explain*1000:.1f}ms  " +
+              " ".join(f"{cause}:{frames}" for cause, frames in sorted(blamed.items())))
+
+        # a render of the target, described by its manifest, standing
+        # in for the original timeline of the next run
+        snap, = steenbeck.snapshotTimelines([target])
+        steenbeck.calculateFrameSeq(snap)
+        output = os.path.join(td, "output.mp4")
+        with open(output, "wb") as f:
+            f.write(b"\0" * 4096)
+        _, save = timed(steenbeck.saveManifest, output,
+                        steenbeck.Manifest(snap, steenbeck.audioLayout(target)))
+        manifest, load = timed(steenbeck.loadManifest, output)
+        _, rehash = timed(steenbeck.calculateFrameSeq, manifest.snapshot)
+        print(f"{label}  manifest: {os.path.getsize(output + '.stbkman')} bytes  "
+              f"save:{save*1000:.1f}ms  load:{load*1000:.1f}ms  frames from manifest:{rehash*1000:.1f}ms")
+
+
+def benchAlignment(ntracks, nitems, nedits, gop):
+    """
+    benchAlignment compares how many frames get rendered for edits that
+    move clips around in their media, or put things on top of them,
+    against diffing frame by frame
+    """
+    original = fake_resolve.syntheticTimeline(ntracks, nitems)
+    for pattern in ("headtrim", "slip", "overlay"):
+        target = fake_resolve.editTimeline(original, pattern, nedits)
+        snaps = steenbeck.snapshotTimelines([original, target], threads=1)
+        table = steenbeck.SignatureTable()
+        runs = steenbeck.calculateFrameSeqs(snaps, table=table)
+        frames = []
+        for snap in snaps:
+            tracks, _ = steenbeck.trackItems(snap, 'video')
+            frames.append(steenbeck.sweepTracks(
+                tracks, list(range(snap.endframe - snap.startframe + 1)), table))
+        kfindex = fake_resolve.syntheticIndex(runs[0].duration,
+                                              fake_resolve.syntheticKeyframes(runs[0].duration, gop))
+
+        rendered = []
+        for originalFrames, targetFrames in (runs, frames):
+            segments = steenbeck.buildSegments(originalFrames, targetFrames, kfindex, 0)
+            rendered.append(sum(s.duration for s in segments if isinstance(s, steenbeck.target)))
+        print(f"alignment tracks:{ntracks} items:{nitems} {pattern}:{nedits} gop:{gop}  "
+              f"frames to render by runs:{rendered[0]} frame by frame:{rendered[1]}")
+
+
+def bench():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-frames', type=int, default=135_000)
+    parser.add_argument('-pattern', default="mixed",
+                        choices=fake_resolve.EDIT_PATTERNS)
+    parser.add_argument('-edits', type=int, default=20)
+    parser.add_argument('-gop', type=int, default=250)
+    parser.add_argument('-latency', type=float, default=0.0,
+                        help="seconds every fake resolve call takes")
+    args = parser.parse_args()
+    fake_resolve.latency = args.latency
+
+    for gop, ncuts in [(12, 100), (250, 100), (250, 1000), (250, 5000)]:
+        benchKeyframes(args.frames, gop, ncuts)
+
+    for gop in (12, args.gop):
+        benchAlignment(3, 30, 5, gop)
+
+    for ntracks, nitems in [(1, 100), (4, 1000), (8, 5000)]:
+        benchTimeline(ntracks, nitems, args.pattern, args.edits, args.gop)
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,499 @@
+#!/usr/bin/env python
+
+"""
+A stand-in for the parts of the DaVinci Resolve scripting API that steenbeck
+uses, along with a stand-in for ffprobe. This makes it possible to run the
+hot paths of steenbeck on synthetic timelines without Resolve or ffmpeg
+installed, for benchmarking.
+"""
+import fractions
+import itertools
+import os
+import random
+import time
+import steenbeck
+
+# resolve hands out a lot more properties than this, but these are the ones
+# that are there for every video item
+DEFAULT_PROPERTIES = {
+    "Pan": 0.0,
+    "Tilt": 0.0,
+    "ZoomX": 1.0,
+    "ZoomY": 1.0,
+    "ZoomGang": True,
+    "RotationAngle": 0.0,
+    "AnchorPointX": 0.0,
+    "AnchorPointY": 0.0,
+    "Pitch": 0.0,
+    "Yaw": 0.0,
+    "FlipX": False,
+    "FlipY": False,
+    "CropLeft": 0.0,
+    "CropRight": 0.0,
+    "CropTop": 0.0,
+    "CropBottom": 0.0,
+    "CropSoftness": 0.0,
+    "CropRetain": False,
+    "DynamicZoomEase": 0,
+    "CompositeMode": 0,
+    "Opacity": 100.0,
+    "Distortion": 0.0,
+    "RetimeProcess": 0,
+    "MotionEstimation": 0,
+    "Scaling": 0,
+    "ResizeFilter": 0,
+}
+
+EDIT_PATTERNS = ["insert", "delete", "trim", "headtrim", "slip", "property", "overlay", "mixed"]
+
+uniqueids = itertools.count(1)
+
+# seconds every call on a timeline item takes. Real resolve calls are a
+# round trip to another process, set this to see what that does
+latency = 0.0
+
+
+def roundTrip():
+    if latency > 0:
+        time.sleep(latency)
+
+
+class MediaPoolItem:
+    def __init__(self, mediaid, fps="25"):
+        self.mediaid = mediaid
+        self.fps = fps
+
+    def GetMediaId(self):
+        roundTrip()
+        return self.mediaid
+
+    def GetClipProperty(self, key=None):
+        roundTrip()
+        props = {"FPS": self.fps}
+        if key is not None:
+            return props.get(key)
+        return props
+
+
+class TimelineItem:
+    """
+    TimelineItem is an item on a track. start and end are timeline
+    frame numbers, source is the frame of the media the item starts on
+    """
+
+    def __init__(self, media, start, end, source, props):
+        self.media = media
+        self.start = start
+        self.end = end
+        self.source = source
+        self.props = props
+        self.uniqueid = f"item-{next(uniqueids)}"
+
+    def GetName(self):
+        roundTrip()
+        return f"{self.media.mediaid}.mov"
+
+    def GetMediaPoolItem(self):
+        roundTrip()
+        return self.media
+
+    def GetStart(self):
+        roundTrip()
+        return self.start
+
+    def GetEnd(self):
+        roundTrip()
+        return self.end
+
+    def GetDuration(self):
+        roundTrip()
+        return self.end - self.start
+
+    def GetSourceStartFrame(self):
+        roundTrip()
+        return self.source
+
+    def GetSourceEndFrame(self):
+        roundTrip()
+        return self.source + (self.end - self.start)
+
+    def GetLeftOffset(self, transitionPolicy=False):
+        roundTrip()
+        return self.source
+
+    def GetProperty(self, key=None):
+        roundTrip()
+        if key is not None:
+            return self.props.get(key)
+        return dict(self.props)
+
+    def GetUniqueId(self):
+        roundTrip()
+        return self.uniqueid
+
+
+class Timeline:
+    def __init__(self, name, startframe, video, audio, framerate="25"):
+        self.name = name
+        self.startframe = startframe
+        self.tracks = {"video": video, "audio": audio}
+        self.framerate = framerate
+        self.uniqueid = f"timeline-{next(uniqueids)}"
+
+    def GetName(self):
+        return self.name
+
+    def GetUniqueId(self):
+        return self.uniqueid
+
+    def GetStartFrame(self):
+        return self.startframe
+
+    def GetEndFrame(self):
+        end = self.startframe
+        for tracks in self.tracks.values():
+            for items in tracks:
+                if items:
+                    end = max(end, items[-1].end)
+        return end
+
+    def GetSetting(self, key):
+        return {
+            "timelineFrameRate": self.framerate,
+            "timelineResolutionWidth": "1920",
+            "timelineResolutionHeight": "1080",
+        }.get(key)
+
+    def GetTrackCount(self, tracktype):
+        return len(self.tracks.get(tracktype, []))
+
+    def GetTrackSubType(self, tracktype, index):
+        if tracktype != "audio":
+            return None
+        return "stereo"
+
+    def GetItemListInTrack(self, tracktype, index):
+        roundTrip()
+        return list(self.tracks[tracktype][index-1])
+
+
+class Project:
+    """
+    Project keeps a render queue, but never really renders anything. Every job
+    is done as soon as rendering starts, leaving a file of RENDER_BYTES per
+    frame behind.
+    """
+    RENDER_BYTES = 1000
+
+    def __init__(self, timelines, current=None):
+        self.timelines = timelines
+        self.current = current or timelines[-1]
+        self.settings = {}
+        self.jobs = {}
+        self.status = {}
+
+    def GetName(self):
+        return "fake project"
+
+    def GetTimelineCount(self):
+        return len(self.timelines)
+
+    def GetTimelineByIndex(self, index):
+        return self.timelines[index-1]
+
+    def GetCurrentTimeline(self):
+        return self.current
+
+    def SetCurrentTimeline(self, timeline):
+        if timeline not in self.timelines:
+            return False
+        self.current = timeline
+        return True
+
+    def LoadRenderPreset(self, preset):
+        return True
+
+    def SetRenderSettings(self, settings):
+        self.settings.update(settings)
+        return True
+
+    def GetCurrentRenderFormatAndCodec(self):
+        return {"format": "mp4", "codec": "H264"}
+
+    def AddRenderJob(self):
+        job = f"job-{next(uniqueids)}"
+        self.jobs[job] = dict(self.settings)
+        self.status[job] = {"JobStatus": "Ready", "CompletionPercentage": 0}
+        return job
+
+    def StartRendering(self, jobs, isInteractiveMode=False):
+        for j in jobs:
+            settings = self.jobs[j]
+            if "TargetDir" in settings:
+                frames = settings["MarkOut"] - settings["MarkIn"] + 1
+                path = os.path.join(settings["TargetDir"], settings["CustomName"] + ".mp4")
+                with open(path, "wb") as f:
+                    f.write(b"\0" * frames * self.RENDER_BYTES)
+            self.status[j] = {"JobStatus": "Complete", "CompletionPercentage": 100}
+        return True
+
+    def IsRenderingInProgress(self):
+        return False
+
+    def GetRenderJobStatus(self, job):
+        return self.status[job]
+
+
+class ProjectManager:
+    def __init__(self, project):
+        self.project = project
+
+    def GetCurrentProject(self):
+        return self.project
+
+
+class Resolve:
+    def __init__(self, project):
+        self.projectmanager = ProjectManager(project)
+
+    def GetProjectManager(self):
+        return self.projectmanager
+
+
+def syntheticTimeline(ntracks, nitems, seed=0, audiotracks=0, name="original", startframe=86400):
+    """
+    syntheticTimeline returns a timeline with ntracks video tracks of nitems
+    items each. The first track is cut back to back, like a main edit. The
+    tracks above have gaps between their items, like titles and overlays.
+    """
+    rng = random.Random(seed)
+    media = [MediaPoolItem(f"media-{seed}-{m}") for m in range(max(nitems//4, 1))]
+
+    def track(dense):
+        items = []
+        pos = startframe
+        for _ in range(nitems):
+            if not dense:
+                pos += rng.randint(10, 200)
+            duration = rng.randint(12, 250)
+            props = dict(DEFAULT_PROPERTIES)
+            if rng.random() < 0.2:
+                props["ZoomX"] = props["ZoomY"] = rng.choice([1.1, 1.2, 1.5])
+            items.append(TimelineItem(rng.choice(media), pos, pos+duration,
+                                      rng.randint(0, 5000), props))
+            pos += duration
+        return items
+
+    video = [track(True)] + [track(False) for _ in range(ntracks-1)]
+    audio = [track(t == 0) for t in range(audiotracks)]
+
+    # every track should end at the same place, so that timelines can be
+    # edited without the end moving around for reasons other than the edit
+    end = video[0][-1].end
+    for items in video[1:] + audio:
+        while items and items[-1].start >= end:
+            items.pop()
+        if items:
+            items[-1].end = min(items[-1].end, end)
+    return Timeline(name, startframe, video, audio)
+
+
+def editTimeline(timeline, pattern="mixed", nedits=10, seed=0, name="target"):
+    """
+    editTimeline returns a copy of timeline with nedits edits of the given
+    pattern made to the first video track. Edits ripple, so everything after
+    them on every track moves along. Overlay edits add, remove or move an
+    item on the top video track instead, without rippling anything, like
+    titles do. Like a duplicated timeline in resolve, every item in the copy
+    gets a new unique id.
+    """
+    if pattern not in EDIT_PATTERNS:
+        raise Exception(f"unknown edit pattern {pattern}")
+    rng = random.Random(seed)
+
+    def copy(it):
+        return TimelineItem(it.media, it.start, it.end, it.source, dict(it.props))
+
+    tracks = {t: [[copy(it) for it in items] for items in tracks]
+              for t, tracks in timeline.tracks.items()}
+    main = tracks["video"][0]
+    if pattern in ("overlay", "mixed") and len(tracks["video"]) < 2:
+        tracks["video"].append([])
+    top = tracks["video"][-1]
+
+    def place(it):
+        # put it in a gap on the top track that it fits in, if there is one
+        duration = it.end - it.start
+        gaps = []
+        pos = timeline.startframe
+        for start, end in [(other.start, other.end) for other in top] + [(main[-1].end, main[-1].end)]:
+            if start - pos >= duration:
+                gaps.append((pos, start))
+            pos = max(pos, end)
+        if not gaps:
+            return
+        lo, hi = rng.choice(gaps)
+        it.start = rng.randint(lo, hi - duration)
+        it.end = it.start + duration
+        top.append(it)
+        top.sort(key=lambda it: it.start)
+
+    def ripple(frame, delta):
+        for t in tracks.values():
+            for items in t:
+                for it in items:
+                    if it.start >= frame:
+                        it.start += delta
+                        it.end += delta
+
+    for _ in range(nedits):
+        if not main:
+            break
+        kind = pattern
+        if kind == "mixed":
+            kind = rng.choice(EDIT_PATTERNS[:-1])
+        i = rng.randrange(len(main))
+        it = main[i]
+        if kind == "insert":
+            duration = rng.randint(12, 100)
+            ripple(it.start, duration)
+            new = TimelineItem(MediaPoolItem(f"insert-{seed}-{rng.randrange(1 << 30)}"),
+                               it.start-duration, it.start, rng.randint(0, 5000), dict(DEFAULT_PROPERTIES))
+            main.insert(i, new)
+        elif kind == "delete" and len(main) > 1:
+            del main[i]
+            ripple(it.end, -(it.end-it.start))
+        elif kind == "trim" and it.end - it.start > 2:
+            trim = rng.randint(1, (it.end-it.start)//2)
+            it.end -= trim
+            ripple(it.end+trim, -trim)
+        elif kind == "headtrim" and it.end - it.start > 2:
+            trim = rng.randint(1, (it.end-it.start)//2)
+            it.source += trim
+            it.end -= trim
+            ripple(it.end+trim, -trim)
+        elif kind == "slip":
+            it.source += rng.randint(1, 50)
+        elif kind == "property":
+            it.props["Opacity"] = rng.choice([50.0, 75.0, 90.0])
+        elif kind == "overlay":
+            action = rng.choice(["add", "remove", "move"]) if top else "add"
+            if action == "add":
+                place(TimelineItem(MediaPoolItem(f"title-{seed}-{rng.randrange(1 << 30)}"),
+                                   0, rng.randint(12, 150), 0, dict(DEFAULT_PROPERTIES)))
+            else:
+                moved = top.pop(rng.randrange(len(top)))
+                if action == "move":
+                    place(moved)
+
+    return Timeline(name, timeline.startframe, tracks["video"], tracks["audio"], timeline.framerate)
+
+
+def frameHashes(timeline, cache=None, inert=steenbeck.INERT_PROPERTIES):
+    """
+    frameHashes returns the hash of every run of frames of the video of
+    timeline, the way steenbeck snapshots and hashes it
+    """
+    snap, = steenbeck.snapshotTimelines([timeline], cache, threads=1, inert=inert)
+    return list(steenbeck.calculateFrameSeq(snap, cache).sigs)
+
+
+def fakeResolve(original, target):
+    """
+    fakeResolve returns a Resolve with a project holding both timelines,
+    with target as the current one
+    """
+    return Resolve(Project([original, target], current=target))
+
+
+# the synthetic renders are 25fps with a 1/12800 timebase
+TIMEBASE = fractions.Fraction(1, 12800)
+FRAMERATE = fractions.Fraction(25)
+PTS_PER_FRAME = 512
+
+
+def syntheticKeyframes(nframes, gop, seed=0):
+    """
+    syntheticKeyframes returns the frames a render of nframes frames has
+    keyframes on. GOP lengths vary a bit around gop, like they do with
+    scene detection.
+    """
+    rng = random.Random(seed)
+    keyframes = []
+    f = 0
+    while f < nframes:
+        keyframes.append(f)
+        f += rng.randint(gop//2, gop + gop//2)
+    return keyframes
+
+
+def syntheticPackets(nframes, gop, seed=0):
+    """
+    syntheticPackets returns a packet stream like the one ffprobe gives us
+    for a synthetic render with one B-frame of delay, with keyframes where
+    syntheticKeyframes puts them.
+    """
+    keyframes = set(syntheticKeyframes(nframes, gop, seed))
+    packets = []
+    for f in range(nframes):
+        packets.append({
+            "pts": f*PTS_PER_FRAME,
+            "dts": (f-2)*PTS_PER_FRAME,
+            "duration": PTS_PER_FRAME,
+            "flags": "K__" if f in keyframes else "___",
+        })
+    return packets
+
+
+def syntheticIndex(nframes, keyframes):
+    """
+    syntheticIndex returns the keyframe index steenbeck would build from
+    the packets of a synthetic render with keyframes on the given frames
+    """
+    index = steenbeck.KeyframeIndex(TIMEBASE, FRAMERATE, nframes*PTS_PER_FRAME)
+    for f in keyframes:
+        index.add(steenbeck.packet(f*PTS_PER_FRAME, (f-2)*PTS_PER_FRAME, PTS_PER_FRAME,
+                                   steenbeck.packetFlags("K__")))
+    return index
+
+
+class FakeProbe:
+    """
+    FakeProbe stands in for ffprobe. Every file it's asked about is a
+    synthetic render of nframes frames, with one video and one audio stream.
+    install swaps it in for the ffprobe calls in steenbeck.
+    """
+
+    def __init__(self, nframes, gop, seed=0):
+        self.nframes = nframes
+        self.gop = gop
+        self.seed = seed
+
+    def streams(self, path):
+        return [self.video(path), {
+            "index": 1,
+            "codec_type": "audio",
+            "codec_name": "aac",
+            "sample_rate": "48000",
+            "channels": 2,
+            "bit_rate": "320000",
+        }]
+
+    def video(self, path):
+        return {
+            "index": 0,
+            "codec_type": "video",
+            "codec_name": "h264",
+            "time_base": str(TIMEBASE),
+            "avg_frame_rate": f"{FRAMERATE}/1",
+            "r_frame_rate": f"{FRAMERATE}/1",
+            "duration_ts": self.nframes*PTS_PER_FRAME,
+        }
+
+    def packets(self, path, intervals=None):
+        for p in syntheticPackets(self.nframes, self.gop, self.seed):
+            yield steenbeck.packet(p["pts"], p["dts"], p["duration"], steenbeck.packetFlags(p["flags"]))
+
+    def install(self):
+        steenbeck.probeStreams = self.streams
+        steenbeck.readPackets = self.packets
@@ -18,28 +18,461 @@ import os
 import fractions
 import math
 import tempfile
+import shutil
+import struct
+import bisect
+import sys
+import threading
+import cProfile
+import contextlib
+import copy
+import itertools
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from python_get_resolve import GetResolve
 
+try:
+    import resource
+except ImportError:
+    # windows, see peakRSS
+    resource = None
+
+try:
+    import numpy
+except ImportError:
+    # planning segments works without it, just slower on long
+    # timelines, see planSegmentsNumpy
+    numpy = None
+
 
 def steenbeck():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-t')
+    parser.add_argument('-t',
+                        help="the timeline the reference is a render of, not needed if the reference has a manifest")
     parser.add_argument('-f')
     parser.add_argument('-o')
+    parser.add_argument('-batch', nargs=2, action='append', metavar=('TIMELINE', 'OUTPUT'),
+                        help="render this timeline into this output instead of the current timeline into -o, can be given more than once")
     parser.add_argument('-renderpreset')
     parser.add_argument('-debuglogs', action='store_true')
     parser.add_argument('-debuguniquename', action='store_true')
     parser.add_argument("-debugleavetemps", action='store_true')
+    parser.add_argument('-cachedir', default=defaultCacheDir())
+    parser.add_argument('-nocache', action='store_true')
+    parser.add_argument('-mergegap', type=int, default=25,
+                        help="render up to this many frames between two renders to make them one, for -planner greedy and audio")
+    parser.add_argument('-planner', choices=["cost", "greedy"], default="cost",
+                        help="pick what to render by the estimated cost of rendering it, or by -mergegap")
+    parser.add_argument('-gluecachesize', type=int, default=20_000,
+                        help="size limit of the glue cache in megabytes")
+    parser.add_argument('-diffaudio', action='store_true',
+                        help="render only the audio that changed and take the rest from the reference. "
+                        "Only changes to the items on the audio tracks are seen, not clip gain, faders, pan, "
+                        "mute and solo or fairlight effects")
+    parser.add_argument('-fullaudio', action='store_true',
+                        help="render all of the audio, this is the default without -diffaudio")
+    parser.add_argument('-inertprop', action='append', metavar='PROPERTY',
+                        help=f"don't render again when only this item property changed, can be given more than once. "
+                        f"{CLIP_NAME} stands for the name of titles and generators. Properties like Scaling "
+                        f"only matter for some media, check they don't for yours before giving them")
+    parser.add_argument('-renderprop', action='append', metavar='PROPERTY',
+                        help=f"render again when this item property changed, even though it is one of "
+                        f"{', '.join(INERT_PROPERTIES)} that aren't by default")
+    parser.add_argument('-explain', action='store_true',
+                        help="say which item properties and edits made each render necessary, "
+                        "this asks resolve about every item instead of only the changed ones")
+    parser.add_argument('-smartrender', action='store_true',
+                        help="re-encode the partial GOPs around every cut with ffmpeg instead of having resolve render them")
+    parser.add_argument('-pipeline', action='store_true',
+                        help="render in timeline order and stitch the start of the output while resolve renders the rest")
+    parser.add_argument('-snapshotthreads', type=int, default=SNAPSHOT_THREADS,
+                        help="how many tracks to fetch from resolve at the same time. Resolve isn't "
+                        "known to be fine with being called from several threads, so this is 1 by default")
+    parser.add_argument('-watch', action='store_true',
+                        help="keep running, rendering the current timeline again whenever it changes")
+    parser.add_argument('-watchpoll', type=float, default=WATCH_POLL,
+                        help="seconds between looking at the timeline for changes in watch mode")
+    parser.add_argument('-watchsettle', type=float, default=WATCH_SETTLE,
+                        help="seconds the timeline has to stay the same before rendering in watch mode")
+    parser.add_argument('-dryrun', action='store_true',
+                        help="print what would be rendered and how long it would take as JSON, without rendering")
+    parser.add_argument('-report',
+                        help="where to write the run report, defaults to the reports directory in the cache directory")
+    parser.add_argument('-profile',
+                        help="write a cProfile dump of the python side of the run to this file")
     args = parser.parse_args()
+    if args.watch and args.dryrun:
+        parser.error("-dryrun doesn't go with -watch")
+    if args.watch and args.batch:
+        parser.error("-batch doesn't go with -watch")
+    if args.diffaudio and args.fullaudio:
+        parser.error("-diffaudio doesn't go with -fullaudio")
+
+    if args.watch:
+        steenbeck_watch(args)
+        return
 
     now = datetime.datetime.now()
     prefix = f"steenbeck-{now.strftime("%y%m%d-%H%M%S")}-"
     delete = not (args.debugleavetemps or args.debuguniquename)
-    with tempfile.TemporaryDirectory(prefix=prefix, delete=delete) as td:
-        steenbeck_inner(td, args)
+    report = Report(profile=args.profile is not None)
+    reportfile = args.report
+    if reportfile is None:
+        reportfile = defaultReportPath(args.cachedir, now)
+    try:
+        with tempfile.TemporaryDirectory(prefix=prefix, delete=delete) as td:
+            steenbeck_inner(td, args, report)
+    except BaseException as e:
+        report.error = repr(e)
+        raise
+    finally:
+        report.write(reportfile)
+        if args.profile is not None:
+            report.profiler.dump_stats(args.profile)
+
+
+def steenbeck_inner(tempdir: str, args, report=None):
+    if report is None:
+        report = Report()
+
+    # a reference we rendered ourselves has a manifest next to it saying
+    # what timeline it is a render of, so the original timeline is optional
+    manifest = None
+    if args.t is None:
+        manifest = loadManifest(args.f)
+        if manifest is None:
+            raise Exception(f"{args.f} has no manifest, use -t to say what timeline it is a render of")
+
+    with report.phase("resolve"):
+        resolve = countCalls(GetResolve(), report)
+        project = GetProject(resolve)
+        if manifest is None:
+            originalTimeline, targetTimeline = GetTimelines(project, args.t)
+        else:
+            targetTimeline = project.GetCurrentTimeline()
+        # in batch mode, the timelines to render are named, and
+        # the current one doesn't matter
+        targetTimelines = [targetTimeline]
+        if args.batch:
+            targetTimelines = [FindTimeline(project, name) for name, _ in args.batch]
+    report.info["reference"] = args.f
+    report.info["timeline"] = targetTimelines[0].GetName()
+    report.info["manifest"] = manifest is not None
+    if manifest is None:
+        for tl in targetTimelines:
+            checkTimelines(originalTimeline, tl)
+
+    # find out where the keyframes are. The index is built by reading through
+    # the whole reference render once and kept next to it for later runs
+    with report.phase("ffprobe", python=True):
+        reference = loadReference(args.f)
+
+    if manifest is None:
+        originalLayout = audioLayout(originalTimeline)
+    else:
+        originalLayout = manifest.layout
+    diffaudio = [canDiffAudio(args, reference, originalLayout, audioLayout(tl))
+                 for tl in targetTimelines]
+    tracktypes = ('video', 'audio') if any(diffaudio) else ('video',)
+
+    # copy what we need out of all the timelines in one go, after this
+    # we don't need to ask resolve about items anymore
+    sigcache = None
+    if not args.nocache:
+        sigcache = SignatureCache(os.path.join(args.cachedir, "timelines"))
+    snapcache, inert = snapshotOptions(args, sigcache)
+    with report.phase("snapshot"):
+        if manifest is None:
+            originalSnap, *targetSnaps = snapshotTimelines(
+                [originalTimeline, *targetTimelines], snapcache, tracktypes, args.snapshotthreads, inert)
+        else:
+            originalSnap = manifest.snapshot
+            targetSnaps = snapshotTimelines(
+                targetTimelines, snapcache, tracktypes, args.snapshotthreads, inert)
+            for snap in targetSnaps:
+                checkSnapshots(originalSnap, snap)
+
+    if args.dryrun:
+        report.info["dryrun"] = True
+        plans = [dryRun(args, report, project, tl, reference, originalSnap, snap, sigcache, d)
+                 for tl, snap, d in zip(targetTimelines, targetSnaps, diffaudio)]
+        print(json.dumps(plans if args.batch else plans[0], indent=1))
+        return
+
+    _, ext = os.path.splitext(args.f)
+    outputfiles = [args.o]
+    if args.batch:
+        outputfiles = [output for _, output in args.batch]
+    if args.debuguniquename:
+        outputfiles = [os.path.join(tempdir, f"output{n}{ext}") for n in range(len(outputfiles))]
+    else:
+        outputfiles = [os.path.abspath(output) for output in outputfiles]
+
+    targets = [renderTarget(tl, snap, d, output) for tl, snap, d, output
+               in zip(targetTimelines, targetSnaps, diffaudio, outputfiles)]
+    renderTimelines(tempdir, args, report, project, reference, originalSnap, targets, sigcache)
+
+
+# seconds between looking for changes in watch mode, and how long
+# the timeline has to stay the same before we render it
+WATCH_POLL = 2.0
+WATCH_SETTLE = 5.0
+
+
+def steenbeck_watch(args):
+    """
+    steenbeck_watch keeps running, rendering the current timeline into the
+    output again whenever it changes and the changes have settled.
+
+    The first render diffs against the original timeline, or the manifest
+    of the reference, like a normal run. After that, the previous output is
+    the reference and the timeline as it was when we rendered it is the
+    original, so every render only does the work for the edits made since
+    the last one. The connection to resolve, the snapshot of what we last
+    rendered and the keyframe index of the reference are kept between renders.
+    """
+    resolve = GetResolve()
+    sigcache = None
+    if not args.nocache:
+        sigcache = SignatureCache(os.path.join(args.cachedir, "timelines"))
+    tracktypes = ('video', 'audio') if args.diffaudio else ('video',)
+    snapcache, inert = snapshotOptions(args, sigcache)
+
+    # the output is rendered next to where it goes and moved into place,
+    # since the output of the last render is what we're reading from
+    outputfile = os.path.abspath(args.o)
+    root, ext = os.path.splitext(outputfile)
+    nextfile = f"{root}.next{ext}"
+
+    manifest = None
+    if args.t is None:
+        manifest = loadManifest(args.f)
+        if manifest is None:
+            raise Exception(f"{args.f} has no manifest, use -t to say what timeline it is a render of")
+
+    report = Report()
+    with report.phase("resolve"):
+        project = GetProject(countCalls(resolve, report))
+        if manifest is None:
+            originalTimeline, timeline = GetTimelines(project, args.t)
+            checkTimelines(originalTimeline, timeline)
+        else:
+            timeline = project.GetCurrentTimeline()
+    timelineid = timeline.GetUniqueId()
+    with report.phase("ffprobe", python=True):
+        reference = loadReference(args.f)
+    if manifest is None:
+        with report.phase("snapshot"):
+            originalSnap, = snapshotTimelines(
+                [originalTimeline], snapcache, tracktypes, args.snapshotthreads, inert)
+        layout = audioLayout(originalTimeline)
+    else:
+        originalSnap = manifest.snapshot
+        layout = manifest.layout
+
+    renderedstate = None
+    pending = None
+    pendingsince = None
+    while True:
+        if renderedstate is not None:
+            time.sleep(args.watchpoll)
+            report = Report()
+            with report.phase("resolve"):
+                project = GetProject(countCalls(resolve, report))
+                timeline = FindTimelineById(project, timelineid)
+
+        with report.phase("snapshot"):
+            snap, = snapshotTimelines([timeline], snapcache, tracktypes, args.snapshotthreads, inert)
+        state = snap.state()
+        if state == renderedstate:
+            pending = None
+            continue
+        now = time.monotonic()
+        if state != pending:
+            pending = state
+            pendingsince = now
+        if renderedstate is not None and now - pendingsince < args.watchsettle:
+            continue
+
+        report.info["reference"] = reference.path
+        report.info["timeline"] = timeline.GetName()
+        diffaudio = canDiffAudio(args, reference, layout, audioLayout(timeline))
+        prefix = f"steenbeck-{datetime.datetime.now().strftime("%y%m%d-%H%M%S")}-"
+        try:
+            if snap.startframe != originalSnap.startframe or snap.framerate != originalSnap.framerate:
+                raise Exception("start frame or framerate changed since the last render")
+            with tempfile.TemporaryDirectory(prefix=prefix, delete=not args.debugleavetemps) as td:
+                renderTimeline(td, args, report, project, timeline, reference,
+                               originalSnap, snap, sigcache, diffaudio, nextfile)
+            moveRender(nextfile, outputfile)
+            with report.phase("ffprobe", python=True):
+                reference = loadReference(outputfile)
+            originalSnap = snap
+            layout = audioLayout(timeline)
+            print(f"rendered {outputfile}")
+        except Exception as e:
+            # keep going with the last good output, and wait for the
+            # timeline to change before trying again
+            report.error = repr(e)
+            print(f"render failed: {e}")
+        finally:
+            renderedstate = state
+            report.write(args.report or defaultReportPath(args.cachedir, datetime.datetime.now()))
+
+
+def snapshotOptions(args, sigcache):
+    """
+    snapshotOptions returns the signature cache to snapshot with and the
+    inert properties. Explaining renders needs to know what every item
+    shows, and for titles and generators, that is their name, which the
+    cache would save us from asking about.
+    """
+    inert = inertProperties(args.inertprop, args.renderprop)
+    if args.explain:
+        return None, inert
+    return sigcache, inert
+
+
+def defaultReportPath(cachedir, now):
+    return os.path.join(cachedir, "reports", f"{now.strftime("%y%m%d-%H%M%S")}-{os.getpid()}.json")
+
+
+def checkTimelines(originalTimeline, targetTimeline):
+    if originalTimeline.GetStartFrame() != targetTimeline.GetStartFrame():
+        raise Exception("differing start frames")
+
+    if originalTimeline.GetSetting("timelineFrameRate") != targetTimeline.GetSetting("timelineFrameRate"):
+        raise Exception("differing framerates")
+
+
+def checkSnapshots(originalSnap, targetSnap):
+    if originalSnap.startframe != targetSnap.startframe:
+        raise Exception("differing start frames")
+
+    if originalSnap.framerate != targetSnap.framerate:
+        raise Exception("differing framerates")
+
+    # not an error, but items that changed one of the properties that only
+    # one side treats as inert don't match anymore and get rendered again
+    if None not in (originalSnap.inert, targetSnap.inert) and originalSnap.inert != targetSnap.inert:
+        print(f"the reference was hashed with inert properties {sorted(originalSnap.inert)}, "
+              f"this run uses {sorted(targetSnap.inert)}")
+
+
+class referenceFile:
+    """
+    referenceFile is a render that we take unchanged frames from, along
+    with where its keyframes are and what streams it has
+    """
+
+    def __init__(self, path, kfindex, streams):
+        self.path = path
+        self.kfindex = kfindex
+        self.streams = streams
 
 
-def steenbeck_inner(tempdir: str, args):
+def loadReference(path):
+    path = os.path.abspath(path)
+    streams = probeStreams(path)
+    return referenceFile(path, loadKeyframeIndex(path, streams), streams)
+
+
+def canDiffAudio(args, reference, originalLayout, targetLayout):
+    """
+    canDiffAudio works out if we can diff the audio. The parts that didn't
+    change are taken from the audio of the reference. If the audio tracks are
+    laid out differently, the mix probably is too, so render all of it.
+
+    Diffing only sees the items on the audio tracks. Clip gain, faders, pan,
+    mute and solo and fairlight effects can change the mix without changing
+    any of them, so it has to be asked for with -diffaudio.
+    """
+    refaudio = [st for st in reference.streams if st["codec_type"] == "audio"]
+    return args.diffaudio and len(refaudio) > 0 and originalLayout == targetLayout
+
+
+class renderPlan:
+    """
+    renderPlan is what a run is going to do: the segments covering the
+    target timeline, saying where every frame comes from, and the audio
+    spans, or None if all of the audio gets rendered
+    """
+
+    def __init__(self, originalFrames, targetFrames, segments, audiospans, smartrender):
+        self.originalFrames = originalFrames
+        self.targetFrames = targetFrames
+        self.segments = segments
+        self.audiospans = audiospans
+        self.smartrender = smartrender
+        # segment index to why that target segment gets rendered, for
+        # -explain, see renderCauses
+        self.causes = None
+
+    def frames(self, kind):
+        return sum(s.duration for s in self.segments if isinstance(s, kind))
+
+    def audiojobs(self):
+        """
+        audiojobs returns the (start, duration) of every audio render,
+        in target frames
+        """
+        if self.audiospans is None:
+            return [(0, self.targetFrames.duration)]
+        return [(tstart, duration) for ostart, tstart, duration in self.audiospans if ostart is None]
+
+    def audioUnchanged(self):
+        """
+        audioUnchanged says if the audio is diffed and nothing changed in it
+        """
+        duration = self.targetFrames.duration
+        return self.audiospans == [(0, 0, duration)] and duration == self.originalFrames.duration
+
+    def encode(self):
+        def kind(s):
+            return type(s).__name__
+
+        def causes(i):
+            if self.causes is None:
+                return None
+            return self.causes.get(i)
+        return {
+            "frames": self.targetFrames.duration,
+            "referenceframes": self.originalFrames.duration,
+            "smartrender": self.smartrender,
+            "copiedframes": self.frames(original),
+            "renderframes": self.frames(target),
+            "reencodeframes": self.frames(reencode),
+            "segments": [{
+                "kind": kind(s),
+                "start": s.originalframe + s.positiondelta,
+                "duration": s.duration,
+                "referenceframe": s.originalframe if not isinstance(s, target) else None,
+                "causes": causes(i),
+            } for i, s in enumerate(self.segments)],
+            "audiospans": None if self.audiospans is None else [{
+                "start": tstart,
+                "duration": duration,
+                "referenceframe": ostart,
+            } for ostart, tstart, duration in self.audiospans],
+        }
+
+
+def planRender(args, report, reference, originalSnap, targetSnap, sigcache, diffaudio):
+    """
+    planRender works out what it takes to turn the reference, a render of
+    originalSnap, into a render of targetSnap. Nothing gets rendered and
+    resolve isn't asked about anything.
+    """
+    return planRenders(args, report, reference, originalSnap, [targetSnap], sigcache, [diffaudio])[0]
+
+
+def planRenders(args, report, reference, originalSnap, targetSnaps, sigcache, diffaudio):
+    """
+    planRenders returns a renderPlan for every one of targetSnaps, see
+    planRender. diffaudio says for every target if its audio gets diffed.
+    All the timelines are hashed together, so the original is only
+    hashed once.
+    """
 
     def dumpsegments(msg, segs):
         if not args.debuglogs:
@@ -50,25 +483,1138 @@ def steenbeck_inner(tempdir: str, args):
             print(s)
         print()
 
-    resolve = GetResolve()
-    project = GetProject(resolve)
-    originalTimeline, targetTimeline = GetTimelines(project, args.t)
+    # hash the timelines into runs of frames, where every frame in a run
+    # shows the same items on every track. Diffing happens on these runs,
+    # so the cost scales with the number of cuts, not the length of the timeline
+    sigtable = SignatureTable()
+    with report.phase("hashing", python=True):
+        originalFrames, *targetFrames = calculateFrameSeqs(
+            [originalSnap, *targetSnaps], sigcache, 'video', sigtable)
+
+    # smart rendering needs an encoder that can make frames that
+    # fit in with the ones in the reference
+    videostreams = videoStreams(reference.streams)
+    video = videostreams[0]
+    smartrender = args.smartrender
+    if smartrender and video["codec_name"] not in REENCODERS:
+        print(f"can't re-encode {video['codec_name']}, rendering cuts with resolve")
+        smartrender = False
+    if smartrender and len(videostreams) > 1:
+        print("can't re-encode more than one video stream, rendering cuts with resolve")
+        smartrender = False
+
+    # the cost planner goes by what earlier runs took, see costModel
+    model = None
+    if args.planner == "cost":
+        model = costModel.calibrate(os.path.join(args.cachedir, "reports"))
+    segments = []
+    for frames in targetFrames:
+        segments.append(buildSegments(originalFrames, frames, reference.kfindex, args.mergegap,
+                                      dumpsegments, report, smartrender, model=model))
+        if model is not None and not args.dryrun:
+            print(f"cut plan: {report.info['gluesegments']} render jobs, "
+                  f"{report.info['glueframes']} frames, about {report.info['plancost']:.0f}s "
+                  f"(by -mergegap: about {report.info['greedyplancost']:.0f}s)")
+
+    audiospans = [None] * len(targetSnaps)
+    audiotargets = [n for n, d in enumerate(diffaudio) if d]
+    if audiotargets:
+        with report.phase("audio diff", python=True):
+            originalAudio, *targetAudio = calculateFrameSeqs(
+                [originalSnap, *(targetSnaps[n] for n in audiotargets)], sigcache, 'audio', sigtable)
+            for n, audio in zip(audiotargets, targetAudio):
+                audiospans[n] = audioSpans(originalAudio, audio, args.mergegap)
+        if args.debuglogs:
+            for n in audiotargets:
+                print("audio spans")
+                for a in audiospans[n]:
+                    print(a)
+                print()
+    plans = [renderPlan(originalFrames, frames, segs, spans, smartrender)
+             for frames, segs, spans in zip(targetFrames, segments, audiospans)]
+
+    if args.explain:
+        totals = {}
+        for plan, snap in zip(plans, targetSnaps):
+            plan.causes = renderCauses(originalSnap, snap, plan.segments)
+            frames = {}
+            for causes in plan.causes.values():
+                for cause, n in causes.items():
+                    frames[cause] = frames.get(cause, 0) + n
+                    totals[cause] = totals.get(cause, 0) + n
+            if not args.dryrun:
+                print("rendering because of: " + (", ".join(
+                    f"{cause} {n} frames" for cause, n in sorted(
+                        frames.items(), key=lambda c: (-c[1], c[0]))) or "nothing"))
+        report.info["rendercauses"] = dict(sorted(totals.items(), key=lambda c: (-c[1], c[0])))
+    return plans
+
+
+# what renderCauses blames frames on, other than item properties
+CAUSE_MEDIA = "media"
+CAUSE_SOURCE = "source"
+CAUSE_SPEED = "speed"
+CAUSE_UNKNOWN = "unknown"
+CAUSE_UNCHANGED = "unchanged"
+
+
+def renderCauses(originalSnap, targetSnap, segments, tracktype='video'):
+    """
+    renderCauses works out why the target segments in segments have to be
+    rendered. Both snapshots need to have been hashed. It returns, by segment
+    index, how many frames of the segment every cause covers, biggest first.
+
+    Every item showing in a segment is matched up with the item in the
+    original that shows the same media at the same source frames, and
+    blamed for the properties that differ between the two. Items with
+    nothing to match up with are blamed on their media, or on the source
+    if the media is there but other frames of it are. Frames that none of
+    this covers are unchanged: they are only rendered because they are
+    between two keyframes, close to other renders, or because an item
+    went away on a track above them. Items that only one side knows the
+    media of, like the ones in a manifest, are unknown.
+    """
+    omemo = originalSnap.memo[tracktype]
+    tmemo = targetSnap.memo[tracktype]
+
+    # media to what the original shows of it, as
+    # (source start, source end, rate, props)
+    shown = {}
+    for items in originalSnap.tracks[tracktype]:
+        for rec in items:
+            if rec.name is None:
+                continue
+            _, srcstart, rate = omemo[rec.key]
+            shown.setdefault((rec.name, rec.fps), []).append(
+                (srcstart, srcstart + (rec.end - rec.start)*rate, rate, rec.props))
+
+    def itemCauses(rec, start, end):
+        """
+        itemCauses returns (cause, start, end) for the frames of rec between
+        start and end on the timeline
+        """
+        if rec.name is None or not shown:
+            return [(CAUSE_UNKNOWN, start, end)]
+        _, srcstart, rate = tmemo[rec.key]
+        srcstart += (start - rec.start)*rate
+        srcend = srcstart + (end - start)*rate
+
+        def frame(src):
+            return min(max(start + (src - srcstart)/rate, start), end)
+
+        best = None
+        covered = []
+        for ostart, oend, orate, oprops in shown.get((rec.name, rec.fps), []):
+            if ostart >= srcend or srcstart >= oend:
+                continue
+            covered.append((frame(ostart), frame(oend)))
+            diff = [k for k in sorted(set(rec.props) | set(oprops))
+                    if rec.props.get(k) != oprops.get(k)]
+            if orate != rate:
+                diff.append(CAUSE_SPEED)
+            if best is None or len(diff) < len(best):
+                best = diff
+        if best is None:
+            cause = CAUSE_SOURCE if (rec.name, rec.fps) in shown else CAUSE_MEDIA
+            return [(cause, start, end)]
+        res = [(cause, start, end) for cause in best]
+        # frames of the media the original doesn't show anywhere
+        last = start
+        for a, b in sorted(covered) + [(end, end)]:
+            if a > last:
+                res.append((CAUSE_SOURCE, last, a))
+            last = max(last, b)
+        return res
+
+    # items on every track sorted by where they end, to find the ones
+    # showing in a segment without going through all of them
+    tracks = []
+    for items in targetSnap.tracks[tracktype]:
+        items = sorted(items, key=lambda rec: rec.end)
+        tracks.append(([rec.end for rec in items], items))
+
+    res = {}
+    for i, s in enumerate(segments):
+        if not isinstance(s, target):
+            continue
+        start = s.originalframe + s.positiondelta
+        end = start + s.duration
+        spans = {}
+        for ends, items in tracks:
+            for rec in items[bisect.bisect_right(ends, start):]:
+                if rec.start >= end:
+                    # items on a track don't overlap, so the ones ending
+                    # later start later too
+                    break
+                for cause, a, b in itemCauses(rec, max(rec.start, start), min(rec.end, end)):
+                    spans.setdefault(cause, []).append((a, b))
+
+        causes = {cause: round(coveredFrames(sp)) for cause, sp in spans.items()}
+        unchanged = s.duration - round(coveredFrames(list(itertools.chain.from_iterable(spans.values()))))
+        if unchanged > 0:
+            causes[CAUSE_UNCHANGED] = unchanged
+        res[i] = dict(sorted(causes.items(), key=lambda c: (-c[1], c[0])))
+    return res
+
+
+def coveredFrames(spans):
+    """
+    coveredFrames returns how many frames the (start, end) spans cover
+    between them, counting the ones that overlap once
+    """
+    covered = 0
+    last = None
+    for start, end in sorted(spans):
+        if last is not None:
+            start = max(start, last)
+        if end > start:
+            covered += end - start
+        last = end if last is None else max(last, end)
+    return covered
+
+
+def glueSalt(args, project, timeline, ext):
+    """
+    glueSalt returns what goes into the key of glue, other than the frames
+    it covers. Glue rendered with different settings can't be reused.
+    The render preset has to be loaded already.
+    """
+    return marshal.dumps((
+        args.renderpreset,
+        project.GetCurrentRenderFormatAndCodec(),
+        timeline.GetSetting("timelineFrameRate"),
+        timeline.GetSetting("timelineResolutionWidth"),
+        timeline.GetSetting("timelineResolutionHeight"),
+        ext))
 
-    if originalTimeline.GetStartFrame() != targetTimeline.GetStartFrame():
-        raise Exception("differing start frames")
 
-    if originalTimeline.GetSetting("timelineFrameRate") != targetTimeline.GetSetting("timelineFrameRate"):
-        raise Exception(f"differing framerates")
+def glueKeys(plan, gluesalt):
+    """
+    glueKeys returns the glue key of every target segment, by segment index.
+    Segments showing the same frames share a key, in any timeline, so they
+    only get rendered once.
+    """
+    keys = {}
+    for i, s in enumerate(plan.segments):
+        if isinstance(s, target):
+            keys[i] = GlueCache.key(plan.targetFrames.span(
+                s.originalframe + s.positiondelta, s.duration), gluesalt)
+    return keys
+
+
+# what things cost until there are reports of earlier runs to go by.
+# Rough numbers for a 1080p h264 render
+RENDER_JOB_SECONDS = 5.0
+RENDER_FRAME_SECONDS = 0.02
+AUDIO_FRAME_SECONDS = 0.001
+REENCODE_FRAME_SECONDS = 0.01
+STITCH_FRAME_SECONDS = 0.0005
+# how many of the latest reports go into calibrating the cost model
+REPORT_HISTORY = 50
+
+
+class costModel:
+    """
+    costModel estimates how long the parts of a run take. Resolve renders
+    cost a fixed amount for every job and for every frame, with audio frames
+    a lot cheaper than video ones. Re-encoding and stitching cost a fixed
+    amount for every frame. See calibrate.
+    """
+
+    def __init__(self):
+        self.jobseconds = RENDER_JOB_SECONDS
+        self.frameseconds = RENDER_FRAME_SECONDS
+        self.audioseconds = AUDIO_FRAME_SECONDS
+        self.reencodeseconds = REENCODE_FRAME_SECONDS
+        self.stitchseconds = STITCH_FRAME_SECONDS
+        # how many reports the costs came from
+        self.reports = 0
+
+    @classmethod
+    def calibrate(cls, reportdir, history=REPORT_HISTORY):
+        """
+        calibrate returns a costModel fitted to the latest reports in
+        reportdir. Render costs are a least squares fit of the render phase
+        against the glue job and frame counts. Audio is rendered in a phase
+        of its own, and what it took beyond the job costs goes on the audio
+        frames. The others are total time over total frames. Runs that
+        failed or didn't render are left out, and so are runs from before
+        audio was rendered separately, whose render phase has both in it.
+        """
+        model = cls()
+        try:
+            names = sorted(n for n in os.listdir(reportdir) if n.endswith(".json"))
+        except FileNotFoundError:
+            return model
+
+        renders = []
+        audio = []
+        reencode = [0.0, 0]
+        stitch = [0.0, 0]
+        for name in names[-history:]:
+            try:
+                with open(os.path.join(reportdir, name)) as f:
+                    r = json.load(f)
+            except (OSError, ValueError):
+                continue
+            info = r.get("info", {})
+            phases = r.get("phases", {})
+            if r.get("error") is not None or "audioframes" not in info:
+                continue
+            if "render" not in phases and "render audio" not in phases:
+                continue
+            model.reports += 1
+            if "render" in phases:
+                renders.append((info.get("renderjobs", 0), info.get("renderframes", 0), phases["render"]))
+            if "render audio" in phases:
+                audio.append((info.get("audiojobs", 0), info["audioframes"], phases["render audio"]))
+            if info.get("reencodeframes") and "reencode" in phases:
+                reencode[0] += phases["reencode"]
+                reencode[1] += info["reencodeframes"]
+            if info.get("frames") and "concat and mux" in phases:
+                stitch[0] += phases["concat and mux"]
+                stitch[1] += info["frames"]
+
+        sjj = sum(j*j for j, _, _ in renders)
+        sjf = sum(j*f for j, f, _ in renders)
+        sff = sum(f*f for _, f, _ in renders)
+        sjt = sum(j*t for j, _, t in renders)
+        sft = sum(f*t for _, f, t in renders)
+        det = sjj*sff - sjf*sjf
+        fitted = False
+        if len(renders) >= 2 and det > 1e-9 * sjj * sff:
+            a = (sjt*sff - sft*sjf) / det
+            b = (sjj*sft - sjf*sjt) / det
+            if a >= 0 and b >= 0:
+                model.jobseconds, model.frameseconds = a, b
+                fitted = True
+        frames = sum(f for _, f, _ in renders)
+        if not fitted and frames > 0:
+            # not enough spread in the reports to tell the two apart,
+            # keep the job cost and put the rest on the frames
+            left = sum(t - j*model.jobseconds for j, _, t in renders)
+            model.frameseconds = max(left, 0) / frames
+        frames = sum(f for _, f, _ in audio)
+        if frames > 0:
+            left = sum(t - j*model.jobseconds for j, _, t in audio)
+            model.audioseconds = max(left, 0) / frames
+        if reencode[1] > 0:
+            model.reencodeseconds = reencode[0] / reencode[1]
+        if stitch[1] > 0:
+            model.stitchseconds = stitch[0] / stitch[1]
+        return model
+
+    def estimate(self, jobs, renderframes, reencodeframes, frames, audiojobs=0, audioframes=0):
+        """
+        estimate returns the seconds every part of a run takes. Re-encoding
+        happens while resolve renders, so only the longer of the two counts.
+        render has the audio in it
+        """
+        audio = audiojobs*self.jobseconds + audioframes*self.audioseconds
+        render = jobs*self.jobseconds + renderframes*self.frameseconds + audio
+        reencode = reencodeframes*self.reencodeseconds
+        stitch = frames*self.stitchseconds
+        return {
+            "render": render,
+            "audio": audio,
+            "reencode": reencode,
+            "stitch": stitch,
+            "total": max(render, reencode) + stitch,
+        }
+
+    def planEstimate(self, segments):
+        """
+        planEstimate is estimate for the segments of a plan, with a render
+        job for every target segment
+        """
+        targets = [s for s in segments if isinstance(s, target)]
+        return self.estimate(len(targets), sum(s.duration for s in targets),
+                             sum(s.duration for s in segments if isinstance(s, reencode)),
+                             sum(s.duration for s in segments))
+
+
+def dryRun(args, report, project, timeline, reference,
+           originalSnap, targetSnap, sigcache, diffaudio):
+    """
+    dryRun returns what rendering targetSnap would take, along with how long
+    that and a full render of the timeline would take. The render preset is
+    loaded to find out what glue we already have, but no jobs are queued.
+    """
+    plan = planRender(args, report, reference, originalSnap, targetSnap, sigcache, diffaudio)
+
+    res = project.LoadRenderPreset(args.renderpreset)
+    if res == False:
+        raise Exception(f"couldn't find render preset {args.renderpreset}")
+    _, ext = os.path.splitext(reference.path)
+    gluecache = None
+    if not args.nocache:
+        gluecache = GlueCache(os.path.join(
+            args.cachedir, "glue"), args.gluecachesize * 1024 * 1024)
+    gluekeys = glueKeys(plan, glueSalt(args, project, timeline, ext))
+
+    # the same as the render queue renderTimeline would make
+    jobs = 0
+    renderframes = 0
+    cachedframes = 0
+    seen = set()
+    for i, key in gluekeys.items():
+        if key in seen:
+            continue
+        seen.add(key)
+        duration = plan.segments[i].duration
+        if gluecache is not None and gluecache.contains(key, ext):
+            cachedframes += duration
+            continue
+        jobs += 1
+        renderframes += duration
+    audiojobs = plan.audiojobs()
+    audioframes = sum(duration for _, duration in audiojobs)
+
+    model = costModel.calibrate(os.path.join(args.cachedir, "reports"))
+    incremental = model.estimate(jobs, renderframes, plan.frames(reencode),
+                                 plan.targetFrames.duration, len(audiojobs), audioframes)
+    # a full render does the audio in the same job as the video
+    full = model.estimate(1, plan.targetFrames.duration, 0, 0, 0, plan.targetFrames.duration)
+    return {
+        "reference": reference.path,
+        "timeline": timeline.GetName(),
+        "plan": plan.encode(),
+        "renderjobs": jobs,
+        "renderframes": renderframes,
+        "audiojobs": len(audiojobs),
+        "audioframes": audioframes,
+        "cachedglueframes": cachedframes,
+        "planner": {
+            "planner": args.planner,
+            "cost": report.info.get("plancost"),
+            "greedycost": report.info.get("greedyplancost"),
+        },
+        "estimate": {
+            "incremental": incremental,
+            "full": full,
+            "reports": model.reports,
+        },
+        "recommend": "incremental" if incremental["total"] < full["total"] else "full",
+    }
+
+
+class renderTarget:
+    """
+    renderTarget is a timeline to render, as snapshotted, and where the
+    render goes. diffaudio says if its audio gets diffed or rendered whole
+    """
+
+    def __init__(self, timeline, snapshot, diffaudio, outputfile):
+        self.timeline = timeline
+        self.snapshot = snapshot
+        self.diffaudio = diffaudio
+        self.outputfile = outputfile
+        self.plan = None
+        # segment index to glue key, see glueKeys
+        self.gluekeys = None
+        self.audiofiles = []
+
+
+def renderTimeline(tempdir, args, report, project, timeline, reference,
+                   originalSnap, targetSnap, sigcache, diffaudio, outputfile):
+    """
+    renderTimeline renders the timeline snapshotted in targetSnap into
+    outputfile, taking every frame it can from the reference, which is a
+    render of originalSnap. Only the parts that changed are rendered by resolve.
+    """
+    renderTimelines(tempdir, args, report, project, reference, originalSnap,
+                    [renderTarget(timeline, targetSnap, diffaudio, outputfile)], sigcache)
+
+
+def renderTimelines(tempdir, args, report, project, reference, originalSnap, targets, sigcache):
+    """
+    renderTimelines renders every renderTarget in targets, like renderTimeline.
+    The work on the reference side is done once for all of them, and their
+    renders go into one render queue. Glue that shows the same frames in
+    more than one target is only rendered once.
+    """
+    kfindex = reference.kfindex
+    streams = reference.streams
+    framerate = kfindex.framerate
+    videostreams = videoStreams(streams)
+    video = videostreams[0]
+
+    plans = planRenders(args, report, reference, originalSnap, [t.snapshot for t in targets],
+                        sigcache, [t.diffaudio for t in targets])
+    for t, plan in zip(targets, plans):
+        t.plan = plan
+
+    # strip audio from the concatenation input
+    # the concatenation demuxer can get confused if it
+    # encounters audio packets and we're adding the audio
+    # back later anyway. It checks the outpoint against packets from
+    # every stream before it throws away the ones it isn't using, so picking
+    # out the video stream in the concat list doesn't help.
+    # This runs while resolve is rendering and is skipped entirely
+    # if the reference only has video streams
+    _, ext = os.path.splitext(reference.path)
+    basefile = reference.path
+    strip = None
+    if len(videostreams) != len(streams):
+        basefile = f"base{ext}"
+        command = [
+            "ffmpeg",
+            "-y",
+            "-i", reference.path,
+            "-c", "copy",
+        ]
+        for st in videostreams:
+            command += ["-map", f"0:{st['index']}"]
+        command.append(basefile)
+        stripspan = report.start("audio strip")
+        strip = subprocess.Popen(command, cwd=tempdir)
+
+    # the partial GOPs only need the reference, so they are
+    # encoded while resolve is rendering
+    reencodes = {}
+    reencodepool = None
+    if any(t.plan.smartrender for t in targets):
+        reencodepool = ThreadPoolExecutor(max_workers=REENCODE_THREADS)
+        reencodespan = report.start("reencode")
+        for n, t in enumerate(targets):
+            for i, s in enumerate(t.plan.segments):
+                if isinstance(s, reencode):
+                    command = reencodeCommand(video, reference.path, s.originalframe,
+                                              s.duration, framerate, f"reencode{n}_{i}{ext}")
+                    reencodes[n, i] = reencodepool.submit(
+                        subprocess.run, command, cwd=tempdir, capture_output=True)
+
+    # the concat demuxer lines streams up by their position in every
+    # file, so glue has to come with the same video streams as the reference
+    checked = set()
+
+    def checkGlue(key):
+        if len(videostreams) == 1 or key in checked:
+            return
+        checked.add(key)
+        count = len(videoStreams(probeStreams(os.path.join(tempdir, gluefiles[key]))))
+        if count != len(videostreams):
+            raise Exception(f"{gluefiles[key]} has {count} video streams, "
+                            f"the reference has {len(videostreams)}. Check the render preset")
+
+    pipeline = None
+    try:
+        res = project.LoadRenderPreset(args.renderpreset)
+        if res == False:
+            raise Exception(f"couldn't find render preset {args.renderpreset}")
+
+        # glue that we've rendered before for the same frames can be reused
+        # as long as it was rendered with the same settings
+        gluecache = None
+        if not args.nocache:
+            gluecache = GlueCache(os.path.join(
+                args.cachedir, "glue"), args.gluecachesize * 1024 * 1024)
+        # glue key to file
+        gluefiles = {}
+        rendered = []
+
+        AUDIOBASE = "audio"
+        # (frames, target number, render settings, glue key) of every render
+        # job. Audio renders have no glue key
+        renders = []
+        for n, t in enumerate(targets):
+            startframe = t.snapshot.startframe
+            audiospans = t.plan.audiospans
+            if audiospans is None:
+                t.audiofiles.append(f"{AUDIOBASE}{n}{ext}")
+                renders.append((t.snapshot.endframe - startframe, n, {
+                    "ExportAudio": True,
+                    "ExportVideo": False,
+                    "MarkIn": startframe,
+                    "MarkOut": t.snapshot.endframe,
+                    'TargetDir': tempdir,
+                    'CustomName': f"{AUDIOBASE}{n}"
+                }, None))
+            else:
+                for i, (ostart, tstart, duration) in enumerate(audiospans):
+                    if ostart is not None:
+                        continue
+                    t.audiofiles.append(f"{AUDIOBASE}{n}_{i}{ext}")
+                    renders.append((duration, n, {
+                        "ExportAudio": True,
+                        "ExportVideo": False,
+                        "MarkIn": startframe + tstart,
+                        "MarkOut": startframe + tstart + duration - 1,
+                        'TargetDir': tempdir,
+                        'CustomName': f"{AUDIOBASE}{n}_{i}"
+                    }, None))
+
+            t.gluekeys = glueKeys(t.plan, glueSalt(args, project, t.timeline, ext))
+            for i, s in enumerate(t.plan.segments):
+                if isinstance(s, target):
+                    targetstart = s.originalframe + s.positiondelta
+                    key = t.gluekeys[i]
+                    if key in gluefiles:
+                        continue
+                    if gluecache is not None:
+                        cached = gluecache.lookup(key, ext)
+                        if cached is not None:
+                            gluefiles[key] = cached
+                            continue
+                    gluefiles[key] = f"glue{n}_{i}{ext}"
+                    rendered.append(key)
+                    renders.append((s.duration, n, {
+                        "ExportVideo": True,
+                        "ExportAudio": False,
+                        "MarkIn": int(startframe + targetstart),
+                        "MarkOut": int(startframe + (targetstart+s.duration)-1),
+                        'TargetDir': tempdir,
+                        'CustomName': f'glue{n}_{i}'
+                    }, key))
+
+        if args.pipeline:
+            # stitching goes from the start of every target, so the renders
+            # go in timeline order. Audio goes first anyway, see below
+            renders.sort(key=lambda r: (r[1], r[3] is not None, r[2]["MarkIn"]))
+        else:
+            # queue the longest renders first, so that the short ones
+            # fill in at the end rather than the long one dragging on alone
+            renders.sort(key=lambda r: r[0], reverse=True)
+        # Resolve renders whatever timeline is current when a job is
+        # added, so switch to the right one first
+        jobs = []
+        names = {}
+        # glue key to the job rendering it, and the audio jobs of every target
+        gluejobs = {}
+        audiojobs = [[] for _ in targets]
+        current = None
+        for _, n, rendersettings, key in renders:
+            t = targets[n]
+            if current is not t:
+                if project.GetCurrentTimeline().GetUniqueId() != t.snapshot.uniqueid:
+                    if not project.SetCurrentTimeline(t.timeline):
+                        raise Exception(f"couldn't switch to timeline {t.timeline.GetName()}")
+                current = t
+            project.LoadRenderPreset(args.renderpreset)
+            project.SetRenderSettings(rendersettings)
+            job = project.AddRenderJob()
+            jobs.append(job)
+            names[job] = rendersettings['CustomName']
+            if key is None:
+                audiojobs[n].append(job)
+            else:
+                gluejobs[key] = job
+
+        # glue and audio are counted apart, costModel.calibrate fits the
+        # glue render cost to these
+        report.info["renderjobs"] = len(gluejobs)
+        report.info["renderframes"] = sum(r[0] for r in renders if r[3] is not None)
+        report.info["audiojobs"] = sum(len(j) for j in audiojobs)
+        report.info["audioframes"] = sum(r[0] for r in renders if r[3] is None)
+        # the jobs that are done, for the pipeline
+        done = set()
+
+        def onpoll(progress):
+            done.update(j for j, (state, _) in progress.items() if state == "Complete")
+            if pipeline is not None:
+                pipeline.poll()
+
+        if args.pipeline:
+            def ready(n, i):
+                s = targets[n].plan.segments[i]
+                if isinstance(s, original):
+                    return strip is None or strip.poll() == 0
+                if isinstance(s, reencode):
+                    res = reencodes[n, i]
+                    return res.done() and res.exception() is None and res.result().returncode == 0
+                key = targets[n].gluekeys[i]
+                job = gluejobs.get(key)
+                if job is None:
+                    return True
+                if job not in done:
+                    return False
+                checkGlue(key)
+                return True
+
+            def audioready(n):
+                return all(j in done for j in audiojobs[n])
+
+            pipeline = stitchPipeline(tempdir, report, reference, basefile, targets,
+                                      gluefiles, ready, audioready)
+        # the audio goes first, on its own, so that we know how long the
+        # glue took. It renders quickly and the pipeline wants it early
+        audio = [j for js in audiojobs for j in js]
+        glue = list(gluejobs.values())
+        for phase, batch in (("render audio", audio), ("render", glue)):
+            if not batch:
+                continue
+            with report.phase(phase):
+                project.StartRendering(batch, isInteractiveMode=False)
+                waitForRender(project, batch, names, onpoll)
+    except BaseException:
+        if pipeline is not None:
+            pipeline.kill()
+        if strip is not None:
+            strip.kill()
+            strip.wait()
+        if reencodepool is not None:
+            reencodepool.shutdown(cancel_futures=True)
+        raise
 
-    # run through every frame of the video, creating a hash of the current frame
-    # properties. This is horribly inefficient, but the alternative
-    # is to actually do the maths for insertion and doing "data structures"
-    # and "computer science". Life's too short
-    originalFrames = calculateFrameSeq(originalTimeline)
-    targetFrames = calculateFrameSeq(targetTimeline)
+    for j in jobs:
+        status = project.GetRenderJobStatus(j)
+        if status['JobStatus'] != 'Complete':
+            raise Exception(f"{names[j]} render failed")
+
+    if reencodepool is not None:
+        reencodepool.shutdown()
+        for res in reencodes.values():
+            res = res.result()
+            if res.returncode != 0:
+                raise Exception(f"failed to re-encode {res.args[-1]}: {res.stderr.decode(errors='replace')}")
+        report.stop(reencodespan)
+
+    if strip is not None:
+        if strip.wait() != 0:
+            raise Exception("failed audio strip")
+        report.stop(stripspan)
+        report.ffmpeg("audio strip", [reference.path], os.path.join(tempdir, basefile))
+
+    for key in rendered:
+        checkGlue(key)
+
+    # whatever the pipeline couldn't do during the renders gets done
+    # now, before the glue it reads moves into the cache
+    if pipeline is not None:
+        try:
+            pipeline.finish()
+        except BaseException:
+            pipeline.kill()
+            raise
+        report.info["chunks"] = sum(len(c) for c in pipeline.chunks)
+
+    # rendered glue goes into the cache, and gets used from there
+    if gluecache is not None:
+        for key in rendered:
+            gluefiles[key] = gluecache.store(
+                key, os.path.join(tempdir, gluefiles[key]))
+
+    for n, t in enumerate(targets):
+        if pipeline is None:
+            stitchTarget(tempdir, report, reference, basefile, t, n, gluefiles)
+        else:
+            stitchTarget(tempdir, report, reference, basefile, t, n, gluefiles,
+                         pipeline.chunks[n], pipeline.mixes[n])
+
+    if len(targets) > 1:
+        report.info["targets"] = [{
+            "timeline": t.timeline.GetName(),
+            "output": t.outputfile,
+            "segments": len(t.plan.segments),
+            "glueframes": t.plan.frames(target),
+            "reencodeframes": t.plan.frames(reencode),
+        } for t in targets]
+
+    if gluecache is not None:
+        gluecache.evict()
+
+
+# the least a chunk of the program gets stitched in while resolve is still
+# rendering, in frames. About five minutes at 25fps
+PIPELINE_CHUNK_FRAMES = 7500
+
+
+class stitchPipeline:
+    """
+    stitchPipeline does the part of stitching that doesn't have to wait for
+    every render, while resolve is still rendering. Once the start of a
+    target has all of its glue, it gets copied into a chunk file, and
+    spliced audio gets mixed down as soon as its renders are there.
+    stitchTarget then only has to join the chunks and copy the audio.
+    One chunk and one audio mix are made at a time.
+
+    ready(n, i) says if segment i of target n can be stitched, audioready(n)
+    if the audio renders of target n are done.
+    """
+
+    def __init__(self, tempdir, report, reference, basefile, targets, gluefiles,
+                 ready, audioready, minframes=PIPELINE_CHUNK_FRAMES):
+        self.tempdir = tempdir
+        self.report = report
+        self.reference = reference
+        self.basefile = basefile
+        self.targets = targets
+        self.gluefiles = gluefiles
+        self.ready = ready
+        self.audioready = audioready
+        self.minframes = minframes
+        _, self.ext = os.path.splitext(reference.path)
+
+        # the next segment to stitch of every target, and the chunks so far
+        self.pos = [0] * len(targets)
+        self.chunks = [[] for _ in targets]
+        # the mixed down audio of every target, if it needs one
+        self.mixes = [None] * len(targets)
+        self.mixing = [tgt.plan.audiospans is not None and not tgt.plan.audioUnchanged()
+                       for tgt in targets]
+        # (process, target number, output, frames, inputs) of what is running
+        self.chunkrun = None
+        self.mixrun = None
+        self.span = None
+
+    def poll(self):
+        """
+        poll picks up what has finished and starts what can be started
+        """
+        self.collect(False)
+        if self.chunkrun is None:
+            self.startChunk()
+        if self.mixrun is None:
+            self.startMix()
+
+    def finish(self):
+        """
+        finish stitches everything that is left, which is all of it
+        once every render is done
+        """
+        while True:
+            self.poll()
+            if self.chunkrun is None and self.mixrun is None:
+                break
+            self.collect(True)
+        if any(pos != len(tgt.plan.segments) for pos, tgt in zip(self.pos, self.targets)) \
+                or any(m and f is None for m, f in zip(self.mixing, self.mixes)):
+            raise Exception("pipelined stitching stopped short, contact developer")
+        if self.span is not None:
+            self.report.stop(self.span)
+
+    def kill(self):
+        for run in (self.chunkrun, self.mixrun):
+            if run is not None:
+                run[0].kill()
+                run[0].wait()
+        self.chunkrun = self.mixrun = None
+
+    def collect(self, wait):
+        for run in (self.chunkrun, self.mixrun):
+            if run is None:
+                continue
+            proc, n, output, frames, inputs = run
+            if wait:
+                proc.wait()
+            if proc.poll() is None:
+                continue
+            if proc.returncode != 0:
+                raise Exception(f"failed to stitch {output}")
+            self.report.ffmpeg("pipelined stitch", [os.path.join(self.tempdir, f) for f in inputs],
+                               os.path.join(self.tempdir, output))
+            if run is self.chunkrun:
+                self.chunks[n].append((output, frames))
+                self.chunkrun = None
+            else:
+                self.mixes[n] = output
+                self.mixrun = None
+
+    def run(self, command):
+        if self.span is None:
+            self.span = self.report.start("pipelined stitch")
+        return subprocess.Popen(command, cwd=self.tempdir)
+
+    def startChunk(self):
+        framerate = self.reference.kfindex.framerate
+        for n, tgt in enumerate(self.targets):
+            segments = tgt.plan.segments
+            start = end = self.pos[n]
+            frames = 0
+            while end < len(segments) and self.ready(n, end):
+                frames += segments[end].duration
+                end += 1
+            if end == start or (frames < self.minframes and end != len(segments)):
+                continue
+
+            # every segment starts on a keyframe, so any of them can
+            # start a chunk
+            k = len(self.chunks[n])
+            lines, files = spliceList(
+                segments[start:end], framerate, self.basefile,
+                lambda i: self.gluefiles[tgt.gluekeys[start+i]],
+                lambda i: f"reencode{n}_{start+i}{self.ext}")
+            listfile = f"chunk{n}_{k}.txt"
+            with open(os.path.join(self.tempdir, listfile), "w") as f:
+                f.write("\n".join(lines))
+            output = f"chunk{n}_{k}{self.ext}"
+            self.chunkrun = (self.run([
+                "ffmpeg",
+                "-y",
+                "-safe", "0",
+                "-f", "concat",
+                "-i", listfile,
+                "-map", "0:v",
+                "-c", "copy",
+                output,
+            ]), n, output, frames, files)
+            self.pos[n] = end
+            return
+
+    def startMix(self):
+        for n, tgt in enumerate(self.targets):
+            if not self.mixing[n] or self.mixes[n] is not None or not self.audioready(n):
+                continue
+            output = f"audiomix{n}{self.ext}"
+            inputs, options = audioSplice(self.tempdir, self.reference, tgt.plan, tgt.audiofiles, n, 0)
+            self.mixrun = (self.run(["ffmpeg", "-y", *inputs, *options, output]),
+                           n, output, 0, inputs[1::2])
+            return
+
+
+def stitchTarget(tempdir, report, reference, basefile, tgt, n, gluefiles, chunks=None, audiomix=None):
+    """
+    stitchTarget puts the output of the renderTarget tgt together out of the
+    reference, the glue and the rendered audio, and writes its manifest.
+    n is the number of the target in the run, which its files are named by.
+
+    If the video has been stitched into chunks already, chunks holds the
+    (file, frames) of every one, in order. If the spliced audio has been
+    mixed down already, audiomix is the file it is in. See stitchPipeline
+    """
+    kfindex = reference.kfindex
+    streams = reference.streams
+    framerate = kfindex.framerate
+    _, ext = os.path.splitext(reference.path)
+    plan = tgt.plan
+    segments = plan.segments
+    audiospans = plan.audiospans
+    audiofiles = tgt.audiofiles
+    gluekeys = tgt.gluekeys
+    outputfile = tgt.outputfile
+
+    # generate file for ffmpeg concat demuxer
+    if chunks is None:
+        splicelines, splicefiles = spliceList(
+            segments, framerate, basefile,
+            lambda i: gluefiles[gluekeys[i]],
+            lambda i: f"reencode{n}_{i}{ext}")
+    else:
+        splicelines = []
+        splicefiles = []
+        for f, frames in chunks:
+            splicelines.append(f"file {concatQuote(f)}")
+            splicelines.append(f"duration {durstring(frames, framerate)}")
+            splicefiles.append(f)
+
+    fileloc = os.path.join(tempdir, f"splice{n}.txt")
+    with open(fileloc, "w") as splicefile:
+        splicefile.write("\n".join(splicelines))
+
+    # the rendered audio goes in as is. Partial audio gets spliced onto the
+    # reference audio sample by sample, which means encoding it again. Audio is
+    # cheap to encode, so this is still a lot faster than having resolve render it.
+    # Every audio stream is spliced the same way, the rendered audio comes
+    # out of the same preset as the reference, so it has the same streams.
+    # Timecode tracks are copied from whatever file is input tcinput, it
+    # starts where the output does
+    tcinput = 1
+    if audiospans is None:
+        audioinputs = ["-i", audiofiles[0]]
+        timecodes = timecodeStreams(probeStreams(os.path.join(tempdir, audiofiles[0])))
+        audiomap = ["-map", "1:a", "-c", "copy"]
+    elif plan.audioUnchanged():
+        audioinputs = ["-i", reference.path]
+        timecodes = timecodeStreams(streams)
+        audiomap = ["-map", "1:a", "-c", "copy"]
+    elif audiomix is not None:
+        audioinputs = ["-i", audiomix]
+        timecodes = timecodeStreams(streams)
+        if timecodes:
+            audioinputs += ["-i", reference.path]
+            tcinput = 2
+        audiomap = ["-map", "1:a", "-c", "copy"]
+    else:
+        audioinputs, audiomap = audioSplice(tempdir, reference, plan, audiofiles, n, 1)
+        timecodes = timecodeStreams(streams)
+        audiomap += ["-c:v", "copy", "-c:d", "copy"]
+    # resolve also puts per frame metadata into its renders as data
+    # streams. Those describe frames we might have cut out, and the mp4
+    # muxer doesn't like them anyway, so they don't get carried over
+    for st in timecodes:
+        audiomap += ["-map", f"{tcinput}:{st['index']}"]
+
+    # concatenate and add the audio back in one go, so that the video
+    # is only read and written once
+    command = [
+        "ffmpeg",
+        "-y",
+        "-report",
+        "-safe", "0",
+        "-f", "concat",
+        "-i", fileloc,
+        *audioinputs,
+        "-map", "0:v",
+        *audiomap,
+        outputfile
+    ]
+    with report.phase("concat and mux"):
+        res = subprocess.run(command, cwd=tempdir)
+    if res.returncode != 0:
+        raise Exception(f"failed to stitch {outputfile}")
+    inputs = [os.path.join(tempdir, command[i+1])
+              for i, c in enumerate(command) if c == "-i"]
+    inputs += [os.path.join(tempdir, f) for f in splicefiles]
+    report.ffmpeg("concat and mux", inputs, outputfile)
 
-    lcs = longestcommonsub(originalFrames, targetFrames)
+    # write down what the output is, so that it can be the reference of the
+    # next run without the timeline it was rendered from
+    with report.phase("manifest"):
+        saveKeyframeIndex(outputfile, stitchedKeyframeIndex(outputfile, segments, kfindex))
+        saveManifest(outputfile, Manifest(tgt.snapshot, audioLayout(tgt.timeline)))
 
+
+def audioSplice(tempdir, reference, plan, audiofiles, n, first):
+    """
+    audioSplice returns the ffmpeg inputs and output options that splice the
+    rendered audiofiles onto the audio of the reference, which comes in as
+    input number first, with the rendered audio after it
+    """
+    framerate = reference.kfindex.framerate
+    refaudio = [st for st in reference.streams if st["codec_type"] == "audio"]
+    inputs = ["-i", reference.path]
+    for a in audiofiles:
+        inputs += ["-i", a]
+    graphs = []
+    options = []
+    for j, ref in enumerate(refaudio):
+        graphs.append(audioFilter(plan.audiospans, int(ref["sample_rate"]), framerate,
+                                  f"{first}:a:{j}", first+1, j))
+        options += ["-map", f"[aout{j}]", f"-c:a:{j}", ref["codec_name"]]
+        if "bit_rate" in ref:
+            options += [f"-b:a:{j}", ref["bit_rate"]]
+    filterloc = os.path.join(tempdir, f"audio{n}.txt")
+    with open(filterloc, "w") as filterfile:
+        filterfile.write(";\n".join(graphs))
+    return inputs, ["-filter_complex_script", filterloc] + options
+
+
+def durstring(framenum, framerate) -> str:
+    """
+    durstring turns a frame number into a timestamp for ffmpeg. This is
+    where frame numbers become fractions, so no detail is lost for NTSC
+    """
+    posSecond = framenum/fractions.Fraction(framerate)
+    # microsecond is the smallest unit that ffmpeg parses
+    # so use it and discard any fractional component
+    us = 1_000_000 * posSecond
+    return f"{math.floor(us)}us"
+
+
+def spliceList(segments, framerate, basefile, gluefile, reencodefile):
+    """
+    spliceList returns the lines of the ffmpeg concat demuxer script that
+    puts segments together, and the files it reads. gluefile and reencodefile
+    give the file for the target and reencode segment at a position
+    """
+    splicelines = []
+    splicefiles = []
+    for i, s in enumerate(segments):
+        if isinstance(s, original):
+            if s.duration <= 0:
+                continue
+            splicelines.append(f"file {concatQuote(basefile)}")
+            if basefile not in splicefiles:
+                splicefiles.append(basefile)
+            splicelines.append(f"inpoint {durstring(s.originalframe, framerate)}")
+            # ffmpeg goes by decode timestamp when determining when to stop concatenating
+            # and the outpoint is exclusive, so we need to specify the frame before the keyframe
+            # Also, specify a duration since without this, it will take use the outpoint
+            # and mess up the presentation timestamp for the following file
+            outpoint = s.originalframe+s.duration
+            outpoint += s.outKfDelta
+            splicelines.append(f"outpoint {durstring(outpoint, framerate)}")
+            splicelines.append(f"duration {durstring(s.duration, framerate)}")
+        elif isinstance(s, reencode):
+            splicelines.append(f"file {concatQuote(reencodefile(i))}")
+            splicefiles.append(reencodefile(i))
+            splicelines.append(f"duration {durstring(s.duration, framerate)}")
+        else:
+            if s.duration <= 0:
+                raise Exception("zero length 'to' segment, contact developer")
+            splicelines.append(f"file {concatQuote(gluefile(i))}")
+            if gluefile(i) not in splicefiles:
+                splicefiles.append(gluefile(i))
+            splicelines.append(f"duration {durstring(s.duration, framerate)}")
+    return splicelines, splicefiles
+
+
+def buildSegments(originalFrames, targetFrames, kfindex, mergegap, dump=None, report=None, smartrender=False,
+                  vectorized=None, model=None):
+    """
+    buildSegments works out which frames of the target timeline can be
+    taken from the reference render and which need rendering. It returns
+    a list of original and target segments covering the target timeline, with
+    the cuts into the reference moved onto keyframes.
+
+    With smartrender, the cuts stay where they are and the partial GOPs
+    around them come back as reencode segments instead.
+
+    The planning runs on numpy arrays when numpy is there, see
+    planSegmentsNumpy. vectorized forces one way or the other.
+
+    With a costModel, what gets rendered is worked out by cost, see
+    cheapestSegments, rather than by mergegap. If that comes out more
+    expensive than going by mergegap, which can happen when re-encoding
+    overlaps with rendering, the mergegap plan is used after all.
+    """
+    if dump is None:
+        def dump(msg, segs):
+            pass
+    if report is None:
+        report = Report()
+
+    with report.phase("lcs", python=True):
+        pairs = heaviestcommonpairs(originalFrames.hashes, targetFrames.hashes,
+                                    originalFrames.lengths, targetFrames.lengths)
+
+    planning = report.start("planning", python=True)
+    if vectorized is None:
+        vectorized = numpy is not None and not smartrender
+    gap = mergegap if model is None else -1
+    if vectorized:
+        segments = planSegmentsNumpy(originalFrames, targetFrames, pairs, kfindex, gap)
+    else:
+        segments = planSegments(originalFrames, targetFrames, pairs, kfindex, gap, dump, smartrender)
+    if model is not None:
+        greedy = mergeTargets([copy.copy(s) for s in segments], mergegap)
+        cheapest = mergeTargets(cheapestSegments(segments, model), -1)
+        greedycost = model.planEstimate(greedy)["total"]
+        cost = model.planEstimate(cheapest)["total"]
+        segments = cheapest
+        if cost > greedycost:
+            segments, cost = greedy, greedycost
+        report.info["plancost"] = cost
+        report.info["greedyplancost"] = greedycost
+    dump("segment list after merging targets", segments)
+
+    # consistency check
+    length = 0
+    for s in segments:
+        of = s.originalframe
+        if of < 0 or s.duration < 0:
+            raise Exception("overlapping segments, contact developer")
+        length += s.duration
+
+    if length != targetFrames.duration:
+        raise Exception(
+            "made a sequence that is not same length as intended result, contact developer")
+
+    report.stop(planning)
+    report.info["frames"] = targetFrames.duration
+    report.info["segments"] = len(segments)
+    report.info["gluesegments"] = sum(1 for s in segments if isinstance(s, target))
+    report.info["glueframes"] = sum(s.duration for s in segments if isinstance(s, target))
+    report.info["reencodesegments"] = sum(1 for s in segments if isinstance(s, reencode))
+    report.info["reencodeframes"] = sum(s.duration for s in segments if isinstance(s, reencode))
+    return segments
+
+
+def planSegments(originalFrames, targetFrames, pairs, kfindex, mergegap, dump, smartrender):
+    """
+    planSegments turns the matching runs in pairs into segments, one
+    python object at a time. See buildSegments
+    """
     # turn our LCS into a list of segments. These segments
     # are either "original" or "target" segments.
     # for original segments, we use the frame number, 0-indexed of the
@@ -76,129 +1622,1731 @@ def steenbeck_inner(tempdir: str, args):
     #
     # for target segments, we use the frame number of the timeline we read
     # from resolve
-    class segment:
-        def __init__(self, originalframe, positiondelta, duration):
-            self.originalframe = originalframe
-            self.positiondelta = positiondelta
-            self.duration = duration
-
-            self.inKeyframe = None
-            self.outKeyframe = None
-
-            # delta frames between presentation timestamp
-            # and decode timestamp for the out keyframes. This is important
-            # because the concat demuxer decides when to stop reading on the
-            # DTS rather than the PTS and it can be an arbitrary time before
-            # the actual keyframe.
-            #
-            # Note that while the delta in the packet stream is in time base units
-            # and doesn't necessarily line up with frames, we use frames here because
-            # we do all our maths in it. The math is done in fractions anyway to deal with
-            # NTSC, so no detail is lost
-            self.outKfDelta = None
-
-        def __repr__(self) -> str:
-            return f"<{type(self).__name__} of:{self.originalframe} delta:{self.positiondelta} dur:{self.duration} inframe:{self.inKeyframe} outframe:{self.outKeyframe}>"
-
-    class original(segment):
-        pass
+    segments = []
+
+    def addsegment(seg):
+        # adjacent runs often line up on both sides, merge them
+        # so that we don't end up with a cut for every run
+        if segments and type(segments[-1]) is type(seg):
+            prev = segments[-1]
+            if prev.positiondelta == seg.positiondelta and prev.originalframe + prev.duration == seg.originalframe:
+                prev.duration += seg.duration
+                return
+        segments.append(seg)
+
+    # walk the matching runs. Runs with the same hash show the same
+    # frames from their start, so if the lengths differ, the head of the
+    # runs match and the leftover in the target is an insertion.
+    # Anything in between matches is either an insertion or a deletion
+    ostarts = originalFrames.starts()
+    tstarts = targetFrames.starts()
+    j = 0
+    for ri, rj in pairs:
+        ostart, tstart = ostarts[ri], tstarts[rj]
+        if tstart > j:
+            addsegment(target(j, 0, tstart-j))
+        common = min(originalFrames.lengths[ri], targetFrames.lengths[rj])
+        addsegment(original(ostart, tstart-ostart, common))
+        if targetFrames.lengths[rj] > common:
+            addsegment(target(tstart+common, 0, targetFrames.lengths[rj]-common))
+        j = tstart + targetFrames.lengths[rj]
+    if j < targetFrames.duration:
+        addsegment(target(j, 0, targetFrames.duration-j))
+
+    dump("segment list before keyframe search", segments)
+
+    # for every segment, find the keyframe after its in point and the one before it's out point
+    # these will act as "handles" when we start gluing segments together
+    inKeyframe = {}
+    outKeyframe = {}
+    for s in segments:
+        # target segments do not have keyframes at their entry or exit
+        # rely on them being next to original segments that do
+        if isinstance(s, target):
+            continue
+
+        inKeyframe[s.originalframe] = s
+        outframe = s.originalframe+s.duration
+        if outframe < originalFrames.duration:
+            outKeyframe[outframe] = s
+        else:
+            s.outKeyframe = outframe
+            s.outKfDelta = 0
+
+    ptsperframe = kfindex.ptsperframe()
+
+    for framenum, s in inKeyframe.items():
+        k = kfindex.findnext(framenum)
+        if k is None:
+            # no keyframe until the end of the file, the end of the
+            # file is a fine place to cut
+            s.inKeyframe = kfindex.endframe()
+        else:
+            s.inKeyframe = kfindex.frames[k]
+    for framenum, s in outKeyframe.items():
+        k = kfindex.findprev(framenum)
+        if k is None:
+            raise Exception("did not find preceding keyframe")
+        s.outKeyframe = kfindex.frames[k]
+        s.outKfDelta = (kfindex.dts[k]-kfindex.pts[k])/ptsperframe
+
+    dump("after keyframe search", segments)
+
+    if smartrender:
+        segments = reencodeBoundaries(segments, dump)
+    else:
+        segments = nudgeToKeyframes(segments, dump)
+
+    return mergeTargets(segments, mergegap)
+
+
+def mergeTargets(segments, mergegap):
+    """
+    mergeTargets merges target segments next to each other, and target
+    segments with one segment of at most mergegap frames between them.
+    A mergegap below 0 only merges the ones next to each other
+    """
+    # every render job has a startup cost in resolve. If two target segments
+    # are only a few frames apart, rendering the frames between them is
+    # cheaper than starting another job
+    newsegments = []
+    for s in segments:
+        if isinstance(s, target) and newsegments:
+            prev = newsegments[-1]
+            if isinstance(prev, target):
+                prev.duration += s.duration
+                continue
+            if len(newsegments) > 1 and isinstance(newsegments[-2], target) and prev.duration <= mergegap:
+                newsegments.pop()
+                newsegments[-1].duration += prev.duration + s.duration
+                continue
+        newsegments.append(s)
+    return newsegments
+
+
+def cheapestSegments(segments, model):
+    """
+    cheapestSegments picks which segments to render instead of copying or
+    re-encoding them, so that the render and re-encode time of segments
+    is the lowest model has for it. Rendering a segment costs its frames,
+    but rendering the only one between two target segments saves a job.
+    The cuts stay where they are, the segments that get rendered come back
+    as target segments.
+    """
+    # cheapest cost of the segments so far, with the last one kept and
+    # with it rendered, and for every segment, which of those the
+    # cheapest way to get to it came from
+    kept, rendered = 0.0, math.inf
+    came = []
+    for s in segments:
+        keep = 0.0
+        if isinstance(s, target):
+            keep = math.inf
+        elif isinstance(s, reencode):
+            keep = s.duration*model.reencodeseconds
+        render = s.duration*model.frameseconds
+        fromkept = (kept <= rendered, kept + model.jobseconds <= rendered)
+        came.append(fromkept)
+        kept, rendered = (min(kept, rendered) + keep,
+                          min(kept + model.jobseconds, rendered) + render)
+
+    newsegments = []
+    last = kept > rendered
+    for s, fromkept in zip(reversed(segments), reversed(came)):
+        if last and not isinstance(s, target):
+            s = target(s.originalframe + s.positiondelta, 0, s.duration)
+        newsegments.append(s)
+        last = not fromkept[last]
+    newsegments.reverse()
+    return newsegments
+
+
+def planSegmentsNumpy(originalFrames, targetFrames, pairs, kfindex, mergegap):
+    """
+    planSegmentsNumpy does what planSegments does without smart render, on
+    numpy arrays of frame numbers. Every step works on all the segments at
+    once and only the segments that come out the end become objects.
+    """
+    i64 = numpy.int64
+
+    def runs(joins, *cols):
+        # collapse every stretch of entries that join the one before into
+        # its first entry. The last column is durations, which add up
+        firsts = numpy.flatnonzero(~joins)
+        *cols, dur = cols
+        return [c[firsts] for c in cols] + [numpy.add.reduceat(dur, firsts)]
+
+    def after(a, fill):
+        # a shifted along by one, so that entry i holds entry i-1
+        return numpy.concatenate(([fill], a[:-1]))[:len(a)]
+
+    # walk the matching runs, see planSegments. Every pair gives an
+    # insertion before it, the matching frames and an insertion after
+    pairs = numpy.fromiter(itertools.chain.from_iterable(pairs), dtype=i64,
+                           count=2*len(pairs)).reshape(-1, 2)
+    ri, rj = pairs[:, 0], pairs[:, 1]
+    olengths = numpy.asarray(originalFrames.lengths, dtype=i64)
+    tlengths = numpy.asarray(targetFrames.lengths, dtype=i64)
+    ostart = (numpy.cumsum(olengths) - olengths)[ri]
+    tstart = (numpy.cumsum(tlengths) - tlengths)[rj]
+    tlen = tlengths[rj]
+    common = numpy.minimum(olengths[ri], tlen)
+    tend = tstart + tlen
+    j = after(tend, 0)
+    last = int(tend[-1]) if len(tend) else 0
+    zero = numpy.zeros_like(tstart)
+
+    of = numpy.append(numpy.stack([j, ostart, tstart+common], 1).ravel(), last)
+    pd = numpy.append(numpy.stack([zero, tstart-ostart, zero], 1).ravel(), 0)
+    dur = numpy.append(numpy.stack([tstart-j, common, tlen-common], 1).ravel(), targetFrames.duration-last)
+    orig = numpy.append(numpy.tile([False, True, False], len(ri)), False)
+    keep = orig | (dur > 0)
+    of, pd, dur, orig = of[keep], pd[keep], dur[keep], orig[keep]
+
+    joins = numpy.zeros(len(of), dtype=bool)
+    joins[1:] = (orig[1:] == orig[:-1]) & (pd[1:] == pd[:-1]) & (of[:-1] + dur[:-1] == of[1:])
+    orig, pd, of, dur = runs(joins, orig, pd, of, dur)
+
+    # keyframe search. Entries for target segments get worked out too,
+    # but nothing looks at them
+    kfframes = numpy.asarray(kfindex.frames, dtype=i64)
+    kfdelta = numpy.asarray(kfindex.dts, dtype=i64) - numpy.asarray(kfindex.pts, dtype=i64)
+    inkf = numpy.append(kfframes, kfindex.endframe())[numpy.searchsorted(kfframes, of)]
+    outframe = of + dur
+    atend = outframe >= originalFrames.duration
+    k = numpy.searchsorted(kfframes, outframe) - 1
+    if numpy.any(orig & ~atend & (k < 0)):
+        raise Exception("did not find preceding keyframe")
+    k = numpy.maximum(k, 0)
+    outkf = numpy.where(atend, outframe, numpy.append(kfframes, 0)[k])
+    # the decode delay stays in time base units until it becomes a fraction
+    # of a frame for the segments that are left at the end
+    outdelta = numpy.where(atend, 0, numpy.append(kfdelta, 0)[k])
+
+    # overlap target morph
+    morph = orig & (inkf >= outkf)
+    of = numpy.where(morph, of + pd, of)
+    pd = numpy.where(morph, 0, pd)
+    orig = orig & ~morph
+
+    # roll up consecutive target segments. Original segments don't join
+    # anything, so their keyframes come through
+    joins = ~orig & after(~orig, False)
+    orig, pd, of, inkf, outkf, outdelta, dur = runs(joins, orig, pd, of, inkf, outkf, outdelta, dur)
+    if len(orig) and orig[0]:
+        orig, pd, of, inkf, outkf, outdelta, dur = (
+            numpy.insert(a, 0, v) for a, v in
+            zip((orig, pd, of, inkf, outkf, outdelta, dur), (False, 0, of[0]+pd[0], 0, 0, 0, 0)))
+
+    # keyframe nudges. A segment ends in the same place whatever the
+    # segments around it do, so every out nudge is known up front. The in
+    # nudges are then relative to where the out nudge before left the start
+    outnudge = numpy.where(orig, of + dur - outkf, 0)
+    outnudge[-1:] = 0
+    outnudge = numpy.maximum(outnudge, 0)
+    of = of - after(outnudge, 0)
+    dur = dur + after(outnudge, 0) - outnudge
+    innudge = numpy.maximum(numpy.where(orig, inkf - of, 0), 0)
+    of = of + innudge
+    dur = dur - innudge
+    dur[:-1] += innudge[1:]
+
+    # glue insertion, every segment is followed by the glue it needs,
+    # which is nothing for most of them
+    glue = numpy.where(orig, numpy.maximum(of + dur - outkf, 0), 0)
+    dur = dur - glue
+    gluestart = of + pd + dur
+    of = numpy.stack([of, gluestart], 1).ravel()
+    pd = numpy.stack([pd, numpy.zeros_like(pd)], 1).ravel()
+    dur = numpy.stack([dur, glue], 1).ravel()
+    orig = numpy.stack([orig, numpy.zeros_like(orig)], 1).ravel()
+    inkf = numpy.repeat(inkf, 2)
+    outkf = numpy.repeat(outkf, 2)
+    outdelta = numpy.repeat(outdelta, 2)
+    keep = orig | (dur > 0)
+    orig, pd, of, inkf, outkf, outdelta, dur = (
+        a[keep] for a in (orig, pd, of, inkf, outkf, outdelta, dur))
+
+    # merge targets next to each other, or with at most mergegap frames
+    # of original between them
+    istarget = ~orig
+    absorbed = orig & (dur <= mergegap) & after(istarget, False) & numpy.append(istarget[1:], False)
+    joins = (istarget & after(istarget | absorbed, False)) | absorbed
+    orig, pd, of, inkf, outkf, outdelta, dur = runs(joins, orig, pd, of, inkf, outkf, outdelta, dur)
+
+    ptsperframe = kfindex.ptsperframe()
+    segments = []
+    for o, p, f, ikf, okf, delta, d in zip(*(a.tolist() for a in (orig, pd, of, inkf, outkf, outdelta, dur))):
+        if not o:
+            segments.append(target(f, p, d))
+            continue
+        s = original(f, p, d)
+        s.inKeyframe = ikf
+        s.outKeyframe = okf
+        s.outKfDelta = delta/ptsperframe
+        segments.append(s)
+    return segments
+
+
+def nudgeToKeyframes(segments, dump):
+    """
+    nudgeToKeyframes moves the cuts into the reference onto keyframes,
+    handing the frames in between to the target segments next to them,
+    so that resolve renders them.
+    """
+    # go through every segment, if any of the original segments have overlapping
+    # in and out keyframes, turn the segment into a target one
+    for i, s in enumerate(segments):
+        if isinstance(s, target):
+            continue
+        if s.inKeyframe >= s.outKeyframe:
+            segments[i] = target(
+                s.originalframe + s.positiondelta, 0, s.duration)
+
+    dump("after overlap target morph", segments)
+
+    # the previous pass can cause target segments next to each other.
+    # "roll up" consecutive target segments into one segment
+    newsegments = []
+    targetaccum = None
+    for i, s in enumerate(segments):
+        if isinstance(s, original):
+            if targetaccum != None:
+                newsegments.append(targetaccum)
+                targetaccum = None
+            newsegments.append(s)
+            continue
+        if targetaccum == None:
+            targetaccum = s
+        elif targetaccum.originalframe + targetaccum.duration == s.originalframe:
+            targetaccum.duration += s.duration
+        else:
+            newsegments.append(targetaccum)
+            targetaccum = None
+    if targetaccum != None:
+        newsegments.append(targetaccum)
+
+    segments = newsegments
+
+    # the frames up to the in keyframe go to the segment before, so a
+    # timeline starting on reference frames needs an empty target in
+    # front for them. It goes again if it is still empty after nudging
+    if segments and isinstance(segments[0], original):
+        first = segments[0]
+        segments.insert(0, target(first.originalframe + first.positiondelta, 0, 0))
+    dump("segment list before keyframe nudges", segments)
+
+    # create a new sequence with the in and out points
+    # of our segments nudged based on the data we found from ffmpeg
+    for i, s in enumerate(segments):
+        if isinstance(s, target):
+            continue
+
+        innudge = s.inKeyframe - s.originalframe
+        outnudge = (s.originalframe + s.duration) - s.outKeyframe
+        if innudge > 0:
+            prevsegment = segments[i-1]
+            prevsegment.duration += innudge
+            s.duration -= innudge
+            s.originalframe += innudge
+        if outnudge > 0 and i != len(segments)-1:
+            nextseg = segments[i+1]
+            nextseg.duration += outnudge
+            nextseg.originalframe -= outnudge
+            s.duration -= outnudge
+
+    dump("segment list after keyframe nudges", segments)
+    # after we've nudged the cut points, find any segment
+    # that still has a difference between its outframe
+    # and the outgoing keyframe. This indicates a spot
+    # that needs glue
+    newsegments = []
+    for i, s in enumerate(segments):
+        if isinstance(s, target):
+            if s.duration > 0:
+                newsegments.append(s)
+            continue
+        outframe = s.originalframe + s.duration
+        if s.outKeyframe < outframe:
+            tgtduration = outframe - s.outKeyframe
+            s.duration -= tgtduration
+            tgtframe = s.originalframe + s.positiondelta
+            tgtframe += s.duration
+            newsegments.append(s)
+            newsegments.append(target(tgtframe, 0, tgtduration))
+        else:
+            newsegments.append(s)
+
+    dump("segment list after glue insertion", newsegments)
+    return newsegments
+
+
+def reencodeBoundaries(segments, dump):
+    """
+    reencodeBoundaries keeps the cuts into the reference where they are.
+    The frames between a cut and the keyframe next to it are split off
+    into reencode segments, which ffmpeg decodes from the reference and
+    encodes again, so resolve only renders frames that changed.
+    """
+    newsegments = []
+
+    def add(seg):
+        if seg.duration <= 0:
+            return
+        # reencodes on both sides of a short original segment
+        # end up next to each other, make them one
+        if newsegments and type(newsegments[-1]) is type(seg) and isinstance(seg, reencode):
+            prev = newsegments[-1]
+            if prev.positiondelta == seg.positiondelta and prev.originalframe + prev.duration == seg.originalframe:
+                prev.duration += seg.duration
+                return
+        newsegments.append(seg)
+
+    for s in segments:
+        if isinstance(s, target):
+            add(s)
+            continue
+        outframe = s.originalframe + s.duration
+        if s.inKeyframe >= s.outKeyframe:
+            # no whole GOP in here to copy
+            add(reencode(s.originalframe, s.positiondelta, s.duration))
+            continue
+        add(reencode(s.originalframe, s.positiondelta, s.inKeyframe - s.originalframe))
+        s.duration = s.outKeyframe - s.inKeyframe
+        s.originalframe = s.inKeyframe
+        add(s)
+        add(reencode(s.outKeyframe, s.positiondelta, outframe - s.outKeyframe))
+
+    dump("segment list after splitting off reencodes", newsegments)
+    return newsegments
+
+
+class segment:
+    def __init__(self, originalframe, positiondelta, duration):
+        self.originalframe = originalframe
+        self.positiondelta = positiondelta
+        self.duration = duration
+
+        self.inKeyframe = None
+        self.outKeyframe = None
+
+        # delta frames between presentation timestamp
+        # and decode timestamp for the out keyframes. This is important
+        # because the concat demuxer decides when to stop reading on the
+        # DTS rather than the PTS and it can be an arbitrary time before
+        # the actual keyframe.
+        #
+        # Note that while the delta in the packet stream is in time base units
+        # and doesn't necessarily line up with frames, we use frames here because
+        # we do all our maths in it. The math is done in fractions anyway to deal with
+        # NTSC, so no detail is lost
+        self.outKfDelta = None
+
+    def __repr__(self) -> str:
+        return f"<{type(self).__name__} of:{self.originalframe} delta:{self.positiondelta} dur:{self.duration} inframe:{self.inKeyframe} outframe:{self.outKeyframe}>"
+
+
+class original(segment):
+    pass
+
+
+class target(segment):
+    pass
+
+
+class reencode(segment):
+    pass
+
+
+# bounds for how often we ask resolve how the renders are going.
+# We start often and back off while nothing changes
+RENDER_POLL_MIN = 0.25
+RENDER_POLL_MAX = 5
+
+
+def waitForRender(project, jobs, names, onpoll=None):
+    """
+    waitForRender waits for resolve to finish rendering, printing the
+    progress of every job as it changes. onpoll gets the (status, percentage)
+    of every job every time we look.
+    """
+    interval = RENDER_POLL_MIN
+    progress = {}
+    while True:
+        rendering = project.IsRenderingInProgress()
+        changed = False
+        for j in jobs:
+            status = project.GetRenderJobStatus(j)
+            state = (status.get('JobStatus'), status.get('CompletionPercentage', 0))
+            if progress.get(j) != state:
+                progress[j] = state
+                changed = True
+                print(f"{names[j]}: {state[0]} {state[1]}%")
+        if onpoll is not None:
+            onpoll(progress)
+        if not rendering:
+            return
+
+        if changed:
+            interval = RENDER_POLL_MIN
+        else:
+            interval = min(interval*2, RENDER_POLL_MAX)
+        time.sleep(interval)
+
+
+class Report:
+    """
+    Report keeps track of where the time goes during a run: how long every
+    phase took, how often we called into resolve, how much ffmpeg read
+    and wrote, and how much memory we used. It gets written out as JSON at
+    the end of every run, so runs can be compared.
+
+    If profile is set, the python heavy phases are run under cProfile.
+    """
+    VERSION = 1
+
+    class span:
+        def __init__(self, name, start, python):
+            self.name = name
+            self.start = start
+            self.end = None
+            self.python = python
+
+    def __init__(self, profile=False):
+        self.started = time.time()
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.calls = {}
+        self.ffmpegruns = []
+        self.info = {}
+        self.error = None
+        self.lock = threading.Lock()
+        self.profiler = None
+        if profile:
+            self.profiler = cProfile.Profile()
+
+    def start(self, name, python=False):
+        """
+        start starts a span of the phase called name. Spans can overlap,
+        like the audio strip, which runs while resolve is rendering
+        """
+        sp = Report.span(name, time.perf_counter(), python)
+        self.spans.append(sp)
+        if python and self.profiler is not None:
+            self.profiler.enable()
+        return sp
+
+    def stop(self, sp):
+        sp.end = time.perf_counter()
+        if sp.python and self.profiler is not None:
+            self.profiler.disable()
+
+    @contextlib.contextmanager
+    def phase(self, name, python=False):
+        sp = self.start(name, python)
+        try:
+            yield sp
+        finally:
+            self.stop(sp)
+
+    def call(self, method, duration):
+        # timelines are fetched from several threads
+        with self.lock:
+            count, total = self.calls.get(method, (0, 0.0))
+            self.calls[method] = (count+1, total+duration)
+
+    def ffmpeg(self, name, inputs, output):
+        """
+        ffmpeg records the bytes an ffmpeg run read and wrote. We don't
+        know how much of every input ffmpeg actually read, so this counts
+        all of every input file.
+        """
+        def size(path):
+            try:
+                return os.path.getsize(path)
+            except OSError:
+                return 0
+        self.ffmpegruns.append({
+            "name": name,
+            "read": sum(size(p) for p in inputs),
+            "written": size(output),
+        })
+
+    def encode(self):
+        phases = {}
+        spans = []
+        now = time.perf_counter()
+        for sp in self.spans:
+            end = sp.end if sp.end is not None else now
+            phases[sp.name] = phases.get(sp.name, 0.0) + end - sp.start
+            spans.append({
+                "name": sp.name,
+                "start": sp.start - self.origin,
+                "duration": end - sp.start,
+            })
+        rss, childrss = peakRSS()
+        return {
+            "version": self.VERSION,
+            "started": datetime.datetime.fromtimestamp(self.started).isoformat(),
+            "wall": now - self.origin,
+            "error": self.error,
+            "info": self.info,
+            "phases": phases,
+            "spans": spans,
+            "resolve": {
+                "calls": sum(c for c, _ in self.calls.values()),
+                "time": sum(t for _, t in self.calls.values()),
+                "methods": {m: {"calls": c, "time": t} for m, (c, t) in sorted(self.calls.items())},
+            },
+            "ffmpeg": self.ffmpegruns,
+            "peakrss": rss,
+            "peakrsschildren": childrss,
+        }
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.encode(), f, indent=1)
+
+
+def countCalls(obj, report):
+    """
+    countCalls wraps a resolve object so that every method call on it, and on
+    any object we get back from it, is counted and timed in report
+    """
+    if obj is None or isinstance(obj, (str, int, float, bool, bytes, dict)):
+        return obj
+    if isinstance(obj, (list, tuple)):
+        return [countCalls(o, report) for o in obj]
+    return resolveProxy(obj, report)
+
+
+class resolveProxy:
+    __slots__ = ("obj", "report")
+
+    def __init__(self, obj, report):
+        self.obj = obj
+        self.report = report
+
+    def __getattr__(self, name):
+        method = getattr(self.obj, name)
+
+        def call(*args, **kwargs):
+            # resolve wants its own objects back, not our wrappers
+            args = [a.obj if isinstance(a, resolveProxy) else a for a in args]
+            start = time.perf_counter()
+            res = method(*args, **kwargs)
+            self.report.call(name, time.perf_counter() - start)
+            return countCalls(res, self.report)
+        return call
+
+
+def peakRSS():
+    """
+    peakRSS returns the peak resident set size in bytes of this process and
+    of the child processes we've waited for. Either can be None if we
+    can't tell on this platform.
+    """
+    if resource is not None:
+        # linux reports kilobytes, mac reports bytes
+        scale = 1 if sys.platform == "darwin" else 1024
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+    if sys.platform.startswith("win"):
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [
+                ("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD),
+                ("PeakWorkingSetSize", ctypes.c_size_t),
+                ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t),
+                ("PeakPagefileUsage", ctypes.c_size_t),
+            ]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        getinfo = ctypes.windll.psapi.GetProcessMemoryInfo
+        getinfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(
+            PROCESS_MEMORY_COUNTERS), wintypes.DWORD]
+        getprocess = ctypes.windll.kernel32.GetCurrentProcess
+        getprocess.restype = wintypes.HANDLE
+        handle = getprocess()
+        if getinfo(handle, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize, None
+    return None, None
+
+
+class FrameSeq:
+    """
+    FrameSeq is a run length encoded sequence of frame signatures. Every run
+    is a stretch of frames where every track shows the same item. Two runs
+    with the same signature show the same frames, starting from their first one.
+
+    sigs holds the 64 bit signature of every run, which stays the same between
+    runs of steenbeck. hashes holds the same signatures interned into small
+    ids by a SignatureTable, which is what diffing works on. FrameSeqs can
+    only be compared if they were made with the same table.
+    """
+
+    def __init__(self, sigs, lengths, table=None):
+        if table is None:
+            table = SignatureTable()
+        self.sigs = sigs
+        self.hashes = table.internall(sigs)
+        self.lengths = lengths
+        self.duration = sum(lengths)
+        self.runstarts = None
+
+    def starts(self):
+        """
+        starts returns the frame number that every run starts on
+        """
+        if self.runstarts is None:
+            self.runstarts = array('Q')
+            pos = 0
+            for l in self.lengths:
+                self.runstarts.append(pos)
+                pos += l
+        return self.runstarts
+
+    def span(self, start, duration):
+        """
+        span describes the frames from start to start+duration as a list of
+        (signature, offset into run, frame count) for every run it covers
+        """
+        out = []
+        starts = self.starts()
+        r = bisect.bisect_right(starts, start) - 1
+        end = start + duration
+        while start < end:
+            runend = starts[r] + self.lengths[r]
+            count = min(runend, end) - start
+            out.append((self.sigs[r], start - starts[r], count))
+            start += count
+            r += 1
+        return out
+
+    def __repr__(self) -> str:
+        return f"<FrameSeq runs:{len(self.hashes)} duration:{self.duration}>"
+
+
+class SignatureTable:
+    """
+    SignatureTable hands out a small id for every run signature it sees,
+    so that the diff compares ints rather than 64 bit signatures
+    """
+
+    def __init__(self):
+        self.ids = {}
+
+    def intern(self, sig):
+        return self.ids.setdefault(sig, len(self.ids))
+
+    def internall(self, sigs):
+        return array('I', map(self.intern, sigs))
+
+
+SIGMASK = (1 << 64) - 1
+# 2**64 divided by the golden ratio, multiplying by this spreads
+# small ints out over all 64 bits
+GOLDEN = 0x9e3779b97f4a7c15
+
+
+def mix64(x):
+    """
+    mix64 scrambles a 64 bit int, so that every input bit affects every
+    output bit. This is the splitmix64 finalizer
+    """
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & SIGMASK
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & SIGMASK
+    return x ^ (x >> 31)
+
+
+# how many tracks we ask resolve about at the same time. Resolve doesn't
+# say its scripting API can be called from more than one thread, and this
+# has only been tried against fake_resolve, so it's one unless asked for
+SNAPSHOT_THREADS = 1
+
+# stands for the name of items without media, like titles and generators,
+# in the inert properties
+CLIP_NAME = "Name"
+
+# item properties that can't change what the item looks like, along with
+# what they get hashed as instead of their value. Hashing them as their
+# default instead of leaving them out keeps the hash of every item that
+# doesn't touch them the same as it was before they were inert.
+#
+# Only properties that never make a difference to the render go in here.
+# Ones that only sometimes do are left for -inertprop:
+#  - CropRetain, DynamicZoomEase, RetimeProcess and MotionEstimation only
+#    do something with a crop, dynamic zoom or a retime, none of which we
+#    can always see from the properties
+#  - Scaling and ResizeFilter only do something when the media isn't the
+#    timeline resolution, which we don't ask about
+#  - the name is all there is to tell one generator from another
+INERT_PROPERTIES = {
+    # links ZoomX and ZoomY in the inspector, both of which get hashed
+    "ZoomGang": True,
+}
+
+
+def inertProperties(inert=(), render=()):
+    """
+    inertProperties returns the properties to hash as a fixed value, see
+    INERT_PROPERTIES: the defaults and the ones in inert, without the ones in
+    render. Ones in inert that aren't inert by default get hashed as None.
+    """
+    props = dict(INERT_PROPERTIES)
+    for p in inert or ():
+        props.setdefault(p, None)
+    for p in render or ():
+        props.pop(p, None)
+    return props
+
+
+class item:
+    """
+    item is what we know about a timeline item, copied out of resolve.
+    sourcestartframe, sourceendframe and the name of items without media
+    are only fetched if the signature cache doesn't already know the hash
+    of the item
+    """
+    __slots__ = ("key", "start", "end", "leftoffset", "props", "name",
+                 "sourcestartframe", "sourceendframe", "fps")
+
+    def __init__(self, start, end, leftoffset, props):
+        self.start = start
+        self.end = end
+        self.leftoffset = leftoffset
+        self.props = props
+        # anything that would change the hash of the item changes one of
+        # these, the media or its frame rate. Slipping the clip changes
+        # the left offset
+        self.key = None
+        self.name = None
+        self.sourcestartframe = None
+        self.sourceendframe = None
+        # frame rate of the media, as resolve reports it
+        self.fps = None
+
+
+class timelineSnapshot:
+    """
+    timelineSnapshot is a copy of everything we need from a timeline, so that
+    hashing doesn't need to go back to resolve
+    """
+
+    def __init__(self, uniqueid, startframe, endframe, framerate):
+        self.uniqueid = uniqueid
+        self.startframe = startframe
+        self.endframe = endframe
+        self.framerate = framerate
+        # track type to a list of items for every track
+        self.tracks = {}
+        # track type to what the signature cache had for it
+        self.cached = {}
+        # track type to item key to (hash, source position, rate) for
+        # every item, filled in by calculateFrameSeqs
+        self.memo = {}
+        # the inert properties the items were hashed with, or None if we
+        # don't know, see inertProperties
+        self.inert = None
+
+    def state(self):
+        """
+        state returns a hash that changes whenever anything we know about
+        the timeline changes
+        """
+        state = hashlib.sha256(marshal.dumps(
+            (self.startframe, self.endframe, sorted(self.tracks))), usedforsecurity=False)
+        for tracktype in sorted(self.tracks):
+            for items in self.tracks[tracktype]:
+                state.update(struct.pack("<I", len(items)))
+                for rec in items:
+                    state.update(rec.key)
+        return state.digest()
+
+
+def snapshotTimelines(timelines, cache=None, tracktypes=('video',), threads=SNAPSHOT_THREADS,
+                      inert=INERT_PROPERTIES):
+    """
+    snapshotTimelines returns a timelineSnapshot for every timeline.
+    Properties in inert are copied as the value they are hashed as, so
+    changing them doesn't change the snapshot.
+
+    Every call into resolve is a round trip to another process, so with
+    threads above one, the tracks of all the timelines are fetched at the
+    same time from a pool of that many threads.
+    """
+    snapshots = []
+    fetches = []
+    # media id to frame rate, most media shows up more than once
+    clipfps = {}
+    for tl in timelines:
+        snap = timelineSnapshot(tl.GetUniqueId(), tl.GetStartFrame(), tl.GetEndFrame(),
+                                parseFrameRate(tl.GetSetting("timelineFrameRate")))
+        snap.inert = inert
+        snapshots.append(snap)
+        for tracktype in tracktypes:
+            cached = None
+            if cache is not None:
+                cached = cache.load(cacheId(snap.uniqueid, tracktype))
+            snap.cached[tracktype] = cached
+            known = cached.items if cached is not None else {}
+            trackcount = tl.GetTrackCount(tracktype)
+            snap.tracks[tracktype] = [None] * trackcount
+            for tc in range(1, trackcount+1):
+                fetches.append((snap, tl, tracktype, tc, known))
+
+    def fetch(snap, tl, tracktype, tc, known):
+        snap.tracks[tracktype][tc-1] = snapshotTrack(
+            tl, tracktype, tc, snap.startframe, known, clipfps, inert)
+
+    if threads <= 1:
+        for f in fetches:
+            fetch(*f)
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for res in [pool.submit(fetch, *f) for f in fetches]:
+                res.result()
+    return snapshots
+
+
+def snapshotTrack(timeline, tracktype, tc, startframe, known, clipfps, inert=INERT_PROPERTIES):
+    """
+    snapshotTrack copies the items on a track out of resolve. Items that
+    are in known only get asked about what goes into their key
+    """
+    items = []
+    for it in timeline.GetItemListInTrack(tracktype, tc):
+        # Get all the properties about this timeline item that we can find
+        # This will be hashed together with the other items covering
+        # the same frames
+        props = it.GetProperty()
+        # I don't think resolve will give out dicts in random order
+        # but let's be safe
+        props = dict(sorted(props.items()))
+        # inert properties go into the key as what they are hashed as, so
+        # changing one of them doesn't even make us hash the item again
+        props = {k: inert[k] if k in inert else v for k, v in props.items()}
+        rec = item(it.GetStart() - startframe, it.GetEnd() - startframe,
+                   it.GetLeftOffset(False), props)
+        # replacing or relinking a clip, or changing what frame rate resolve
+        # takes its media to be, keeps the item and everything about it on the
+        # timeline the same, so the media goes into the key too
+        mpi = it.GetMediaPoolItem()
+        if mpi is not None:
+            rec.name = mpi.GetMediaId()
+            if rec.name not in clipfps:
+                clipfps[rec.name] = mpi.GetClipProperty("FPS")
+            rec.fps = clipfps[rec.name]
+        keyed = (tc, it.GetUniqueId(), rec.start, rec.end, rec.leftoffset, props, rec.name, rec.fps)
+        if CLIP_NAME in inert:
+            # the name isn't in the key, but it is in the hash of items
+            # without media, so cached hashes can't be shared with runs
+            # that do hash it
+            keyed += (CLIP_NAME, inert[CLIP_NAME])
+        rec.key = hashlib.sha256(marshal.dumps(keyed), usedforsecurity=False).digest()
+
+        if rec.key not in known:
+            if mpi is None:
+                rec.name = it.GetName()
+                if CLIP_NAME in inert:
+                    rec.name = inert[CLIP_NAME]
+            rec.sourcestartframe = it.GetSourceStartFrame()
+            rec.sourceendframe = it.GetSourceEndFrame()
+        items.append(rec)
+    return items
+
+
+def cacheId(timelineid, tracktype):
+    if tracktype == 'video':
+        return timelineid
+    return f"{timelineid}/{tracktype}"
+
+
+def calculateFrameSeq(snapshot, cache=None, tracktype='video', table=None):
+    """
+    calculateFrameSeq returns a FrameSeq for the tracks of tracktype in a
+    single timelineSnapshot. See calculateFrameSeqs.
+    """
+    return calculateFrameSeqs([snapshot], cache, tracktype, table)[0]
+
+
+def calculateFrameSeqs(snapshots, cache=None, tracktype='video', table=None):
+    """
+    calculateFrameSeqs returns a FrameSeq for the tracks of tracktype in
+    every timelineSnapshot. For audio, a run is a stretch where the same
+    items are heard instead of seen. FrameSeqs that are going to be diffed
+    against each other need to share a SignatureTable.
+
+    Runs are cut wherever an item in any of the snapshots starts or ends in
+    the source media, so that a trimmed or slipped clip lines up with the
+    runs of the clip it was made from. Every snapshot gets cut at the same
+    source positions, otherwise an item that didn't change could end up cut
+    differently in two timelines.
+
+    If a SignatureCache is given, the hashes of items that haven't changed
+    since the last time we saw this timeline are reused, and if nothing
+    changed, the FrameSeq is loaded as is.
+    """
+    if table is None:
+        table = SignatureTable()
+    resolved = [trackItems(snap, tracktype) for snap in snapshots]
+
+    # every item start and end is a place where the picture might change
+    itemcuts = []
+    for snap, (tracks, _) in zip(snapshots, resolved):
+        cuts = {0, snap.endframe - snap.startframe}
+        for trackitems in tracks:
+            for start, end, *_ in trackitems:
+                cuts.add(start)
+                cuts.add(end)
+        itemcuts.append(cuts)
+    allcuts = alignTimelines([tracks for tracks, _ in resolved], itemcuts)
+
+    out = []
+    for snap, (tracks, newmemo), cuts, aligned in zip(snapshots, resolved, itemcuts, allcuts):
+        snap.memo[tracktype] = newmemo
+        tlduration = snap.endframe - snap.startframe
+        aligned = aligned - cuts
+
+        state = hashlib.sha256(marshal.dumps(
+            (snap.startframe, tlduration, sorted(aligned))), usedforsecurity=False)
+        for items in snap.tracks[tracktype]:
+            for rec in items:
+                state.update(rec.key)
+        state = state.digest()
+
+        cached = snap.cached.get(tracktype)
+        if cached is not None and cached.state == state:
+            out.append(FrameSeq(cached.frames.sigs, cached.frames.lengths, table))
+            continue
+
+        frames = sweepTracks(tracks, sorted(cuts | aligned), table)
+        if cache is not None:
+            cache.save(cacheId(snap.uniqueid, tracktype), SignatureCache.entry(
+                state, frames, newmemo))
+        out.append(frames)
+    return out
+
+
+def trackItems(snapshot, tracktype):
+    """
+    trackItems returns the items on every track of tracktype as sorted
+    lists of (start, end, signature, source position, rate), clipped to the
+    timeline, along with the item memo for the signature cache.
+
+    The source position is where in the media the item starts, in media
+    frames, and rate is how many media frames go by for every timeline frame.
+    Both are exact, NTSC rates and all. Items we can't map onto their media
+    get a source position of 0 and a rate of 1, with the source frame
+    going into their signature instead.
+    """
+    tlduration = snapshot.endframe - snapshot.startframe
+    cached = snapshot.cached.get(tracktype)
+    itemmemo = {}
+    if cached is not None:
+        itemmemo = cached.items
+    newmemo = {}
+
+    tracks = []
+    for items in snapshot.tracks[tracktype]:
+        trackitems = []
+        for rec in items:
+            memo = itemmemo.get(rec.key)
+            if memo is None:
+                memo = hashItem(rec, snapshot.framerate)
+            newmemo[rec.key] = memo
+            itemhash, srcstart, rate = memo
+            itemsig = int.from_bytes(itemhash[:8], "little")
+
+            start = max(rec.start, 0)
+            end = min(rec.end, tlduration)
+            if start >= end:
+                continue
+            srcstart += (start - rec.start) * rate
+            trackitems.append((start, end, itemsig, srcstart, rate))
+
+        trackitems.sort()
+        tracks.append(trackitems)
+    return tracks, newmemo
+
+
+def alignTimelines(timelines, cuts):
+    """
+    alignTimelines returns the cuts of every one of timelines, along with
+    the ones it takes to line their runs up with the other timelines.
+
+    Runs only match if they start on the same source position, so wherever
+    a cut goes through an item, whether it comes from the item itself or
+    from something on another track, every item with the same content gets
+    cut at that source position too, in all of the timelines. Otherwise
+    putting a title over a clip would make the rest of the clip under it
+    start on a source position the other timeline doesn't have a run for.
+
+    This is done once. The cuts it adds go through items on other tracks
+    as well, but pushing those around again only chops the runs up finer.
+    The diff counts matched runs, not frames, so on synthetic edits that
+    makes it render more, where a single pass renders as much as diffing
+    frame by frame would.
+    """
+    sortedcuts = [sorted(c) for c in cuts]
+    boundaries = sourceBoundaries(timelines, sortedcuts)
+    cuts = [set(c) for c in cuts]
+    for tracks, tlcuts in zip(timelines, cuts):
+        alignCuts(tracks, boundaries, tlcuts)
+    return cuts
+
+
+def sourceBoundaries(timelines, cuts):
+    """
+    sourceBoundaries returns, for every item signature, the sorted source
+    positions where a run starts or ends on an item with that signature on
+    the tracks of any of the timelines. cuts holds the sorted cuts of
+    every timeline, item starts and ends included.
+    """
+    bounds = {}
+    for tracks, tlcuts in zip(timelines, cuts):
+        for trackitems in tracks:
+            for start, end, itemsig, srcstart, rate in trackitems:
+                b = bounds.setdefault(itemsig, set())
+                lo = bisect.bisect_left(tlcuts, start)
+                hi = bisect.bisect_right(tlcuts, end)
+                for c in tlcuts[lo:hi]:
+                    b.add(srcstart + (c - start) * rate)
+    return {sig: sorted(b) for sig, b in bounds.items()}
+
+
+def alignCuts(tracks, boundaries, cuts):
+    """
+    alignCuts adds a cut to cuts wherever one of the items in tracks passes
+    over a source position in boundaries. Positions that fall between two
+    timeline frames, like they do when the media has a higher frame rate,
+    can't be lined up with anything and are skipped.
+    """
+    for trackitems in tracks:
+        for start, end, itemsig, srcstart, rate in trackitems:
+            bs = boundaries.get(itemsig)
+            if bs is None:
+                continue
+            lo = bisect.bisect_right(bs, srcstart)
+            hi = bisect.bisect_left(bs, srcstart + (end - start) * rate)
+            for pos in bs[lo:hi]:
+                offset = pos - srcstart
+                if rate != 1:
+                    offset = fractions.Fraction(offset) / rate
+                if offset.denominator == 1:
+                    cuts.add(start + int(offset))
+
+
+def sweepTracks(tracks, cuts, table):
+    """
+    sweepTracks turns the items in tracks into a FrameSeq with a run
+    between every pair of cuts
+    """
+    # sweep over the cut points, keeping track of which item is
+    # visible on every track. An item can show up in several runs if something
+    # on another track cuts it up, so mix in where in the media the run starts.
+    # Gaps just don't contribute to the signature.
+    # The item hashes are already good hashes, so rather than hashing again,
+    # the first 64 bits of them are folded together with mix64
+    cursors = [0] * len(tracks)
+    sigs = array('Q')
+    lengths = array('Q')
+    for lo, hi in zip(cuts, cuts[1:]):
+        sig = 0
+        for tc, trackitems in enumerate(tracks):
+            c = cursors[tc]
+            while c < len(trackitems) and trackitems[c][1] <= lo:
+                c += 1
+            cursors[tc] = c
+            if c < len(trackitems) and trackitems[c][0] <= lo:
+                start, _, itemsig, srcstart, rate = trackitems[c]
+                pos = srcstart + (lo - start) * rate
+                where = (tc << 40) ^ pos.numerator
+                if pos.denominator != 1:
+                    where = mix64(where ^ (pos.denominator << 20))
+                sig = mix64(sig ^ itemsig ^ ((where * GOLDEN) & SIGMASK))
+
+        sigs.append(sig)
+        lengths.append(hi - lo)
+
+    return FrameSeq(sigs, lengths, table)
+
+
+def audioLayout(timeline):
+    """
+    audioLayout returns the kind of every audio track in the timeline,
+    mono, stereo, 5.1 and so on
+    """
+    return [timeline.GetTrackSubType('audio', tc)
+            for tc in range(1, timeline.GetTrackCount('audio')+1)]
+
+
+def audioSpans(originalAudio, targetAudio, mergegap):
+    """
+    audioSpans lines the audio of the target timeline up with the original.
+    It returns a list of (original frame, target frame, duration) covering
+    the target, where original frame is None for spans that need rendering.
+    Reused spans of mergegap frames or less between two rendered
+    spans are rendered as well, so that we don't start a job for every word.
+    """
+    spans = []
+
+    def add(ostart, tstart, duration):
+        if spans:
+            po, pt, pd = spans[-1]
+            if po is None and ostart is None:
+                spans[-1] = (po, pt, pd+duration)
+                return
+            if po is not None and ostart is not None and po+pd == ostart and pt+pd == tstart:
+                spans[-1] = (po, pt, pd+duration)
+                return
+        spans.append((ostart, tstart, duration))
+
+    # same walk as for the video
+    pairs = heaviestcommonpairs(originalAudio.hashes, targetAudio.hashes,
+                                originalAudio.lengths, targetAudio.lengths)
+    ostarts = originalAudio.starts()
+    tstarts = targetAudio.starts()
+    j = 0
+    for ri, rj in pairs:
+        ostart, tstart = ostarts[ri], tstarts[rj]
+        if tstart > j:
+            add(None, j, tstart-j)
+        common = min(originalAudio.lengths[ri], targetAudio.lengths[rj])
+        add(ostart, tstart, common)
+        if targetAudio.lengths[rj] > common:
+            add(None, tstart+common, targetAudio.lengths[rj]-common)
+        j = tstart + targetAudio.lengths[rj]
+    if j < targetAudio.duration:
+        add(None, j, targetAudio.duration-j)
+
+    merged = []
+    for s in spans:
+        if s[0] is None and len(merged) > 1 and merged[-2][0] is None and merged[-1][2] <= mergegap:
+            gap = merged.pop()
+            _, tstart, duration = merged.pop()
+            merged.append((None, tstart, duration + gap[2] + s[2]))
+            continue
+        merged.append(s)
+    return merged
+
+
+def audioFilter(spans, samplerate, framerate, reference, firstrender, stream=0):
+    """
+    audioFilter returns an ffmpeg filter graph that splices the reference
+    audio and the rendered spans together into [aout<stream>]. Rendered
+    spans are expected as inputs numbered from firstrender, in order, and
+    audio stream number stream of every one of them is used.
+
+    Cuts are made on samples, not frames. Frame boundaries for NTSC rates
+    fall between samples, so every boundary is rounded down the same way
+    and the spans add up to exactly the length of the timeline.
+    """
+    def sample(frame):
+        return math.floor(frame * samplerate / framerate)
+
+    reused = sum(1 for s in spans if s[0] is not None)
+    lines = []
+    if reused:
+        outs = "".join(f"[ref{stream}_{k}]" for k in range(reused))
+        lines.append(f"[{reference}]asplit={reused}{outs}")
+    labels = []
+    k = 0
+    r = firstrender
+    for i, (ostart, tstart, duration) in enumerate(spans):
+        count = sample(tstart+duration) - sample(tstart)
+        if ostart is not None:
+            first = sample(ostart)
+            lines.append(
+                f"[ref{stream}_{k}]atrim=start_sample={first}:end_sample={first+count},asetpts=PTS-STARTPTS[a{stream}_{i}]")
+            k += 1
+        else:
+            # resolve doesn't have to agree with us on how many samples
+            # go into the frames it rendered. Pad or cut to what we need
+            lines.append(
+                f"[{r}:a:{stream}]aresample={samplerate},apad=whole_len={count},atrim=end_sample={count},asetpts=PTS-STARTPTS[a{stream}_{i}]")
+            r += 1
+        labels.append(f"[a{stream}_{i}]")
+    lines.append(f"{''.join(labels)}concat=n={len(spans)}:v=0:a=1[aout{stream}]")
+    return ";\n".join(lines)
+
+
+def hashItem(rec, framerate):
+    """
+    hashItem returns (hash, source position, rate) for a timeline item, see
+    trackItems. The hash covers everything that decides what frames the
+    item shows, other than where in the media it starts.
+    """
+    frame = rec.sourcestartframe
+    if frame is not None:
+        # davinci will return 0 for both the first frame of the source
+        # and the frame after that. This makes the frame math infuriatingly
+        # special cased. The way to determine if we're inserting from the first
+        # frame is to see if we have any offset available on the left. This
+        # might be bounded by a transition overlay, but for this case, we can
+        # assume that no one is doing transitions on the absolutely first frame
+        # on of a clip
+        if frame == 0 and rec.leftoffset != 0:
+            frame += 1
+
+    # map timeline frames onto media frames. This used to go wrong whenever
+    # the media and the timeline framerate didn't match, so the rates are
+    # kept as exact fractions. Resolve doesn't tell us about retimes, so we
+    # check that the item covers as much of the media as the rates say it
+    # should. If it doesn't, or we don't know the rates, fall back to
+    # treating every frame of the item as its own.
+    clipfps = parseFrameRate(rec.fps)
+    srcstart, rate = 0, 1
+    if frame is not None and clipfps is not None and framerate is not None and rec.sourceendframe is not None:
+        r = clipfps / framerate
+        if r.denominator == 1:
+            r = int(r)
+        if abs(rec.sourceendframe - (frame + (rec.end - rec.start) * r)) <= 1:
+            srcstart, rate = frame, r
+            frame = None
+
+    # I know I'm not supposed to use marshal, but this is just a convenient
+    # binary representation of a dictionary
+    hashdata = marshal.dumps({
+        "name": rec.name,
+        "props": rec.props,
+        "frame": frame,
+        "rate": (rate.numerator, rate.denominator),
+    })
+    return hashlib.sha256(hashdata, usedforsecurity=False).digest(), srcstart, rate
+
+
+def parseFrameRate(rate):
+    """
+    parseFrameRate turns a frame rate the way resolve reports it, like "25"
+    or "29.97 DF", into an exact Fraction. Resolve rounds NTSC rates, so
+    anything close to one gets snapped onto its n*1000/1001 value.
+    Returns None if rate isn't a frame rate.
+    """
+    if rate is None:
+        return None
+    try:
+        f = fractions.Fraction(str(rate).split()[0])
+    except (ValueError, IndexError, ZeroDivisionError):
+        return None
+    if f <= 0:
+        return None
+    if f.denominator != 1:
+        ntsc = fractions.Fraction(round(f * 1001 / 1000) * 1000, 1001)
+        if abs(ntsc - f) < fractions.Fraction(1, 100):
+            return ntsc
+    return f
+
+
+def exactFraction(numerator, denominator):
+    """
+    exactFraction returns numerator/denominator, as an int if it is one
+    """
+    if denominator == 1:
+        return numerator
+    return fractions.Fraction(numerator, denominator)
+
+
+class SignatureCache:
+    """
+    SignatureCache keeps the FrameSeq of every timeline we've seen on disk,
+    along with the hash of every item in it, so that later runs can skip
+    hashing the parts of the timeline that haven't changed.
+
+    Every timeline gets one file, named after its unique id.
+    """
+    MAGIC = b"STBKSIG3"
+    # key, hash, source position and rate of an item
+    ITEM = struct.Struct("<32s32sqqqq")
+
+    class entry:
+        def __init__(self, state, frames, items):
+            # hash over the keys of every item, if this matches, frames can
+            # be used as is
+            self.state = state
+            self.frames = frames
+            # item key to (hash, source position, rate), see hashItem
+            self.items = items
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, timelineid):
+        name = hashlib.sha256(timelineid.encode(), usedforsecurity=False).hexdigest()
+        return os.path.join(self.directory, f"{name[:32]}.sig")
+
+    def load(self, timelineid):
+        try:
+            with open(self.path(timelineid), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+
+        # a corrupt or old cache file just means we do the work again
+        try:
+            return self.decode(data)
+        except (struct.error, ValueError):
+            return None
+
+    def save(self, timelineid, entry):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(timelineid)
+        tmppath = f"{path}.{os.getpid()}.tmp"
+        with open(tmppath, "wb") as f:
+            f.write(self.encode(entry))
+        os.replace(tmppath, path)
+
+    def encode(self, entry):
+        frames = entry.frames
+        out = [self.MAGIC, entry.state, struct.pack("<I", len(frames.sigs))]
+        for arr in (frames.sigs, frames.lengths):
+            arr = array('Q', arr)
+            if sys.byteorder != "little":
+                arr.byteswap()
+            out.append(arr.tobytes())
+        out.append(struct.pack("<I", len(entry.items)))
+        for key, (hash, srcstart, rate) in entry.items.items():
+            srcstart = fractions.Fraction(srcstart)
+            rate = fractions.Fraction(rate)
+            out.append(self.ITEM.pack(key, hash, srcstart.numerator, srcstart.denominator,
+                                      rate.numerator, rate.denominator))
+        return b"".join(out)
+
+    def decode(self, data):
+        if data[:8] != self.MAGIC:
+            raise ValueError("not a signature file")
+        pos = 8
+        state = data[pos:pos+32]
+        pos += 32
+        (nruns,) = struct.unpack_from("<I", data, pos)
+        pos += 4
+        sigs = array('Q')
+        lengths = array('Q')
+        for arr in (sigs, lengths):
+            arr.frombytes(data[pos:pos+8*nruns])
+            if sys.byteorder != "little":
+                arr.byteswap()
+            pos += 8*nruns
+        (nitems,) = struct.unpack_from("<I", data, pos)
+        pos += 4
+        items = {}
+        for _ in range(nitems):
+            key, hash, srcnum, srcden, ratenum, rateden = self.ITEM.unpack_from(data, pos)
+            if srcden <= 0 or rateden <= 0:
+                raise ValueError("bad item in signature file")
+            items[key] = (hash, exactFraction(srcnum, srcden), exactFraction(ratenum, rateden))
+            pos += self.ITEM.size
+        if pos != len(data) or len(sigs) != nruns or len(lengths) != nruns:
+            raise ValueError("truncated signature file")
+        return SignatureCache.entry(state, FrameSeq(sigs, lengths), items)
+
+
+class GlueCache:
+    """
+    GlueCache keeps rendered glue around between runs, so that re-rendering
+    the same insert shot in a later version of the timeline is free.
+
+    Glue is stored under a key made from the frame signatures it covers and the
+    render settings. Every file has a checksum file next to it, which is
+    checked before the glue is used. When the cache grows beyond its size
+    limit, the least recently used glue is thrown out.
+    """
+
+    def __init__(self, directory, maxsize):
+        self.directory = directory
+        self.maxsize = maxsize
+
+    @staticmethod
+    def key(span, salt):
+        hash = hashlib.sha256(salt, usedforsecurity=False)
+        for sig, offset, count in span:
+            hash.update(struct.pack("<QQQ", sig, offset, count))
+        return hash.hexdigest()
+
+    def lookup(self, key, ext):
+        """
+        lookup returns the path to the glue with key, or None if we don't
+        have it or it has been damaged
+        """
+        path = os.path.join(self.directory, f"{key}{ext}")
+        try:
+            with open(f"{path}.sum") as f:
+                sum = f.read().strip()
+        except FileNotFoundError:
+            return None
+
+        if not os.path.exists(path) or fileChecksum(path) != sum:
+            print(f"dropping damaged glue {path}")
+            self.remove(path)
+            return None
+
+        # bump the modification time, this is what we use for eviction
+        os.utime(path)
+        return path
+
+    def contains(self, key, ext):
+        """
+        contains says if we have the glue with key, without checking or
+        touching it
+        """
+        path = os.path.join(self.directory, f"{key}{ext}")
+        return os.path.exists(path) and os.path.exists(f"{path}.sum")
+
+    def store(self, key, src):
+        """
+        store moves the glue at src into the cache and returns its new path
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        _, ext = os.path.splitext(src)
+        path = os.path.join(self.directory, f"{key}{ext}")
+        sum = fileChecksum(src)
+        shutil.move(src, path)
+        with open(f"{path}.sum", "w") as f:
+            f.write(sum)
+        return path
+
+    def remove(self, path):
+        for p in (path, f"{path}.sum"):
+            try:
+                os.remove(p)
+            except FileNotFoundError:
+                pass
+
+    def evict(self):
+        """
+        evict removes the least recently used glue until the cache
+        fits within its size limit
+        """
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+
+        files = []
+        total = 0
+        for name in names:
+            if name.endswith(".sum"):
+                continue
+            path = os.path.join(self.directory, name)
+            st = os.stat(path)
+            files.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        files.sort()
+        for _, size, path in files:
+            if total <= self.maxsize:
+                break
+            self.remove(path)
+            total -= size
 
-    class target(segment):
-        pass
 
-    segments = []
-    s, i, j = 0, 0, 0
+def fileChecksum(path):
+    hash = hashlib.sha256(usedforsecurity=False)
+    with open(path, "rb") as f:
+        while chunk := f.read(1 << 20):
+            hash.update(chunk)
+    return hash.hexdigest()
+
+
+def concatQuote(path):
+    """
+    concatQuote quotes a path for the concat demuxer. Inside single quotes,
+    everything is taken literally, so only the quote itself needs escaping
+    """
+    return "'" + path.replace("'", "'\\''") + "'"
+
+
+def defaultCacheDir():
+    if sys.platform.startswith("win"):
+        base = os.getenv("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+        base = os.getenv("XDG_CACHE_HOME", os.path.join(
+            os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "steenbeck")
 
-    def sequenceleft():
-        return s < len(lcs) or i < len(originalFrames) or j < len(targetFrames)
 
-    def noneindex(arr, idx):
-        if idx >= len(arr):
+class KeyframeIndex:
+    """
+    KeyframeIndex holds the timestamps of every keyframe in a video stream,
+    sorted by presentation timestamp. Alongside the timestamps, we keep the
+    frame number of every keyframe, so that looking up cut points is
+    integer bisection. For a file, it holds the frames we can cut on,
+    see commonKeyframes.
+    """
+    MAGIC = b"STBKKFI2"
+    HEADER = struct.Struct("<8sQq32sqqqqqQ")
+
+    def __init__(self, timebase, framerate, durationts):
+        self.timebase = timebase
+        self.framerate = framerate
+        self.durationts = durationts
+
+        self.pts = array('q')
+        self.dts = array('q')
+        self.duration = array('q')
+        self.flags = bytearray()
+        self.frames = array('q')
+
+    def ptsperframe(self):
+        return (1/self.framerate)/self.timebase
+
+    def ptsToFrame(self, pts):
+        framenum, rem = divmod(pts, self.ptsperframe())
+        if rem != 0:
+            raise Exception(f"keyframe at pts {pts} is not on a frame boundary")
+        return int(framenum)
+
+    def endframe(self):
+        return self.ptsToFrame(self.durationts)
+
+    def add(self, pkt):
+        """
+        add adds a keyframe packet to the index. Packets come in decode order,
+        which is nearly always presentation order for keyframes, and reading
+        overlapping intervals can give us the same packet twice
+        """
+        k = bisect.bisect_left(self.pts, pkt.pts)
+        if k < len(self.pts) and self.pts[k] == pkt.pts:
+            return
+        self.pts.insert(k, pkt.pts)
+        self.dts.insert(k, pkt.dts)
+        self.duration.insert(k, pkt.duration)
+        self.flags.insert(k, pkt.flags)
+        self.frames.insert(k, self.ptsToFrame(pkt.pts))
+
+    def findnext(self, framenum):
+        """
+        findnext returns the position of the first keyframe at or after framenum
+        """
+        k = bisect.bisect_left(self.frames, framenum)
+        if k == len(self.frames):
+            return None
+        return k
+
+    def findprev(self, framenum):
+        """
+        findprev returns the position of the last keyframe before framenum
+        """
+        k = bisect.bisect_left(self.frames, framenum) - 1
+        if k < 0:
+            return None
+        return k
+
+    def encode(self, size, mtime, contenthash):
+        header = self.HEADER.pack(
+            self.MAGIC, size, mtime, contenthash,
+            self.timebase.numerator, self.timebase.denominator,
+            self.framerate.numerator, self.framerate.denominator,
+            self.durationts, len(self.pts))
+        out = [header]
+        for arr in (self.pts, self.dts, self.duration):
+            arr = array('q', arr)
+            if sys.byteorder != "little":
+                arr.byteswap()
+            out.append(arr.tobytes())
+        out.append(bytes(self.flags))
+        return b"".join(out)
+
+    @classmethod
+    def decode(cls, data, size, mtime, contenthash):
+        """
+        decode returns the index stored in data, or None if it does not
+        belong to the file described by size, mtime and contenthash
+        """
+        (magic, isize, imtime, ihash, tbn, tbd, frn, frd,
+         durationts, count) = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or (isize, imtime, ihash) != (size, mtime, contenthash):
+            return None
+        if len(data) != cls.HEADER.size + 25*count:
             return None
-        else:
-            return arr[idx]
-
-    while sequenceleft():
-        # walk sequences until we don't match
-        oldi = i
-        while sequenceleft() and noneindex(lcs, s) == noneindex(originalFrames, i) == noneindex(targetFrames, j):
-            s += 1
-            i += 1
-            j += 1
-        if oldi != i:
-            segments.append(original(oldi, j-i, i-oldi))
-
-        if not sequenceleft():
-            break
-
-        # this is an insertion, walk target frames until we
-        # match and emit a target segment
-        if noneindex(lcs, s) != noneindex(targetFrames, j):
-            oldj = j
-            while noneindex(lcs, s) != noneindex(targetFrames, j):
-                j += 1
-            segments.append(target(oldj, 0, j-oldj))
-
-        # deletion, walk until we match up again
-        if noneindex(lcs, s) != noneindex(originalFrames, i):
-            while noneindex(lcs, s) != noneindex(originalFrames, i):
-                i += 1
-
-    dumpsegments("segment list before keyframe search", segments)
 
-    # for every segment, find the keyframe after its in point and the one before it's out point
-    # these will act as "handles" when we start gluing segments together
-    inKeyframe = {}
-    outKeyframe = {}
-    for s in segments:
-        # target segments do not have keyframes at their entry or exit
-        # rely on them being next to original segments that do
-        if isinstance(s, target):
-            continue
+        index = cls(fractions.Fraction(tbn, tbd),
+                    fractions.Fraction(frn, frd), durationts)
+        pos = cls.HEADER.size
+        for arr in (index.pts, index.dts, index.duration):
+            arr.frombytes(data[pos:pos+8*count])
+            if sys.byteorder != "little":
+                arr.byteswap()
+            pos += 8*count
+        index.flags = bytearray(data[pos:pos+count])
+        index.frames = array('q', (index.ptsToFrame(pts) for pts in index.pts))
+        return index
 
-        inKeyframe[s.originalframe] = s
-        outframe = s.originalframe+s.duration
-        if outframe < len(originalFrames):
-            outKeyframe[outframe] = s
-        else:
-            s.outKeyframe = outframe
-            s.outKfDelta = 0
 
-    # construct an interval string for ffmpeg.
-    # Seeking will give us the first keyframe previous to the seek point.
-    # 100 frames after is a guess for when we will see a keyframe again.
-    framerate = targetTimeline.GetSetting("timelineFrameRate")
-    intervals = []
-    for i in inKeyframe:
-        second = i/framerate
-        intervals.append(f"{second}%+#100")
-    for i in outKeyframe:
-        second = i/framerate
-        intervals.append(f"{second}%+#100")
-    intervalstr = ",".join(intervals)
-
-    # invoke ffmpeg to find out where the keyframes are
-    command = [
-        "ffprobe",
-        "-print_format", "json",
-        "-select_streams", "v:0",
-        "-show_streams",
-        "-show_packets",
-        "-read_intervals", intervalstr,
-        "-i", args.f
-    ]
-    res = subprocess.run(command, capture_output=True)
-    ffprobeoutput = json.loads(res.stdout)
-    packets = ffprobeoutput["packets"]
-    # TODO(dmo): figure out more complex streams
-    stream = ffprobeoutput["streams"][0]
+def fileContentHash(path, size):
+    """
+    fileContentHash hashes the start and end of a file. This is not meant to
+    catch every change, just files being replaced with ones that happen to
+    have the same size and modification time.
+    """
+    chunk = 1 << 20
+    hash = hashlib.sha256(struct.pack("<Q", size), usedforsecurity=False)
+    with open(path, "rb") as f:
+        hash.update(f.read(chunk))
+        if size > chunk:
+            f.seek(max(chunk, size-chunk))
+            hash.update(f.read(chunk))
+    return hash.digest()
+
 
-    # dedupe all the packets, sort by presentation timestamp
-    bypts = {}
-    for i in packets:
-        bypts[i["pts"]] = i
-    packets = sorted(list(bypts.values()), key=lambda x: x["pts"])
+def loadKeyframeIndex(path, streams=None):
+    """
+    loadKeyframeIndex returns the KeyframeIndex for the video file at path,
+    reading it from the sidecar file next to it if one exists and is for
+    the same file. Otherwise, we probe the file and write a new sidecar.
+    streams is what probeStreams says about the file, if we already know.
+    """
+    st = os.stat(path)
+    contenthash = fileContentHash(path, st.st_size)
+    sidecar = f"{path}.stbkidx"
+    try:
+        with open(sidecar, "rb") as f:
+            index = KeyframeIndex.decode(
+                f.read(), st.st_size, st.st_mtime_ns, contenthash)
+        if index is not None:
+            return index
+    except (FileNotFoundError, struct.error):
+        pass
+
+    index = probeKeyframeIndex(path, streams)
+    saveKeyframeIndex(path, index, st, contenthash)
+    return index
 
+
+def saveKeyframeIndex(path, index, st=None, contenthash=None):
+    """
+    saveKeyframeIndex writes the sidecar file for the video file at path
+    """
+    if st is None:
+        st = os.stat(path)
+        contenthash = fileContentHash(path, st.st_size)
+    sidecar = f"{path}.stbkidx"
+    try:
+        tmppath = f"{sidecar}.{os.getpid()}.tmp"
+        with open(tmppath, "wb") as f:
+            f.write(index.encode(st.st_size, st.st_mtime_ns, contenthash))
+        os.replace(tmppath, sidecar)
+    except OSError as e:
+        # the reference might live somewhere we can't write to,
+        # we'll just have to probe again next time
+        print(f"could not write keyframe index: {e}")
+
+
+def streamKeyframeIndex(stream):
+    """
+    streamKeyframeIndex returns an empty KeyframeIndex for the video
+    stream described by stream, as ffprobe gives it to us
+    """
     # find the timebase, we use this to go from davinci frame numbers to
     # ffmpeg packet timestamps
     d, q = stream["time_base"].split('/')
@@ -209,375 +3357,699 @@ def steenbeck_inner(tempdir: str, args):
     d, q = stream["avg_frame_rate"].split('/')
     framerate = fractions.Fraction(int(d), int(q))
 
-    ptsperframe = (1/framerate)/timebase
-
-    def islastframe(pkt):
-        return pkt["pts"] + pkt["duration"] == stream["duration_ts"]
-
-    def findprevKeyframe(packets, i):
-        for j in reversed(range(i)):
-            if "K" in packets[j]["flags"]:
-                return packets[j]
-
-    def findnextKeyframe(packets, i):
-        for j in range(i, len(packets)):
-            if "K" in packets[j]["flags"]:
-                return packets[j]
-
-        # reached the end of the packet stream. We can get here
-        # either by not finding a keyframe or reaching the end
-        # of the video file
-        if islastframe(packets[j]):
-            return packets[j]["pts"]
-        raise Exception("did not find following keyframe")
-
-    for i, p in enumerate(packets):
-        framenum = p["pts"]/ptsperframe
-        if framenum in inKeyframe:
-            keyframepkt = findnextKeyframe(packets, i)
-            keyframe = keyframepkt["pts"]/ptsperframe
-            inKeyframe[framenum].inKeyframe = keyframe
-        if framenum in outKeyframe:
-            keyframepkt = findprevKeyframe(packets, i)
-            keyframe = keyframepkt["pts"]/ptsperframe
-            decdelta = (keyframepkt["dts"]-keyframepkt["pts"])/ptsperframe
-            outKeyframe[framenum].outKeyframe = keyframe
-            outKeyframe[framenum].outKfDelta = decdelta
-
-    dumpsegments("after keyframe search", segments)
-
-    # go through every segment, if any of the original segments have overlapping
-    # in and out keyframes, turn the segment into a target one
-    for i, s in enumerate(segments):
-        if isinstance(s, target):
-            continue
-        if s.inKeyframe >= s.outKeyframe:
-            segments[i] = target(
-                s.originalframe + s.positiondelta, 0, s.duration)
+    return KeyframeIndex(timebase, framerate, int(stream["duration_ts"]))
 
-    dumpsegments("after overlap target morph", segments)
 
-    # the previous pass can cause target segments next to each other.
-    # "roll up" consecutive target segments into one segment
-    newsegments = []
-    targetaccum = None
-    for i, s in enumerate(segments):
-        if isinstance(s, original):
-            if targetaccum != None:
-                newsegments.append(targetaccum)
-                targetaccum = None
-            newsegments.append(s)
-            continue
-        if targetaccum == None:
-            targetaccum = s
-        elif targetaccum.originalframe + targetaccum.duration == s.originalframe:
-            targetaccum.duration += s.duration
-        else:
-            newsegments.append(targetaccum)
-            targetaccum = None
-    if targetaccum != None:
-        newsegments.append(targetaccum)
+def probeKeyframeIndex(path, streams=None):
+    """
+    probeKeyframeIndex reads the keyframes of every video stream in path,
+    in one pass over the file, and returns where we can cut it
+    """
+    if streams is None:
+        streams = probeStreams(path)
+    indexes = {st["index"]: streamKeyframeIndex(st) for st in videoStreams(streams)}
+    for pkt in readPackets(path):
+        if pkt.flags & KEYFRAME and pkt.stream in indexes:
+            indexes[pkt.stream].add(pkt)
+    return commonKeyframes(list(indexes.values()))
 
-    segments = newsegments
-    dumpsegments("segment list before keyframe nudges", segments)
 
-    # create a new sequence with the in and out points
-    # of our segments nudged based on the data we found from ffmpeg
-    for i, s in enumerate(segments):
-        if isinstance(s, target):
-            continue
+def commonKeyframes(indexes):
+    """
+    commonKeyframes returns the keyframes of the first index that are
+    keyframes in all the others as well, with the same decode delay.
+    Those are the frames a file with more than one video stream can be cut
+    on, since the concat demuxer goes by one outpoint for every stream.
+    """
+    first = indexes[0]
+    if len(indexes) == 1:
+        return first
+
+    def delay(index, k):
+        return (index.dts[k] - index.pts[k]) / index.ptsperframe()
+
+    out = KeyframeIndex(first.timebase, first.framerate, first.durationts)
+    for k, framenum in enumerate(first.frames):
+        for other in indexes[1:]:
+            o = other.findnext(framenum)
+            if o is None or other.frames[o] != framenum or delay(other, o) != delay(first, k):
+                break
+        else:
+            out.add(packet(first.pts[k], first.dts[k], first.duration[k], first.flags[k]))
+    return out
 
-        innudge = s.inKeyframe - s.originalframe
-        outnudge = (s.originalframe + s.duration) - s.outKeyframe
-        if innudge > 0:
-            prevsegment = segments[i-1]
-            prevsegment.duration += innudge
-            s.duration -= innudge
-            s.originalframe += innudge
-        if outnudge > 0 and i != len(segments)-1:
-            nextseg = segments[i+1]
-            nextseg.duration += outnudge
-            nextseg.originalframe -= outnudge
-            s.duration -= outnudge
 
-    dumpsegments("segment list after keyframe nudges", segments)
-    # after we've nudged the cut points, find any segment
-    # that still has a difference between its outframe
-    # and the outgoing keyframe. This indicates a spot
-    # that needs glue
-    newsegments = []
-    for i, s in enumerate(segments):
-        if isinstance(s, target):
-            newsegments.append(s)
+def stitchedKeyframeIndex(path, segments, kfindex):
+    """
+    stitchedKeyframeIndex returns the KeyframeIndex of a file we stitched
+    together from segments. The keyframes of the parts copied out of the
+    reference are already in kfindex, they only need moving to where they
+    ended up. Only the parts that were rendered or re-encoded are read
+    from the file, along with its first packet. Like probeKeyframeIndex,
+    the keyframes of every video stream are read in the same pass.
+
+    Reading from the start of a rendered part seeks back to the keyframe
+    before it, which is one we worked out ourselves. If any of those
+    don't line up with what ffprobe finds, something shifted the
+    timestamps and we fall back to reading the whole file.
+    """
+    streams = probeStreams(path)
+    video = videoStreams(streams)
+    index = streamKeyframeIndex(video[0])
+    ptsperframe = index.ptsperframe()
+    if ptsperframe.denominator != 1:
+        return probeKeyframeIndex(path, streams)
+    ptsperframe = int(ptsperframe)
+    refptsperframe = kfindex.ptsperframe()
+
+    def seconds(framenum):
+        return f"{float(framenum / index.framerate):.6f}"
+
+    # start and end of every copied part, in output frames
+    copied = []
+    intervals = ["%+#1"]
+    pos = 0
+    for s in segments:
+        if s.duration <= 0:
             continue
-        outframe = s.originalframe + s.duration
-        if s.outKeyframe < outframe:
-            tgtduration = outframe - s.outKeyframe
-            s.duration -= tgtduration
-            tgtframe = s.originalframe + s.positiondelta
-            tgtframe += s.duration
-            newsegments.append(s)
-            newsegments.append(target(tgtframe, 0, tgtduration))
+        if isinstance(s, original):
+            k = kfindex.findnext(s.originalframe)
+            while k is not None and k < len(kfindex.frames) and kfindex.frames[k] < s.originalframe + s.duration:
+                pts = (kfindex.frames[k] - s.originalframe + pos) * ptsperframe
+                delay = (kfindex.dts[k] - kfindex.pts[k]) / refptsperframe
+                index.add(packet(pts, pts + round(delay * ptsperframe),
+                                 ptsperframe, kfindex.flags[k]))
+                k += 1
+            copied.append((pos, pos + s.duration))
         else:
-            newsegments.append(s)
-
-    segments = newsegments
-    dumpsegments("segment list after glue insertion", segments)
-    # consistency check
-    length = 0
-    for s in segments:
-        of = s.originalframe
-        if of < 0 or s.duration < 0:
-            raise Exception("overlapping segments, contact developer")
-        length += s.duration
-
-    if length != targetTimeline.GetEndFrame() - targetTimeline.GetStartFrame():
-        raise Exception(
-            "made a sequence that is not same length as intended result, contact developer")
-
-    # strip audio from the concatenation input
-    # the concatenation demuxer can get confused if it
-    # encounters audio packets and we're adding the audio
-    # back later anyway
-    _, ext = os.path.splitext(args.f)
-    basefile = f"base{ext}"
+            intervals.append(f"{seconds(pos)}%{seconds(pos + s.duration)}")
+        pos += s.duration
+
+    copiedstarts = [start for start, _ in copied]
+    # the keyframes of the rendered parts, for every stream
+    found = {st["index"]: streamKeyframeIndex(st) for st in video}
+    primary = video[0]["index"]
+    for pkt in readPackets(path, ",".join(intervals)):
+        if not pkt.flags & KEYFRAME or pkt.stream not in found:
+            continue
+        framenum, rem = divmod(pkt.pts, found[pkt.stream].ptsperframe())
+        if rem != 0:
+            return probeKeyframeIndex(path, streams)
+        c = bisect.bisect_right(copiedstarts, framenum) - 1
+        if c < 0 or framenum >= copied[c][1]:
+            found[pkt.stream].add(pkt)
+        elif pkt.stream == primary:
+            k = bisect.bisect_left(index.pts, pkt.pts)
+            if k == len(index.pts) or index.pts[k] != pkt.pts:
+                return probeKeyframeIndex(path, streams)
+    rendered = commonKeyframes(list(found.values()))
+    for k in range(len(rendered.pts)):
+        index.add(packet(rendered.pts[k], rendered.dts[k], rendered.duration[k], rendered.flags[k]))
+    return index
+
+
+class Manifest:
+    """
+    Manifest describes what a render we stitched together shows: the items
+    of the timeline it was rendered from, along with what calculateFrameSeqs
+    worked out about them, and the layout of the audio tracks. It is kept
+    next to the render, so that a later run can use the render as its
+    reference without the timeline it was made from.
+
+    Like the keyframe index sidecar, a manifest is tied to the size,
+    modification time and content hash of the render it describes.
+    """
+    MAGIC = b"STBKMAN1"
+    # magic, render size, mtime and content hash, size of the json header
+    HEADER = struct.Struct("<8sQq32sI")
+    # key, hash, start and end on the timeline, source position and rate
+    ITEM = struct.Struct("<32s32sqqqqqq")
+
+    def __init__(self, snapshot, layout):
+        self.snapshot = snapshot
+        self.layout = layout
+
+    def encode(self, size, mtime, contenthash):
+        snap = self.snapshot
+        framerate = None
+        if snap.framerate is not None:
+            framerate = [snap.framerate.numerator, snap.framerate.denominator]
+        # only the track types that were hashed have a memo to write out
+        tracktypes = sorted(t for t in snap.tracks if t in snap.memo)
+        meta = json.dumps({
+            "timeline": snap.uniqueid,
+            "startframe": snap.startframe,
+            "endframe": snap.endframe,
+            "framerate": framerate,
+            "audiolayout": self.layout if "audio" in tracktypes else None,
+            "tracks": {t: [len(items) for items in snap.tracks[t]] for t in tracktypes},
+            "inert": snap.inert,
+        }).encode()
+        out = [self.HEADER.pack(self.MAGIC, size, mtime, contenthash, len(meta)), meta]
+        for tracktype in tracktypes:
+            memo = snap.memo[tracktype]
+            for items in snap.tracks[tracktype]:
+                for rec in items:
+                    hash, srcstart, rate = memo[rec.key]
+                    srcstart = fractions.Fraction(srcstart)
+                    rate = fractions.Fraction(rate)
+                    out.append(self.ITEM.pack(rec.key, hash, rec.start, rec.end,
+                                              srcstart.numerator, srcstart.denominator,
+                                              rate.numerator, rate.denominator))
+        return b"".join(out)
+
+    @classmethod
+    def decode(cls, data, size, mtime, contenthash):
+        """
+        decode returns the manifest stored in data, or None if it does not
+        belong to the render described by size, mtime and contenthash.
+
+        The snapshot it comes back with has the hash of every item in its
+        cached memo, so calculateFrameSeqs never needs to ask about them.
+        """
+        magic, isize, imtime, ihash, metasize = cls.HEADER.unpack_from(data)
+        if magic != cls.MAGIC or (isize, imtime, ihash) != (size, mtime, contenthash):
+            return None
+        pos = cls.HEADER.size
+        meta = json.loads(data[pos:pos+metasize])
+        pos += metasize
+
+        framerate = None
+        if meta["framerate"] is not None:
+            framerate = fractions.Fraction(*meta["framerate"])
+        snap = timelineSnapshot(meta["timeline"], meta["startframe"],
+                                meta["endframe"], framerate)
+        # manifests from before inert properties don't say
+        snap.inert = meta.get("inert")
+        for tracktype in sorted(meta["tracks"]):
+            memo = {}
+            snap.tracks[tracktype] = []
+            for count in meta["tracks"][tracktype]:
+                items = []
+                for _ in range(count):
+                    (key, hash, start, end, srcnum, srcden,
+                     ratenum, rateden) = cls.ITEM.unpack_from(data, pos)
+                    pos += cls.ITEM.size
+                    if srcden <= 0 or rateden <= 0:
+                        raise ValueError("bad item in manifest")
+                    rec = item(start, end, None, None)
+                    rec.key = key
+                    items.append(rec)
+                    memo[key] = (hash, exactFraction(srcnum, srcden),
+                                 exactFraction(ratenum, rateden))
+                snap.tracks[tracktype].append(items)
+            snap.cached[tracktype] = SignatureCache.entry(None, None, memo)
+        if pos != len(data):
+            raise ValueError("truncated manifest")
+        return cls(snap, meta["audiolayout"])
+
+
+def saveManifest(path, manifest):
+    """
+    saveManifest writes manifest next to the render at path
+    """
+    st = os.stat(path)
+    contenthash = fileContentHash(path, st.st_size)
+    sidecar = f"{path}.stbkman"
+    try:
+        tmppath = f"{sidecar}.{os.getpid()}.tmp"
+        with open(tmppath, "wb") as f:
+            f.write(manifest.encode(st.st_size, st.st_mtime_ns, contenthash))
+        os.replace(tmppath, sidecar)
+    except OSError as e:
+        print(f"could not write manifest: {e}")
+
+
+def loadManifest(path):
+    """
+    loadManifest returns the Manifest next to the render at path, or None
+    if there isn't one for this render
+    """
+    st = os.stat(path)
+    try:
+        with open(f"{path}.stbkman", "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    try:
+        return Manifest.decode(data, st.st_size, st.st_mtime_ns,
+                               fileContentHash(path, st.st_size))
+    except (struct.error, ValueError, KeyError, TypeError):
+        return None
+
+
+def moveRender(src, dst):
+    """
+    moveRender moves a render and the sidecar files we keep next to it
+    """
+    os.replace(src, dst)
+    for suffix in (".stbkidx", ".stbkman"):
+        if os.path.exists(f"{src}{suffix}"):
+            os.replace(f"{src}{suffix}", f"{dst}{suffix}")
+
+
+# how many re-encodes of partial GOPs we run at the same time. The
+# encoders are multithreaded themselves, so this doesn't need to be many
+REENCODE_THREADS = 2
+
+# ffprobe codec names to the ffmpeg encoder we use to re-encode them
+REENCODERS = {
+    "h264": "libx264",
+    "prores": "prores_ks",
+    "dnxhd": "dnxhd",
+    "mjpeg": "mjpeg",
+}
+
+# the concat demuxer only has room for the parameter sets of one encoder
+# in the extradata, the reference's. x264 is told to put its own in front
+# of every keyframe, under an id the reference is unlikely to use, so
+# that neither side gets decoded with the other's. The others are intra
+# only and carry their headers in every frame. hevc can't be re-encoded:
+# x265 can't change its ids, and the reference's parameter sets aren't
+# repeated, so the frames after a re-encode get decoded with x265's. Nor
+# can mpeg2video, the concat demuxer lets a frame past the outpoint
+REENCODER_OPTIONS = {
+    "h264": ["-x264-params", "repeat-headers=1:sps-id=31"],
+}
+
+
+def reencodeCommand(stream, reference, start, frames, framerate, output):
+    """
+    reencodeCommand returns the ffmpeg command that decodes frames frames of
+    the reference from frame start onwards and encodes them again into output.
+    The encoder is set up with what ffprobe told us about the stream, so that
+    the concat demuxer can put the result next to stream copied packets.
+    """
+    startus = math.floor(1_000_000 * start / framerate)
     command = [
         "ffmpeg",
         "-y",
-        "-i", args.f,
-        "-c", "copy",
-        "-map", "0:v",
-        basefile
+        "-v", "error",
+        # seeking before the input decodes from the keyframe before start
+        # and throws the frames before it away
+        "-ss", f"{startus}us",
+        "-i", reference,
+        "-map", "0:v:0",
+        "-frames:v", str(frames),
+        "-c:v", REENCODERS[stream["codec_name"]],
+        *REENCODER_OPTIONS.get(stream["codec_name"], []),
+        "-r", stream["avg_frame_rate"],
+    ]
+    for key, option in [("pix_fmt", "-pix_fmt"), ("color_range", "-color_range"),
+                        ("color_space", "-colorspace"), ("color_transfer", "-color_trc"),
+                        ("color_primaries", "-color_primaries"), ("bit_rate", "-b:v")]:
+        value = stream.get(key)
+        if value is not None and value != "unknown":
+            command += [option, str(value)]
+
+    profile = stream.get("profile")
+    if profile and stream["codec_name"] in ("h264", "prores"):
+        # ffprobe says "High" or "High 4:2:2", the encoders want "high" and "high422"
+        profile = profile.lower()
+        for drop in (" ", ":", "constrained", "predictive"):
+            profile = profile.replace(drop, "")
+        command += ["-profile:v", profile]
+    level = stream.get("level", 0)
+    if stream["codec_name"] == "h264" and level > 0:
+        command += ["-level:v", f"{level/10:.1f}"]
+
+    # keep the timebase of the reference, or the concat demuxer
+    # has to rescale the timestamps of the copied packets
+    num, den = stream["time_base"].split('/')
+    _, ext = os.path.splitext(output)
+    if num == "1" and ext.lower() in (".mov", ".mp4", ".m4v"):
+        command += ["-video_track_timescale", den]
+    command.append(output)
+    return command
+
+
+def probeStreams(path):
+    """
+    probeStreams returns every stream in the file at path, as ffprobe sees them
+    """
+    command = [
+        "ffprobe",
+        "-print_format", "json",
+        "-show_streams",
+        "-i", path
     ]
-    res = subprocess.run(command, cwd=tempdir)
+    res = subprocess.run(command, capture_output=True)
     if res.returncode != 0:
-        raise Exception(f"failed audio strip")
+        raise Exception(f"failed to probe {path}")
+    return json.loads(res.stdout)["streams"]
 
-    res = project.LoadRenderPreset(args.renderpreset)
-    if res == False:
-        raise Exception(f"couldn't find render preset {args.renderpreset}")
 
-    jobs = []
-    AUDIOBASE = "audio"
-    audiorender = {
-        "ExportAudio": True,
-        "ExportVideo": False,
-        "MarkIn": originalTimeline.GetStartFrame(),
-        "MarkOut": originalTimeline.GetEndFrame(),
-        'TargetDir': tempdir,
-        'CustomName': AUDIOBASE
-    }
-    project.SetRenderSettings(audiorender)
-    job = project.AddRenderJob()
-    jobs.append(job)
+def videoStreams(streams):
+    """
+    videoStreams returns the video streams among streams, leaving
+    out cover art and thumbnails, which ffprobe also calls video
+    """
+    return [st for st in streams if st["codec_type"] == "video"
+            and not st.get("disposition", {}).get("attached_pic")]
 
-    for i, s in enumerate(segments):
-        if isinstance(s, target):
-            targetstart = s.originalframe + s.positiondelta
-            rendersettings = {
-                "ExportVideo": True,
-                "ExportAudio": False,
-                "MarkIn": int(originalTimeline.GetStartFrame() + targetstart),
-                "MarkOut": int(originalTimeline.GetStartFrame() + (targetstart+s.duration)-1),
-                'TargetDir': tempdir,
-                'CustomName': f'glue{i}'
-            }
-            project.LoadRenderPreset(args.renderpreset)
-            project.SetRenderSettings(rendersettings)
-            job = project.AddRenderJob()
-            jobs.append(job)
 
-    project.StartRendering(jobs, isInteractiveMode=False)
+def timecodeStreams(streams):
+    """
+    timecodeStreams returns the timecode tracks among streams
+    """
+    return [st for st in streams if st["codec_type"] == "data"
+            and st.get("codec_tag_string") == "tmcd"]
 
-    while project.IsRenderingInProgress():
-        time.sleep(1)
 
-    for j in jobs:
-        status = project.GetRenderJobStatus(j)
-        if status['JobStatus'] != 'Complete':
-            raise Exception(f"{j} render failed")
+class packet:
+    __slots__ = ("pts", "dts", "duration", "flags", "stream")
 
-    def durstring(framenum: fractions.Fraction) -> str:
-        posSecond = framenum/framerate
-        # microsecond is the smallest unit that ffmpeg parses
-        # so use it and discard any fractional component
-        us = 1_000_000 * posSecond
-        return f"{math.floor(us)}us"
+    def __init__(self, pts, dts, duration, flags, stream=0):
+        self.pts = pts
+        self.dts = dts
+        self.duration = duration
+        self.flags = flags
+        # index of the stream in the file
+        self.stream = stream
 
-    # generate file for ffmpeg concat demuxer
-    splicelines = []
-    for i, s in enumerate(segments):
-        if isinstance(s, original):
-            if s.duration <= 0:
-                continue
-            splicelines.append(f"file '{basefile}'")
-            splicelines.append(f"inpoint {durstring(s.originalframe)}")
-            # ffmpeg goes by decode timestamp when determining when to stop concatenating
-            # and the outpoint is exclusive, so we need to specify the frame before the keyframe
-            # Also, specify a duration since without this, it will take use the outpoint
-            # and mess up the presentation timestamp for the following file
-            outpoint = s.originalframe+s.duration
-            outpoint += s.outKfDelta
-            splicelines.append(f"outpoint {durstring(outpoint)}")
-            splicelines.append(f"duration {durstring(s.duration)}")
-        else:
-            if s.duration <= 0:
-                raise Exception("zero length 'to' segment, contact developer")
-            splicelines.append(f"file 'glue{i}{ext}'")
-            splicelines.append(f"duration {durstring(s.duration)}")
+    def __repr__(self) -> str:
+        return f"<packet stream:{self.stream} pts:{self.pts} dts:{self.dts} dur:{self.duration} flags:{self.flags}>"
 
-    fileloc = os.path.join(tempdir, "splice.txt")
-    with open(fileloc, "w") as splicefile:
-        splicefile.write("\n".join(splicelines))
 
-    # TODO(dmo): figure out if we can do this remux in one go
-    videofile = f"videoonly{ext}"
+def readPackets(path, intervals=None):
+    """
+    readPackets yields the packets of every video stream in path, in the
+    order ffprobe reads them. ffprobe output is read line by line as it comes
+    in, so this never holds more than one packet in memory.
+
+    If given, intervals is passed on to ffprobe as -read_intervals.
+    """
     command = [
-        "ffmpeg",
-        "-y",
-        "-report",
-        "-safe", "0",
-        "-f", "concat",
-        "-i", fileloc,
-        "-c", "copy",
-        "-map", "0:v:0",
-        videofile
+        "ffprobe",
+        "-v", "error",
+        "-print_format", "compact=print_section=0",
+        "-select_streams", "v",
+        "-show_entries", "packet=stream_index,pts,dts,duration,flags",
     ]
-    res = subprocess.run(command, cwd=tempdir)
+    if intervals is not None:
+        command += ["-read_intervals", intervals]
+    command += ["-i", path]
 
-    outputfile = args.o
-    if args.debuguniquename:
-        outputfile = os.path.join(tempdir, f"output{ext}")
-    else:
-        outputfile = os.path.abspath(outputfile)
+    with subprocess.Popen(command, stdout=subprocess.PIPE, text=True) as proc:
+        for line in proc.stdout:
+            pkt = parsePacket(line)
+            if pkt is not None:
+                yield pkt
+        if proc.wait() != 0:
+            raise Exception(f"failed to probe {path}")
 
-    command = [
-        "ffmpeg",
-        "-y",
-        "-i", videofile,
-        "-i", f"{AUDIOBASE}{ext}",
-        "-c", "copy",
-        "-map", "0:v:0",
-        "-map", "1",
-        # TODO(dmo): ffmpeg mp4 muxer doesn't like the aux data that
-        # BMD puts into their files. Strip the data streams
-        "-map", "-1:d",
-        outputfile
-    ]
-    res = subprocess.run(command, cwd=tempdir)
-
-
-def calculateFrameSeq(timeline):
-    """
-    calculateFrameSeq returns an array of hashes, each representing a frame in the timeline.
-    """
-    startframe = timeline.GetStartFrame()
-    tlduration = timeline.GetEndFrame() - startframe
-    frames = [None] * tlduration
-
-    trackcount = timeline.GetTrackCount('video')
-    for tc in range(1, trackcount+1):
-        items = timeline.GetItemListInTrack('video', tc)
-        for it in items:
-            name = it.GetName()
-            mpi = it.GetMediaPoolItem()
-            if mpi is not None:
-                mid = mpi.GetMediaId()
-                name = mid
-
-            start = it.GetStart() - startframe
-            end = it.GetEnd() - startframe
-
-            sourcestartframe = it.GetSourceStartFrame()
-            if sourcestartframe is not None:
-                # davinci will return 0 for both the first frame of the source
-                # and the frame after that. This makes the frame math infuriatingly
-                # special cased. The way to determine if we're inserting from the first
-                # frame is to see if we have any offset available on the left. This
-                # might be bounded by a transition overlay, but for this case, we can
-                # assume that no one is doing transitions on the absolutely first frame
-                # on of a clip
-                if sourcestartframe == 0 and it.GetLeftOffset(False) != 0:
-                    sourcestartframe += 1
-
-            # Get all the properties about this timeline item that we can find
-            # This will be added to a running hash that we keep for every
-            # frame in the timeline
-            props = it.GetProperty()
-            # I don't think resolve will give out dicts in random order
-            # but let's be safe
-            props = dict(sorted(props.items()))
-            # I know I'm not supposed to use marshal, but this is just a convenient
-            # binary representation of a dictionary
-            hashdata = marshal.dumps({
-                "name": name,
-                "props": props,
-                "frame": sourcestartframe,
-            })
-            # if the frame has yet to have a hash assigned, use a copy
-            # to instantiate it. We lazily instantiate this later if needed
-            basehash = None
 
-            for r in range(start, end):
-                hash = frames[r]
-                if hash is None:
-                    if basehash is None:
-                        basehash = hashlib.sha256(
-                            hashdata, usedforsecurity=False)
-                    hash = basehash.copy()
-                else:
-                    hash.update(hashdata)
+def parsePacket(line):
+    """
+    parsePacket parses a line of compact ffprobe output, like
+    "stream_index=0|pts=1024|dts=512|duration=512|flags=K__"
+    """
+    fields = {}
+    for field in line.strip().split("|"):
+        key, sep, value = field.partition("=")
+        if sep:
+            fields[key] = value
+    if "pts" not in fields or "flags" not in fields:
+        return None
+
+    def intfield(key):
+        v = fields.get(key, "N/A")
+        if v == "N/A":
+            return None
+        return int(v)
+
+    pts = intfield("pts")
+    if pts is None:
+        return None
+    dts = intfield("dts")
+    if dts is None:
+        dts = pts
+    return packet(pts, dts, intfield("duration") or 0, packetFlags(fields["flags"]),
+                  intfield("stream_index") or 0)
+
 
-                # TODO(dmo): figure out if we can calculate mapping from timeline frame number to
-                # source clip frame number. This would make it possible to discover sequences outside
-                # just cut boundaries. We used to have this feature, but it was impossible to determine
-                # when the timeline and source clip framerate didn't match.
-                # Every attempt ended up with a mismatch.
+KEYFRAME = 1
 
-                frames[r] = hash
 
-    return [f.digest() for f in frames]
+def packetFlags(flags):
+    """
+    packetFlags turns the ffprobe flag string, like "K__", into a bit set
+    """
+    bits = 0
+    for bit, c in enumerate("KDC"):
+        if c in flags:
+            bits |= 1 << bit
+    return bits
 
 
 def longestcommonsub(S1, S2):
     """
     Longest common subsequence
     """
+    return [S1[i] for i, _ in commonsubpairs(S1, S2)]
+
+
+# upper bound on the number of diagonal entries we keep around at once
+# while backtracking. Anything beyond this gets recomputed
+LCS_SCRATCH = 1 << 20
+
+
+def commonsubpairs(S1, S2):
+    """
+    commonsubpairs returns the (i, j) index pairs of the longest common
+    subsequence of S1 and S2.
+
+    The pairs are the ones you would get from backtracking the textbook
+    (m+1)*(n+1) dynamic programming table, but we never build the table.
+    Instead, we run Myers' greedy diff, which takes O((m+n)*D) time, where
+    D is the number of elements inserted or removed, and recompute the
+    diagonals we need while backtracking rather than storing all of them.
+    """
     m = len(S1)
     n = len(S2)
 
-    # TODO(dmo): trim common ends and beginnings
-    L = [[0 for x in range(n+1)] for x in range(m+1)]
+    # any common end is part of the subsequence, so there is no need to
+    # search through it. The table is backtracked from the end, so it
+    # matches these the same way. A common beginning isn't trimmed: when
+    # elements repeat, the table matches the last ones it can rather than
+    # the first, and the diff has to find that out the long way
+    suf = 0
+    while suf < m and suf < n and S1[m-1-suf] == S2[n-1-suf]:
+        suf += 1
+
+    pairs = myerspairs(S1[:m-suf], S2[:n-suf])
+    pairs.extend((m-suf+k, n-suf+k) for k in range(suf))
+    return pairs
+
+
+def heaviestcommonpairs(S1, S2, W1, W2):
+    """
+    heaviestcommonpairs returns the (i, j) index pairs of the common
+    subsequence of S1 and S2 with the largest total weight, where matching
+    S1[i] with S2[j] weighs min(W1[i], W2[j]).
+
+    This is what diffing runs of frames needs. Matching the most runs isn't
+    matching the most frames: moving a long clip behind a few short ones
+    would otherwise match the short ones and render the long one again.
+
+    Every pair of equal elements is a candidate, and the heaviest chain of
+    candidates going forward in both sequences is found by keeping the best
+    chain ending before every position of S2 in a Fenwick tree. That takes
+    O(R log n) time for R candidates. Signatures mostly show up once, so R
+    is about the length of the sequences, but when it would grow past
+    LCS_SCRATCH, we settle for the longest common subsequence instead.
+    """
+    m = len(S1)
+    n = len(S2)
+
+    # a common beginning or end that weighs the same on both sides is part
+    # of a heaviest subsequence, no other match can weigh more
+    pre = 0
+    while pre < m and pre < n and S1[pre] == S2[pre] and W1[pre] == W2[pre]:
+        pre += 1
+    suf = 0
+    while (suf < m-pre and suf < n-pre and S1[m-1-suf] == S2[n-1-suf]
+           and W1[m-1-suf] == W2[n-1-suf]):
+        suf += 1
+
+    positions = {}
+    for j in range(pre, n-suf):
+        positions.setdefault(S2[j], []).append(j)
+    candidates = sum(len(positions.get(S1[i], ())) for i in range(pre, m-suf))
+    if candidates > LCS_SCRATCH:
+        return commonsubpairs(S1, S2)
+
+    # tree[k] is the weight of the heaviest chain found so far that ends
+    # at or before position k-1 of the middle of S2, and chain[k] its
+    # last candidate
+    size = n - suf - pre
+    tree = [0] * (size+1)
+    chain = [-1] * (size+1)
+    ci = []
+    cj = []
+    before = []
+    for i in range(pre, m-suf):
+        js = positions.get(S1[i])
+        if js is None:
+            continue
+        # backwards, so that the candidates of one element of S1 don't
+        # chain onto each other
+        for j in reversed(js):
+            best = 0
+            last = -1
+            k = j - pre
+            while k > 0:
+                if tree[k] > best:
+                    best = tree[k]
+                    last = chain[k]
+                k -= k & -k
+            best += min(W1[i], W2[j])
+            c = len(ci)
+            ci.append(i)
+            cj.append(j)
+            before.append(last)
+            k = j - pre + 1
+            while k <= size:
+                if tree[k] < best:
+                    tree[k] = best
+                    chain[k] = c
+                k += k & -k
+
+    best = 0
+    last = -1
+    k = size
+    while k > 0:
+        if tree[k] > best:
+            best = tree[k]
+            last = chain[k]
+        k -= k & -k
+
+    pairs = []
+    while last >= 0:
+        pairs.append((ci[last], cj[last]))
+        last = before[last]
+    pairs.reverse()
+    return ([(k, k) for k in range(pre)] + pairs +
+            [(m-suf+k, n-suf+k) for k in range(suf)])
+
+
+def myerspairs(a, b):
+    m = len(a)
+    n = len(b)
+    if m == 0 or n == 0:
+        return []
+
+    # find out how many edits we need to get from a to b
+    v = myerslevel(a, b, None, 0)
+    d = 0
+    while not myersdone(m, n, v, d):
+        d += 1
+        v = myerslevel(a, b, v, d)
+
+    pairs = []
+    res = myerswalk(a, b, 0, myerslevel(a, b, None, 0), d, m, n, pairs)
+    if res is not None:
+        # whatever is left is the run of matches we started on
+        x, y = res
+        while x > 0 and y > 0:
+            x -= 1
+            y -= 1
+            pairs.append((x, y))
+    pairs.reverse()
+    return pairs
+
+
+def myerslevel(a, b, prev, d):
+    """
+    myerslevel extends the furthest reaching paths with d-1 edits in prev by
+    one more edit. Entry t is the x coordinate reached on diagonal k = 2t-d,
+    where k = x-y.
+
+    We do not clamp the coordinates to the edit graph. Paths that leave it
+    can never come back, so they do not change the answer for any point
+    inside it and it keeps the inner loop simple.
+    """
+    m = len(a)
+    n = len(b)
+    cur = [0] * (d+1)
+    for t in range(d+1):
+        if t == 0:
+            x = prev[0] if d > 0 else 0
+        elif t == d:
+            x = prev[t-1] + 1
+        else:
+            x = max(prev[t], prev[t-1] + 1)
+        y = x - (2*t - d)
+        while x < m and y < n and a[x] == b[y]:
+            x += 1
+            y += 1
+        cur[t] = x
+    return cur
 
-    for i in range(m+1):
-        for j in range(n+1):
-            if i == 0 or j == 0:
-                L[i][j] = 0
-            elif S1[i-1] == S2[j-1]:
-                L[i][j] = L[i-1][j-1] + 1
-            else:
-                L[i][j] = max(L[i-1][j], L[i][j-1])
 
-    index = L[m][n]
+def myersdone(m, n, v, d):
+    k = m - n
+    if abs(k) > d or (k + d) % 2 != 0:
+        return False
+    return v[(k + d)//2] >= m
 
-    lcs_algo = [None] * (index)
 
-    i = m
-    j = n
-    while i > 0 and j > 0:
+def myersreached(x, y, v, e):
+    """
+    myersreached reports whether the point (x, y) can be reached with e edits,
+    given the furthest reaching paths v for e edits.
+    """
+    k = x - y
+    if abs(k) > e:
+        return False
+    return v[(k + e)//2] >= x
+
 
-        if S1[i-1] == S2[j-1]:
-            lcs_algo[index-1] = S1[i-1]
-            i -= 1
-            j -= 1
-            index -= 1
+def myerswalk(a, b, lo, vlo, hi, x, y, pairs):
+    """
+    myerswalk backtracks from (x, y), which is hi edits away from the start,
+    until it is lo edits away, appending matches to pairs as it goes.
+    vlo holds the furthest reaching paths for lo edits.
+
+    This follows the same rules as backtracking the dynamic programming table,
+    matching whenever the elements are equal and otherwise skipping an element
+    of b unless skipping one from a is strictly better.
+    Returns the point we ended up on, or None if we hit the edge of the graph.
+    """
+    if hi - lo > 1 and (hi - lo) * (hi + 1) > LCS_SCRATCH:
+        # too many levels to keep around, split them in half and
+        # recompute the lower half once we're done with the upper one
+        mid = (lo + hi) // 2
+        v = vlo
+        for d in range(lo+1, mid+1):
+            v = myerslevel(a, b, v, d)
+        res = myerswalk(a, b, mid, v, hi, x, y, pairs)
+        if res is None:
+            return None
+        x, y = res
+        return myerswalk(a, b, lo, vlo, mid, x, y, pairs)
+
+    levels = [vlo]
+    for d in range(lo+1, hi):
+        levels.append(myerslevel(a, b, levels[-1], d))
+
+    for e in range(hi, lo, -1):
+        while x > 0 and y > 0 and a[x-1] == b[y-1]:
+            x -= 1
+            y -= 1
+            pairs.append((x, y))
+        if x == 0 or y == 0:
+            return None
 
-        elif L[i-1][j] > L[i][j-1]:
-            i -= 1
+        v = levels[e-1-lo]
+        up = myersreached(x-1, y, v, e-1)
+        left = myersreached(x, y-1, v, e-1)
+        if up and not left:
+            x -= 1
         else:
-            j -= 1
+            y -= 1
 
-    return lcs_algo
+    return x, y
 
 
 def FindTimeline(project, timelinename):
@@ -590,6 +4062,16 @@ def FindTimeline(project, timelinename):
     raise Exception(f"Could not find timeline {timelinename}")
 
 
+def FindTimelineById(project, uniqueid):
+    cnt = project.GetTimelineCount()
+    for i in range(1, cnt+1):
+        tl = project.GetTimelineByIndex(i)
+        if tl.GetUniqueId() == uniqueid:
+            return tl
+
+    raise Exception(f"Could not find timeline {uniqueid}")
+
+
 def GetTimelines(project, origtimeline):
     originalTl = FindTimeline(project, origtimeline)
     targetTl = project.GetCurrentTimeline()
@@ -0,0 +1,36 @@
+"""
+Hashes from the signature cache have to come out the same as hashing
+from scratch, whatever happened to the timeline in between.
+"""
+import pytest
+
+import fake_resolve
+import steenbeck
+
+
+def relink(timeline):
+    # same item, same place, different media
+    it = timeline.tracks["video"][0][3]
+    it.media = fake_resolve.MediaPoolItem("relinked", it.media.fps)
+
+
+def reinterpret(timeline):
+    # resolve told to take the media as another frame rate
+    timeline.tracks["video"][0][3].media.fps = "50"
+
+
+def opacity(timeline):
+    timeline.tracks["video"][0][3].props["Opacity"] = 50.0
+
+
+@pytest.mark.parametrize("change", [relink, reinterpret, opacity])
+def test_cache_sees_change(tmp_path, change):
+    cache = steenbeck.SignatureCache(str(tmp_path))
+    timeline = fake_resolve.syntheticTimeline(2, 20, seed=1)
+    before = fake_resolve.frameHashes(timeline, cache)
+    assert fake_resolve.frameHashes(timeline, cache) == before
+
+    change(timeline)
+    after = fake_resolve.frameHashes(timeline, cache)
+    assert after == fake_resolve.frameHashes(timeline)
+    assert after != before
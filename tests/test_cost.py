@@ -0,0 +1,47 @@
+"""
+The cost model gets fitted to the reports of earlier runs, and has to
+tell a full render from an incremental one by the glue they render.
+"""
+import json
+
+import pytest
+
+import steenbeck
+
+
+def writeReports(reportdir, runs):
+    for n, (info, phases) in enumerate(runs):
+        with open(reportdir / f"{n:03}.json", "w") as f:
+            json.dump({"error": None, "info": info, "phases": phases}, f)
+
+
+def test_calibrate_leaves_audio_out_of_glue(tmp_path):
+    runs = []
+    for jobs, frames in [(2, 100), (5, 700), (9, 300), (1, 2000)]:
+        runs.append(({"renderjobs": jobs, "renderframes": frames, "audiojobs": 1, "audioframes": 90000},
+                     {"render": jobs*4.0 + frames*0.03, "render audio": 4.0 + 90000*0.002}))
+    writeReports(tmp_path, runs)
+    model = steenbeck.costModel.calibrate(str(tmp_path))
+    assert model.reports == 4
+    assert model.jobseconds == pytest.approx(4.0)
+    assert model.frameseconds == pytest.approx(0.03)
+    assert model.audioseconds == pytest.approx(0.002)
+
+
+def test_calibrate_skips_reports_with_audio_in_the_render(tmp_path):
+    # from before audio had a phase of its own
+    writeReports(tmp_path, [({"renderjobs": 3, "renderframes": 90300}, {"render": 500.0})])
+    model = steenbeck.costModel.calibrate(str(tmp_path))
+    assert model.reports == 0
+    assert model.frameseconds == steenbeck.RENDER_FRAME_SECONDS
+
+
+def test_incremental_with_full_audio():
+    # rendering all of the audio costs a full render just as much, so a
+    # little glue still wins
+    model = steenbeck.costModel()
+    frames = 90000
+    incremental = model.estimate(12, 665, 0, frames, 1, frames)
+    full = model.estimate(1, frames, 0, 0, 0, frames)
+    assert incremental["audio"] > full["audio"]
+    assert incremental["total"] < full["total"]
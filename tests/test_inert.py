@@ -0,0 +1,29 @@
+"""
+Changing an inert item property mustn't change the hashes of its frames,
+and changing any other one must.
+"""
+import pytest
+
+import fake_resolve
+import steenbeck
+
+
+@pytest.mark.parametrize("prop, value, inertprop, renderprop, changes", [
+    ("ZoomGang", False, None, None, False),
+    ("ZoomGang", False, None, ["ZoomGang"], True),
+    ("CropRetain", True, None, None, True),
+    ("CropRetain", True, ["CropRetain"], None, False),
+    ("ZoomX", 1.5, None, None, True),
+])
+def test_inert_properties(prop, value, inertprop, renderprop, changes):
+    inert = steenbeck.inertProperties(inertprop, renderprop)
+    timeline = fake_resolve.syntheticTimeline(2, 20, seed=1)
+    before = fake_resolve.frameHashes(timeline, inert=inert)
+    timeline.tracks["video"][0][3].props[prop] = value
+    assert (fake_resolve.frameHashes(timeline, inert=inert) != before) == changes
+
+
+def test_inert_default_is_hashed_as_before():
+    # items that leave ZoomGang alone hash the same whether it is inert or not
+    timeline = fake_resolve.syntheticTimeline(2, 20, seed=1)
+    assert fake_resolve.frameHashes(timeline) == fake_resolve.frameHashes(timeline, inert={})
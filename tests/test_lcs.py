@@ -0,0 +1,155 @@
+"""
+Checks the Myers diff behind commonsubpairs against the dynamic programming
+table it replaced, on seeded random sequences.
+"""
+import random
+from array import array
+
+import pytest
+
+import steenbeck
+
+
+def tablepairs(S1, S2):
+    """
+    tablepairs is the longestcommonsub steenbeck used to have, returning
+    the index pairs it backtracks through instead of the elements
+    """
+    m = len(S1)
+    n = len(S2)
+
+    L = [[0 for x in range(n+1)] for x in range(m+1)]
+
+    for i in range(m+1):
+        for j in range(n+1):
+            if i == 0 or j == 0:
+                L[i][j] = 0
+            elif S1[i-1] == S2[j-1]:
+                L[i][j] = L[i-1][j-1] + 1
+            else:
+                L[i][j] = max(L[i-1][j], L[i][j-1])
+
+    pairs = []
+    i = m
+    j = n
+    while i > 0 and j > 0:
+        if S1[i-1] == S2[j-1]:
+            pairs.append((i-1, j-1))
+            i -= 1
+            j -= 1
+        elif L[i-1][j] > L[i][j-1]:
+            i -= 1
+        else:
+            j -= 1
+    pairs.reverse()
+    return pairs
+
+
+def randomSequence(rng, length, alphabet):
+    return [rng.randrange(alphabet) for _ in range(length)]
+
+
+def editedSequence(rng, seq, alphabet):
+    """
+    editedSequence returns seq with a few inserts, deletes and swaps, the
+    way an edited timeline relates to the one it was made from
+    """
+    out = list(seq)
+    for _ in range(rng.randint(0, 8)):
+        kind = rng.choice(["insert", "delete", "swap"])
+        i = rng.randint(0, len(out))
+        if kind == "insert":
+            out[i:i] = randomSequence(rng, rng.randint(1, 5), alphabet)
+        elif kind == "delete":
+            del out[i:i+rng.randint(1, 5)]
+        elif out:
+            out[min(i, len(out)-1)] = rng.randrange(alphabet)
+    return out
+
+
+def cases(seed, ncases):
+    rng = random.Random(seed)
+    for _ in range(ncases):
+        alphabet = rng.choice([2, 3, 10, 1000])
+        a = randomSequence(rng, rng.randint(0, 80), alphabet)
+        if rng.random() < 0.5:
+            b = randomSequence(rng, rng.randint(0, 80), alphabet)
+        else:
+            b = editedSequence(rng, a, alphabet)
+        yield a, b
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_same_pairs_as_table(seed):
+    for a, b in cases(seed, 200):
+        assert steenbeck.commonsubpairs(a, b) == tablepairs(a, b)
+
+
+@pytest.mark.parametrize("scratch", [0, 1, 7, 64])
+def test_same_pairs_with_little_scratch(monkeypatch, scratch):
+    # forces myerswalk to split its levels and recompute the lower half
+    monkeypatch.setattr(steenbeck, "LCS_SCRATCH", scratch)
+    for a, b in cases(100 + scratch, 200):
+        assert steenbeck.commonsubpairs(a, b) == tablepairs(a, b)
+
+
+def test_interned_arrays():
+    # diffing runs on the arrays of ids a SignatureTable hands out
+    for a, b in cases(200, 100):
+        pairs = steenbeck.commonsubpairs(array('I', a), array('I', b))
+        assert pairs == tablepairs(a, b)
+        assert steenbeck.longestcommonsub(array('I', a), array('I', b)) == [a[i] for i, _ in pairs]
+
+
+def test_edges():
+    for a, b in [([], []), ([1], []), ([], [1]), ([1], [1]), ([1, 2, 3], [1, 2, 3]),
+                 ([1, 2, 3], [3, 2, 1]), ([1, 1, 1], [1]), ([1, 2], [2, 1, 2])]:
+        assert steenbeck.commonsubpairs(a, b) == tablepairs(a, b)
+
+
+def heaviestweight(S1, S2, W1, W2):
+    """
+    heaviestweight returns the weight of the heaviest common subsequence,
+    from the dynamic programming table
+    """
+    L = [[0] * (len(S2)+1) for _ in range(len(S1)+1)]
+    for i in range(1, len(S1)+1):
+        for j in range(1, len(S2)+1):
+            L[i][j] = max(L[i-1][j], L[i][j-1])
+            if S1[i-1] == S2[j-1]:
+                L[i][j] = max(L[i][j], L[i-1][j-1] + min(W1[i-1], W2[j-1]))
+    return L[-1][-1]
+
+
+def weighted(seed, ncases):
+    rng = random.Random(seed)
+    for a, b in cases(seed, ncases):
+        yield a, b, [rng.randint(1, 300) for _ in a], [rng.randint(1, 300) for _ in b]
+
+
+def checkHeaviest(a, b, wa, wb):
+    pairs = steenbeck.heaviestcommonpairs(a, b, wa, wb)
+    assert all(a[i] == b[j] for i, j in pairs)
+    assert all(p < q for p, q in zip(pairs, pairs[1:]))
+    assert len({j for _, j in pairs}) == len(pairs)
+    assert sum(min(wa[i], wb[j]) for i, j in pairs) == heaviestweight(a, b, wa, wb)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_heaviest_weight_as_table(seed):
+    for a, b, wa, wb in weighted(300 + seed, 200):
+        checkHeaviest(a, b, wa, wb)
+
+
+def test_heaviest_with_equal_weights():
+    # with every element weighing the same, it is a longest common subsequence
+    for a, b in cases(400, 200):
+        pairs = steenbeck.heaviestcommonpairs(a, b, [1]*len(a), [1]*len(b))
+        assert len(pairs) == len(tablepairs(a, b))
+
+
+def test_heaviest_falls_back(monkeypatch):
+    # too many candidate pairs, so we get the longest common subsequence
+    monkeypatch.setattr(steenbeck, "LCS_SCRATCH", 0)
+    a, b = [1, 2, 3, 1], [2, 3, 1]
+    assert steenbeck.heaviestcommonpairs(a, b, [100, 1, 1, 1], [1, 1, 100]) == tablepairs(a, b)
@@ -0,0 +1,94 @@
+"""
+Putting titles and overlays on top of a clip, taking them off or moving
+them shouldn't make the rest of the clip underneath get rendered again.
+"""
+import pytest
+
+import fake_resolve
+import steenbeck
+from fake_resolve import DEFAULT_PROPERTIES, MediaPoolItem, Timeline, TimelineItem
+
+START = 86400
+
+
+def timeline(*tracks):
+    """
+    timeline returns a timeline with a video track for every list of
+    (media, start, end, source) in tracks
+    """
+    return Timeline("timeline", START, [
+        [TimelineItem(media, START+start, START+end, source, dict(DEFAULT_PROPERTIES))
+         for media, start, end, source in items]
+        for items in tracks], [])
+
+
+def rendered(frameseqs):
+    """
+    rendered returns the (start, end) of every target segment
+    """
+    originalFrames, targetFrames = frameseqs
+    # every frame is a keyframe, so that only the diff decides what gets rendered
+    nframes = originalFrames.duration
+    segments = steenbeck.buildSegments(originalFrames, targetFrames,
+                                       fake_resolve.syntheticIndex(nframes, range(nframes)), 0)
+    return [(s.originalframe + s.positiondelta, s.originalframe + s.positiondelta + s.duration)
+            for s in segments if isinstance(s, steenbeck.target)]
+
+
+def perFrame(snaps):
+    """
+    perFrame returns FrameSeqs with a run for every frame, which is what
+    diffing frame by frame would match
+    """
+    table = steenbeck.SignatureTable()
+    out = []
+    for snap in snaps:
+        tracks, _ = steenbeck.trackItems(snap, 'video')
+        out.append(steenbeck.sweepTracks(tracks, list(range(snap.endframe - snap.startframe + 1)), table))
+    return out
+
+
+clip = MediaPoolItem("clip")
+under = MediaPoolItem("under")
+title = MediaPoolItem("title")
+
+EDITS = {
+    "add": ([[(clip, 0, 100, 1000)], []],
+            [[(clip, 0, 100, 1000)], [(title, 40, 60, 0)]]),
+    "remove": ([[(clip, 0, 100, 1000)], [(title, 40, 60, 0)]],
+               [[(clip, 0, 100, 1000)], []]),
+    "move": ([[(clip, 0, 100, 1000)], [(title, 40, 60, 0)]],
+             [[(clip, 0, 100, 1000)], [(title, 70, 90, 0)]]),
+    # the cut the title makes has to go through both clips under it
+    "stacked": ([[(clip, 0, 100, 1000)], [(under, 20, 80, 500)], []],
+                [[(clip, 0, 100, 1000)], [(under, 20, 80, 500)], [(title, 40, 60, 0)]]),
+    # the same media under the title and further along, cut differently
+    "reused": ([[(clip, 0, 100, 1000), (clip, 100, 200, 1030)], []],
+               [[(clip, 0, 100, 1000), (clip, 100, 200, 1030)], [(title, 40, 60, 0)]]),
+}
+
+
+@pytest.mark.parametrize("edit", sorted(EDITS))
+def test_overlay_edits(edit):
+    original, target = EDITS[edit]
+    snaps = steenbeck.snapshotTimelines([timeline(*original), timeline(*target)], threads=1)
+    runs = rendered(steenbeck.calculateFrameSeqs(snaps))
+    assert runs == rendered(perFrame(snaps))
+
+
+def test_overlay_renders_only_the_overlay():
+    original, target = EDITS["move"]
+    snaps = steenbeck.snapshotTimelines([timeline(*original), timeline(*target)], threads=1)
+    # the copy before a cut ends on the keyframe before it, so the
+    # frame in front of each change gets rendered too
+    assert rendered(steenbeck.calculateFrameSeqs(snaps)) == [(39, 60), (69, 90)]
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_random_overlay_edits(seed):
+    original = fake_resolve.syntheticTimeline(2, 8, seed=seed)
+    target = fake_resolve.editTimeline(original, "overlay", 3, seed=seed)
+    snaps = steenbeck.snapshotTimelines([original, target], threads=1)
+    runs = sum(end - start for start, end in rendered(steenbeck.calculateFrameSeqs(snaps)))
+    frames = sum(end - start for start, end in rendered(perFrame(snaps)))
+    assert runs <= frames
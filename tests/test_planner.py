@@ -0,0 +1,156 @@
+"""
+The segment planners have to come up with the golden splice lists in
+data/planner_splices.json, for the seeded random runs and keyframes made by
+randomCase. They were generated with the planner from before it was split
+into planSegments and planSegmentsNumpy, then regenerated twice: 13 of them
+changed when nudgeToKeyframes was fixed to render the head of a timeline
+starting on reference frames off a keyframe, and 64 when the diff went from
+matching the most runs to matching the most frames with heaviestcommonpairs.
+"""
+import json
+import os
+import random
+from array import array
+
+import pytest
+
+import fake_resolve
+import steenbeck
+
+CASES = 300
+PINNED = os.path.join(os.path.dirname(__file__), "data", "planner_splices.json")
+
+
+def randomCase(seed):
+    """
+    randomCase returns the runs of an original and an edited timeline as
+    lists of (signature, length), the keyframes of a render of the original,
+    a mergegap and whether to smart render
+    """
+    rng = random.Random(seed)
+    sigs = iter(range(1, 1 << 30))
+    pool = [next(sigs) for _ in range(rng.randint(1, 80))]
+    originalRuns = [(rng.choice(pool), rng.randint(1, 300)) for _ in range(rng.randint(1, 60))]
+
+    targetRuns = []
+    for sig, length in originalRuns:
+        kind = rng.choices(["keep", "drop", "replace", "trim", "split", "insert"],
+                           [10, 1, 1, 1, 1, 1])[0]
+        if kind == "keep":
+            targetRuns.append((sig, length))
+        elif kind == "replace":
+            targetRuns.append((next(sigs), length))
+        elif kind == "trim" and length > 1:
+            # a run cut short still starts on the same frame
+            targetRuns.append((sig, rng.randint(1, length-1)))
+        elif kind == "split" and length > 1:
+            # something cut into it on another track
+            head = rng.randint(1, length-1)
+            targetRuns.append((sig, head))
+            targetRuns.append((next(sigs), length-head))
+        elif kind == "insert":
+            targetRuns.append((next(sigs), rng.randint(1, 100)))
+            targetRuns.append((sig, length))
+    if not targetRuns:
+        targetRuns.append((next(sigs), rng.randint(1, 100)))
+    if rng.random() < 0.1:
+        rng.shuffle(targetRuns)
+
+    nframes = sum(length for _, length in originalRuns)
+    gop = rng.choice([2, 12, 50, 250])
+    keyframes = [0]
+    while True:
+        k = keyframes[-1] + rng.randint(gop//2, gop + gop//2)
+        if k >= nframes:
+            break
+        keyframes.append(k)
+    return originalRuns, targetRuns, keyframes, rng.choice([0, 5, 25, 100]), rng.random() < 0.3
+
+
+def frameSeqs(originalRuns, targetRuns):
+    table = steenbeck.SignatureTable()
+    return [steenbeck.FrameSeq(array('Q', [sig for sig, _ in runs]), array('Q', [length for _, length in runs]), table)
+            for runs in (originalRuns, targetRuns)]
+
+
+def spliceList(segments):
+    lines, _ = steenbeck.spliceList(segments, fake_resolve.FRAMERATE, "reference.mp4",
+                                    lambda i: f"glue{i}.mp4", lambda i: f"reencode{i}.mp4")
+    return lines
+
+
+def plan(seed, vectorized):
+    originalRuns, targetRuns, keyframes, mergegap, smartrender = randomCase(seed)
+    originalFrames, targetFrames = frameSeqs(originalRuns, targetRuns)
+    kfindex = fake_resolve.syntheticIndex(originalFrames.duration, keyframes)
+    return spliceList(steenbeck.buildSegments(originalFrames, targetFrames, kfindex, mergegap,
+                                              smartrender=smartrender, vectorized=vectorized))
+
+
+@pytest.fixture(scope="module")
+def pinned():
+    with open(PINNED) as f:
+        return json.load(f)
+
+
+def test_python_planner(pinned):
+    for seed in range(CASES):
+        assert plan(seed, False) == pinned[str(seed)], f"case {seed}"
+
+
+def test_numpy_planner(pinned):
+    assert steenbeck.numpy is not None, "numpy isn't installed, pip install .[numpy] to test planSegmentsNumpy"
+    for seed in range(CASES):
+        if randomCase(seed)[4]:
+            # smart rendering always goes through the python planner
+            continue
+        assert plan(seed, True) == pinned[str(seed)], f"case {seed}"
+
+
+@pytest.mark.parametrize("vectorized", [False, True])
+def test_timeline_starting_on_reference_frames(vectorized):
+    # the target starts 20 frames before a keyframe of the reference,
+    # those have to be rendered rather than go missing
+    assert not vectorized or steenbeck.numpy is not None, "numpy isn't installed, pip install .[numpy] to test planSegmentsNumpy"
+    originalFrames, targetFrames = frameSeqs([(1, 50), (2, 50)], [(2, 50)])
+    kfindex = fake_resolve.syntheticIndex(originalFrames.duration, [0, 30, 70, 90])
+    segments = steenbeck.buildSegments(originalFrames, targetFrames, kfindex, 0, vectorized=vectorized)
+    assert [(type(s).__name__, s.originalframe + s.positiondelta, s.duration) for s in segments] == [
+        ("target", 0, 20), ("original", 20, 30)]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_planners_agree_on_timelines(seed):
+    # the same for edits of synthetic timelines, planned by cost as well
+    assert steenbeck.numpy is not None, "numpy isn't installed, pip install .[numpy] to test planSegmentsNumpy"
+    rng = random.Random(seed)
+    for case in range(40):
+        original = fake_resolve.syntheticTimeline(rng.randint(1, 3), rng.randint(1, 60), seed=case)
+        target = fake_resolve.editTimeline(original, rng.choice(fake_resolve.EDIT_PATTERNS),
+                                           rng.randint(0, 15), seed=case)
+        snaps = steenbeck.snapshotTimelines([original, target], threads=1)
+        originalFrames, targetFrames = steenbeck.calculateFrameSeqs(snaps)
+        keyframes = [0]
+        while keyframes[-1] < originalFrames.duration:
+            keyframes.append(keyframes[-1] + rng.randint(1, 100))
+        kfindex = fake_resolve.syntheticIndex(originalFrames.duration, keyframes[:-1])
+        mergegap = rng.choice([0, 5, 25, 100])
+        model = rng.choice([None, steenbeck.costModel()])
+
+        splices = [spliceList(steenbeck.buildSegments(originalFrames, targetFrames, kfindex, mergegap,
+                                                      vectorized=vectorized, model=model))
+                   for vectorized in (False, True)]
+        assert splices[0] == splices[1], f"case {case}"
+
+
+@pytest.mark.parametrize("vectorized", [False, True])
+def test_clip_move(vectorized):
+    # moving a long clip behind three short ones renders the short ones,
+    # not the long one, like diffing frame by frame would
+    assert not vectorized or steenbeck.numpy is not None, "numpy isn't installed, pip install .[numpy] to test planSegmentsNumpy"
+    originalFrames, targetFrames = frameSeqs([(1, 5000), (2, 25), (3, 25), (4, 25)],
+                                             [(2, 25), (3, 25), (4, 25), (1, 5000)])
+    nframes = originalFrames.duration
+    kfindex = fake_resolve.syntheticIndex(nframes, range(nframes))
+    segments = steenbeck.buildSegments(originalFrames, targetFrames, kfindex, 0, vectorized=vectorized)
+    assert sum(s.duration for s in segments if isinstance(s, steenbeck.target)) == 76
@@ -0,0 +1,84 @@
+"""
+Partial GOPs re-encoded for -smartrender get spliced into a stream copy of
+a reference made by another encoder, with other parameter sets. They have
+to decode the same there as they do on their own.
+
+This needs ffmpeg with libx264.
+"""
+import fractions
+import shutil
+import subprocess
+
+import pytest
+
+import steenbeck
+
+pytestmark = pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+
+# encoder settings for the reference that are unlike the ones we
+# re-encode with, so that the parameter sets differ, its pixel format and
+# the containers to splice it in
+REFERENCES = {
+    "h264": (["-c:v", "libx264", "-x264-params",
+              "keyint=50:min-keyint=50:scenecut=0:bframes=0:cabac=0:8x8dct=0:ref=1"],
+             "yuv420p", [".mp4", ".mov"]),
+    "mjpeg": (["-c:v", "mjpeg", "-q:v", "2"], "yuvj420p", [".mov"]),
+    "prores": (["-c:v", "prores_ks", "-profile:v", "3"], "yuv422p10le", [".mov"]),
+}
+
+
+def ffmpeg(cwd, *args):
+    return subprocess.run(["ffmpeg", "-y", "-v", "error", *args], cwd=cwd,
+                          capture_output=True, check=True).stdout
+
+
+def frameHashes(cwd, path):
+    lines = ffmpeg(cwd, "-i", path, "-map", "0:v:0", "-f", "framemd5", "-").decode().splitlines()
+    return [line.split(",")[-1].strip() for line in lines if not line.startswith("#")]
+
+
+def firstPacketNals(cwd, path):
+    """
+    firstPacketNals returns the h264 NAL unit types in the first video
+    packet of path, which the mp4 and mov muxers store with 4 byte lengths
+    """
+    data = ffmpeg(cwd, "-i", path, "-map", "0:v:0", "-c", "copy", "-frames:v", "1", "-f", "data", "-")
+    types = []
+    while data:
+        n = int.from_bytes(data[:4], "big")
+        types.append(data[4] & 0x1f)
+        data = data[4+n:]
+    return types
+
+
+@pytest.mark.parametrize("codec, ext", [(codec, ext) for codec, (_, _, exts) in REFERENCES.items() for ext in exts])
+def test_reencode_splices(tmp_path, codec, ext):
+    framerate = fractions.Fraction(25)
+    options, pixfmt, _ = REFERENCES[codec]
+    ref = f"reference{ext}"
+    ffmpeg(tmp_path, "-f", "lavfi", "-i", "testsrc2=size=320x240:rate=25:duration=8",
+           *options, "-pix_fmt", pixfmt, "-video_track_timescale", "12800", ref)
+    stream = {"codec_name": codec, "avg_frame_rate": "25/1", "time_base": "1/12800", "pix_fmt": pixfmt}
+
+    # frames 70 to 79 cut out of the middle of a GOP, the partial GOPs
+    # on both sides are re-encoded
+    segments = [steenbeck.original(0, 0, 50), steenbeck.reencode(50, 0, 20),
+                steenbeck.reencode(80, -10, 20), steenbeck.original(100, -10, 100)]
+    for s in segments:
+        s.outKfDelta = 0
+    for i, s in enumerate(segments):
+        if isinstance(s, steenbeck.reencode):
+            subprocess.run(steenbeck.reencodeCommand(stream, ref, s.originalframe, s.duration,
+                                                     framerate, f"reencode{i}{ext}"),
+                           cwd=tmp_path, check=True)
+            if codec == "h264":
+                assert {7, 8} <= set(firstPacketNals(tmp_path, f"reencode{i}{ext}"))
+
+    lines, _ = steenbeck.spliceList(segments, framerate, ref, None, lambda i: f"reencode{i}{ext}")
+    (tmp_path / "splice.txt").write_text("\n".join(lines) + "\n")
+    ffmpeg(tmp_path, "-f", "concat", "-safe", "0", "-i", "splice.txt", "-c", "copy", f"output{ext}")
+
+    reference = frameHashes(tmp_path, ref)
+    expected = (reference[:50] + frameHashes(tmp_path, f"reencode1{ext}") +
+                frameHashes(tmp_path, f"reencode2{ext}") + reference[100:])
+    assert frameHashes(tmp_path, f"output{ext}") == expected